@@ -0,0 +1,212 @@
+import os
+
+from models import iter_observations
+from storage import StorageWriter
+
+# Observation attributes written to each file, in order, with their Arrow
+# types. station_id and year are Hive partition keys and live in the path.
+ARROW_COLUMNS = [('temp_c', 'float32'), ('dewpoint_temp_c', 'float32'),
+                 ('rel_humidity_pct', 'uint8'), ('wind_dir_deg', 'uint16'),
+                 ('wind_speed_kph', 'uint16'), ('visibility_km', 'float32'),
+                 ('station_pressure_kpa', 'float32'), ('humidex', 'float32'),
+                 ('wind_chill', 'int16'), ('weather_desc', 'dictionary'),
+                 ('obs_datetime_std', 'timestamp'),
+                 ('obs_datetime_dst', 'timestamp'),
+                 ('obs_quality', 'dictionary')]
+
+class ArrowWriter(StorageWriter):
+    """
+    Columnar file destination writing Parquet (or Arrow IPC) datasets with
+    Hive-style partitioning:
+
+        <root_dir>/station_id=<id>/year=<yyyy>/part-<yyyymm>[-<n>].parquet
+
+    Each month that arrives becomes one row group (or record batch) of the
+    open file for its year, so memory stays bounded by one month. Columns are
+    typed like models.Observation, weather_desc and obs_quality are
+    dictionary encoded, and both datetimes are stored as second-resolution
+    timestamps in the same local wall-clock time as the SQL schema. A file
+    is named after the first month it holds, with a -<n> suffix when that
+    name is already taken, so a later run (eg. an incremental one resuming
+    the high-water month) adds a new file beside the existing ones instead
+    of overwriting them. The dataset is append-only: importing a range twice
+    stores it twice. pyarrow is imported when the writer is created.
+    """
+    def __init__(self, root_dir, fmt='parquet', compression='zstd'):
+        """
+        Keyword arguments:
+        root_dir -- Dataset root directory (created if needed).
+        fmt -- 'parquet' or 'arrow' for the Arrow IPC file format
+               (default 'parquet').
+        compression -- Parquet compression codec (default 'zstd').
+        """
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.root_dir = root_dir
+        self.fmt = fmt
+        self.compression = compression
+        self.schema = pyarrow.schema([pyarrow.field(name, self._type(kind))
+                                      for (name, kind) in ARROW_COLUMNS])
+        self.open_partition = None
+        self.open_file = None
+        self.open_sink = None
+        self.dictionaries = dict()
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _type(self, kind):
+        if kind == 'dictionary':
+            return self.pa.dictionary(self.pa.int32(), self.pa.string())
+        elif kind == 'timestamp':
+            return self.pa.timestamp('s')
+        return self.pa.type_for_alias(kind)
+
+    def _station_dir(self, station_id):
+        return os.path.join(self.root_dir, 'station_id=' + str(station_id))
+
+    def _partition_files(self, station_id):
+        """Return the data files of a station's newest year partition."""
+        station_dir = self._station_dir(station_id)
+        if not os.path.isdir(station_dir):
+            return []
+        years = sorted(int(name.split('=')[1])
+                       for name in os.listdir(station_dir)
+                       if name.startswith('year='))
+        while years:
+            year_dir = os.path.join(station_dir, 'year=' + str(years.pop()))
+            files = [os.path.join(year_dir, name)
+                     for name in sorted(os.listdir(year_dir))
+                     if name.endswith('.' + self.fmt)]
+            if files:
+                return files
+        return []
+
+    def latest_observation(self, station_id):
+        latest = None
+        for path in self._partition_files(station_id):
+            if self.fmt == 'parquet':
+                table = self.pq.read_table(path, columns=['obs_datetime_std'])
+            else:
+                with self.pa.memory_map(path, 'r') as source:
+                    table = self.pa.ipc.open_file(source).read_all()
+            for value in table.column('obs_datetime_std').to_pylist():
+                if value is not None and (latest is None or value > latest):
+                    latest = value
+        return latest
+
+    def write_station(self, station):
+        """Store station metadata beside the dataset in _stations/."""
+        station_dir = os.path.join(self.root_dir, '_stations')
+        os.makedirs(station_dir, exist_ok=True)
+        names = ['station_id', 'name', 'province', 'latitude', 'longitude',
+                 'elevation', 'climate_identifier', 'local_tz_str']
+        table = self.pa.table({name: [getattr(station, name)]
+                               for name in names})
+        self.pq.write_table(table, os.path.join(
+            station_dir, 'station_id=' + str(station.station_id) +
+            '.parquet'))
+
+    def write_observations(self, observations):
+        written = 0
+        month_key = None
+        rows = list()
+        for obs in iter_observations(observations):
+            obs_std = obs.obs_datetime_std
+            key = (obs.station_id, obs_std.year, obs_std.month)
+            if key != month_key and rows:
+                written += self._write_month(month_key, rows)
+                rows = list()
+            month_key = key
+            rows.append(obs)
+        if rows:
+            written += self._write_month(month_key, rows)
+        return written
+
+    def _write_month(self, month_key, rows):
+        """Append one month of observations as a row group."""
+        (station_id, year_num, month_num) = month_key
+        partition = (station_id, year_num)
+        if partition != self.open_partition:
+            self._close_file()
+            year_dir = os.path.join(self._station_dir(station_id),
+                                    'year=' + str(year_num))
+            os.makedirs(year_dir, exist_ok=True)
+            path = self._new_path(year_dir, year_num, month_num)
+            if self.fmt == 'parquet':
+                self.open_file = self.pq.ParquetWriter(
+                    path, self.schema, compression=self.compression)
+            else:
+                # IPC files accept one dictionary per field plus deltas
+                options = self.pa.ipc.IpcWriteOptions(
+                    emit_dictionary_deltas=True)
+                self.open_sink = self.pa.OSFile(path, 'wb')
+                self.open_file = self.pa.ipc.new_file(self.open_sink,
+                                                      self.schema,
+                                                      options=options)
+            self.open_partition = partition
+            self.dictionaries = dict()
+
+        arrays = list()
+        for (name, kind) in ARROW_COLUMNS:
+            values = [getattr(obs, name) for obs in rows]
+            if kind == 'dictionary':
+                arrays.append(self._dictionary_array(name, values))
+            elif kind == 'timestamp':
+                arrays.append(self.pa.array(
+                    [value.replace(tzinfo=None) if value else None
+                     for value in values], type=self.pa.timestamp('s')))
+            else:
+                arrays.append(self.pa.array(values, type=self._type(kind)))
+        table = self.pa.Table.from_arrays(arrays, schema=self.schema)
+        self.open_file.write_table(table)
+        return len(rows)
+
+    def _new_path(self, year_dir, year_num, month_num):
+        """
+        Return the first unused file name of part-<yyyymm>, part-<yyyymm>-1,
+        part-<yyyymm>-2... in year_dir.
+        """
+        stem = os.path.join(year_dir, 'part-' + str(year_num) +
+                            '%02d' % month_num)
+        path = stem + '.' + self.fmt
+        sequence = 0
+        while os.path.exists(path):
+            sequence += 1
+            path = stem + '-' + str(sequence) + '.' + self.fmt
+        return path
+
+    def _dictionary_array(self, name, values):
+        """
+        Dictionary-encode values against a dictionary that only grows while 
+        a file is open, so every batch extends the previous one.
+        """
+        (dictionary, index) = self.dictionaries.setdefault(name, ([], {}))
+        indices = list()
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            code = index.get(value)
+            if code is None:
+                code = len(dictionary)
+                dictionary.append(value)
+                index[value] = code
+            indices.append(code)
+        return self.pa.DictionaryArray.from_arrays(
+            self.pa.array(indices, type=self.pa.int32()),
+            self.pa.array(dictionary, type=self.pa.string()))
+
+    def _close_file(self):
+        if self.open_file is not None:
+            self.open_file.close()
+        if self.open_sink is not None:
+            self.open_sink.close()
+        self.open_file = None
+        self.open_sink = None
+        self.open_partition = None
+
+    def close(self):
+        """Finish the open file; it is unreadable until this is called."""
+        self._close_file()
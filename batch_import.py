@@ -0,0 +1,312 @@
+import argparse
+import collections
+import csv
+import io
+import itertools
+import json
+import sys
+import time
+
+from cache import ResponseCache
+from import_history import (BULKDATA_URL, HTTP_SESSION, MONTH_PARSERS,
+                            RateLimiter, canadian_timezones, month_range,
+                            open_content, ordered_map, parse_month_payload,
+                            read_content, write_months)
+from metrics import METRICS, profiled
+from storage import WRITER_DESTS, open_writer
+
+MANIFEST_FIELDS = ['station_id', 'tz_name', 'year_start', 'month_start',
+                   'year_end', 'month_end']
+
+def load_manifest(filename):
+    """
+    Read the stations to import from a CSV (with a header row) or JSON (a
+    list of objects) manifest. Each entry needs station_id, tz_name,
+    year_start, month_start, year_end and month_end; day_start is optional.
+
+    Return:
+    A list of dicts with integer fields converted.
+    """
+    with open(filename, 'r', newline='') as manifest_file:
+        if filename.lower().endswith('.json'):
+            rows = json.load(manifest_file)
+        else:
+            rows = list(csv.DictReader(manifest_file))
+
+    entries = list()
+    for (line, row) in enumerate(rows, 1):
+        missing = [field for field in MANIFEST_FIELDS if not row.get(field)]
+        if missing:
+            raise ValueError('Manifest entry ' + str(line) + ' is missing ' +
+                             ', '.join(missing))
+        if row['tz_name'] not in canadian_timezones():
+            raise ValueError('Manifest entry ' + str(line) +
+                             ' has an unknown tz_name ' + row['tz_name'])
+        entry = {'station_id': int(row['station_id']),
+                 'tz_name': row['tz_name'],
+                 'day_start': int(row.get('day_start') or 1)}
+        for field in ['year_start', 'month_start', 'year_end', 'month_end']:
+            entry[field] = int(row[field])
+        entries.append(entry)
+    return entries
+
+def parse_fetched(job):
+    """
+    Parse a fetched month in a parse worker process.
+
+    Keyword arguments:
+    job -- [idx, payload, source_format, station_id, tz_name] where payload
+           is None for a month that was not fetched.
+
+    Return:
+    A fetch result [idx, parsed, error] with parsed the
+    import_history.parse_month_payload vector, or None if there was no
+    payload or parsing raised error. Errors are returned rather than
+    raised, so that one bad month cannot end the shared ordered_map.
+    """
+    [idx, payload, source_format, station_id, tz_name] = job
+    if payload is None:
+        return [idx, None, None]
+    try:
+        return [idx, parse_month_payload((source_format, payload, station_id,
+                                          tz_name)), None]
+    except Exception as e:
+        return [idx, None, e]
+
+class BatchImporter():
+    """
+    Imports many stations through one shared pool of fetch workers. Every
+    (station, month) request goes through the same pool and RateLimiter, so
+    concurrency and politeness towards the data host are global rather than
+    per station. Months are parsed and written station by station in
+    chronological order, and a failing station is reported without stopping
+    the rest of the batch.
+    """
+    def __init__(self, entries, dest='csv', workers=4, max_rate=None,
+                 batch_size=100, cache=None, base_url=BULKDATA_URL,
+                 writer=None, source_format='xml', parse_workers=1):
+        self.entries = entries
+        self.dest = dest
+        self.writer = writer
+        self.workers = workers
+        self.batch_size = batch_size
+        self.cache = cache
+        self.base_url = base_url
+        self.source_format = source_format
+        self.parse_workers = parse_workers
+        self.rate_limiter = None
+        if max_rate:
+            self.rate_limiter = RateLimiter(max_rate)
+        self.failed = dict()
+
+    def _fetch(self, task):
+        """Download one (entry index, (year, month, day)) task."""
+        (idx, (y, m, d)) = task
+        if idx in self.failed:
+            # The station already failed; do not spend requests on it
+            return [idx, None, None]
+        entry = self.entries[idx]
+        try:
+            return [idx, read_content(open_content(
+                station_id=entry['station_id'], year_num=y, month_num=m,
+                day_num_start=d, timeframe=1, frmt=self.source_format,
+                base_url=self.base_url, rate_limiter=self.rate_limiter,
+                cache=self.cache)), None]
+        except Exception as e:
+            return [idx, None, e]
+
+    def _tasks(self):
+        for (idx, entry) in enumerate(self.entries):
+            for ymd in month_range(entry['year_start'], entry['month_start'],
+                                   entry['year_end'], entry['month_end'],
+                                   entry['day_start']):
+                yield (idx, ymd)
+
+    def _parse_jobs(self, results, fetch_errors):
+        """
+        Turn fetch results into parse_fetched jobs. Fetch errors stay in
+        this process (exceptions such as HTTPError do not survive pickling)
+        and are appended to fetch_errors, one per job, in job order.
+        """
+        for [idx, payload, error] in results:
+            entry = self.entries[idx]
+            fetch_errors.append(error)
+            if error is not None:
+                payload = None
+            yield [idx, payload, self.source_format, entry['station_id'],
+                   entry['tz_name']]
+
+    def _parse(self, results):
+        """
+        Parse fetch results in a pool of parse_workers processes, in order,
+        yielding [idx, parsed, error] like parse_fetched.
+        """
+        fetch_errors = collections.deque()
+        for [idx, parsed, error] in ordered_map(
+                parse_fetched, self._parse_jobs(results, fetch_errors),
+                self.parse_workers, processes=True):
+            fetch_error = fetch_errors.popleft()
+            if fetch_error is not None:
+                error = fetch_error
+            yield [idx, parsed, error]
+
+    def _months(self, idx, results, progress):
+        """
+        Parse a station's downloaded months in order, raising the first
+        fetch error encountered. With parse_workers above 1 the results were
+        already parsed by parse_fetched.
+        """
+        entry = self.entries[idx]
+        parse_func = MONTH_PARSERS[self.source_format]
+        station = None
+        for [result_idx, payload, error] in results:
+            if error is not None:
+                raise error
+            if self.parse_workers > 1:
+                [month_station, month_observations, stages] = payload
+                for (stage, seconds) in stages.items():
+                    METRICS.observe(stage, seconds)
+                if station is None:
+                    station = month_station
+                progress['months'] += 1
+                progress['observations'] += len(month_observations)
+                yield [station, month_observations]
+                continue
+            with METRICS.stage('parse'):
+                [station, month_observations] = parse_func(
+                    io.BytesIO(payload), entry['station_id'],
+                    entry['tz_name'], station)
+            progress['months'] += 1
+            progress['observations'] += len(month_observations)
+            yield [station, month_observations]
+
+    def run(self):
+        """
+        Import every manifest entry.
+
+        Return:
+        A dict mapping station_id to the exception that stopped its import,
+        empty when every station succeeded.
+        """
+        results = METRICS.timed_next('wait', ordered_map(
+            self._fetch, self._tasks(), self.workers))
+        if self.parse_workers > 1:
+            # Months are parsed in worker processes, still in order
+            results = self._parse(results)
+        grouped = itertools.groupby(results, key=lambda result: result[0])
+        for (idx, station_results) in grouped:
+            entry = self.entries[idx]
+            progress = {'months': 0, 'observations': 0}
+            start = time.monotonic()
+            try:
+                write_months(self._months(idx, station_results, progress),
+                             entry['station_id'], self.dest,
+                             batch_size=self.batch_size, writer=self.writer)
+            except Exception as e:
+                self.failed[idx] = e
+                METRICS.count('failed_stations')
+            status = 'OK'
+            if idx in self.failed:
+                status = 'FAILED (' + repr(self.failed[idx]) + ')'
+            print('[' + str(idx + 1) + '/' + str(len(self.entries)) + '] ' +
+                  'station ' + str(entry['station_id']) + ': ' +
+                  str(progress['months']) + ' months, ' +
+                  str(progress['observations']) + ' observations in ' +
+                  '%.1fs ' % (time.monotonic() - start) + status)
+
+        failures = dict()
+        for (idx, error) in self.failed.items():
+            failures[self.entries[idx]['station_id']] = error
+        return failures
+
+def main():
+    """
+    Batch entry point, intended to be called via command-line in place of
+    running import_history.py once per station.
+    """
+    description = ('Import Environment Canada historical weather for every '
+                   'station listed in a manifest.')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--manifest', required=True, type=str,
+                        help='CSV or JSON file listing ' +
+                             ', '.join(MANIFEST_FIELDS))
+    parser.add_argument('--dest', default='csv', type=str,
+                        choices=['csv'] + WRITER_DESTS,
+                        help='Destination of the parsed weather information')
+    parser.add_argument('--db_path', default=None, type=str,
+                        help='Database file for sqlite/duckdb, or directory for parquet/arrow')
+    parser.add_argument('--batch_size', default=100, type=int,
+                        help='If destination is SQL, control the INSERT batch size')
+    parser.add_argument('--workers', default=4, type=int,
+                        help='Months downloaded concurrently across all stations')
+    parser.add_argument('--parse_workers', default=1, type=int,
+                        help='Processes parsing months across all stations')
+    parser.add_argument('--max_rate', default=None, type=float,
+                        help='Maximum requests per second to the data host')
+    parser.add_argument('--timeout', default=30, type=float,
+                        help='Seconds to wait for the data host to connect or respond')
+    parser.add_argument('--retries', default=4, type=int,
+                        help='Retries, with jittered backoff, for failed requests')
+    parser.add_argument('--source_format', default='xml', type=str,
+                        choices=sorted(MONTH_PARSERS),
+                        help='Bulkdata format to download and parse')
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='Directory for a compressed cache of responses')
+    parser.add_argument('--cache_ttl', default=86400, type=int,
+                        help='Seconds before cached current/recent months expire')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only read responses from --cache_dir, never the network')
+    parser.add_argument('--metrics_json', default=None, type=str,
+                        help='Write per-stage timings and counters to this JSON file')
+    parser.add_argument('--metrics_prom', default=None, type=str,
+                        help='Write the same metrics as a Prometheus textfile')
+    parser.add_argument('--profile', default=None, type=str,
+                        choices=['cprofile', 'tracemalloc'],
+                        help='Profile the import and print the top entries')
+    parser.add_argument('--profile_out', default=None, type=str,
+                        help='Save the raw cProfile stats or tracemalloc snapshot here')
+    args = parser.parse_args()
+    HTTP_SESSION.timeout = args.timeout
+    HTTP_SESSION.retries = args.retries
+
+    cache = None
+    if args.cache_dir:
+        cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl,
+                              offline=args.offline)
+    elif args.offline:
+        parser.error('--offline requires --cache_dir')
+
+    writer = None
+    if args.dest in WRITER_DESTS:
+        # One writer serves every station in the batch
+        writer = open_writer(args.dest, db_path=args.db_path,
+                             batch_size=args.batch_size)
+
+    importer = BatchImporter(load_manifest(args.manifest), dest=args.dest,
+                             workers=args.workers, max_rate=args.max_rate,
+                             batch_size=args.batch_size, cache=cache,
+                             writer=writer, source_format=args.source_format,
+                             parse_workers=args.parse_workers)
+    METRICS.reset()
+    try:
+        with profiled(args.profile, args.profile_out):
+            failures = importer.run()
+    finally:
+        if writer is not None:
+            writer.close()
+        METRICS.set_counters(HTTP_SESSION.stats, prefix='http_')
+        for line in METRICS.summary_lines():
+            print(line)
+        labels = {'manifest': args.manifest, 'dest': args.dest,
+                  'source_format': args.source_format}
+        if args.metrics_json:
+            METRICS.write_json(args.metrics_json, labels)
+        if args.metrics_prom:
+            METRICS.write_prometheus(args.metrics_prom, labels)
+    if failures:
+        print(str(len(failures)) + ' station(s) failed: ' +
+              ', '.join(str(station_id) for station_id in failures))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1012 @@
+import argparse
+import calendar
+import contextlib
+import hashlib
+import io
+import json
+import operator
+import os
+import pickle
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from urllib import request
+from xml.etree import ElementTree
+
+import import_history
+import storage
+import synthetic
+from batch_import import load_manifest
+from cache import ResponseCache
+from http_session import HTTPSession
+from metrics import METRICS
+from models import OBSERVATION_ATTRIBUTES, Observation, ObservationBatch
+
+def legacy_parse_month(source, station_id, local_tz_name):
+    """
+    The pre-streaming range_hourly parse loop: read and decode the whole
+    response, build the full ElementTree, then walk its stationdata elements.
+    """
+    [station_std_tz, station_local_tz] = import_history.station_timezones(
+                                                                local_tz_name)
+    xml_string = source.read().decode('utf-8')
+    weather_root = ElementTree.fromstring(xml_string)
+    observations = list()
+    for sd_elmnt in weather_root.iter('stationdata'):
+        observations.append(import_history.parse_stationdata(
+                                sd_elmnt, station_id, station_std_tz,
+                                station_local_tz))
+    return observations
+
+def streaming_parse_month(source, station_id, local_tz_name):
+    """Parse a month with the iterparse-based import_history.parse_month."""
+    return import_history.parse_month(source, station_id, local_tz_name)[1]
+
+PARSERS = {'legacy': legacy_parse_month, 'streaming': streaming_parse_month}
+
+def run_parse_case(case, paths, tz_name):
+    """
+    Parse every file in paths with the named parser and return the
+    measurements as a dict. Intended to run in a fresh interpreter so that
+    the peak RSS belongs to this case alone.
+    """
+    parse_func = PARSERS[case]
+    rows = 0
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, 'rb') as source:
+            rows += len(parse_func(source, 1, tz_name))
+    elapsed = time.perf_counter() - start
+    return {'case': case, 'rows': rows, 'seconds': elapsed,
+            'rows_per_sec': rows / elapsed,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def bench_parse(months, tz_name):
+    """
+    Compare records/sec and peak RSS of the legacy and streaming parsers over
+    a synthetic corpus of months, each case in its own subprocess.
+    """
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = list()
+        for (y, m, d) in import_history.month_range(2000, 1, 2100, 12):
+            if len(paths) == months:
+                break
+            path = os.path.join(tmp_dir, str(y) + '-' + str(m) + '.xml')
+            with open(path, 'wb') as xml_file:
+                xml_file.write(synthetic.month_xml(1, y, m))
+            paths.append(path)
+
+        for case in sorted(PARSERS):
+            cmd = [sys.executable, os.path.abspath(__file__), '--tz_name',
+                   tz_name, 'parse-case', case] + paths
+            output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE)
+            results.append(json.loads(output.stdout.decode('utf-8')))
+    return results
+
+class DictObservation():
+    """models.Observation as it was before __slots__, for comparison."""
+    def __init__(self, observation):
+        for name in Observation.__slots__:
+            setattr(self, name, getattr(observation, name))
+
+def _measure(build):
+    """
+    Return [seconds, traced peak bytes, result] of calling build(). Timing 
+    and memory come from separate calls since tracing slows allocation.
+    """
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = build()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return [elapsed, peak, result]
+
+def bench_models(months, tz_name):
+    """
+    Compare memory and build/iterate throughput of a month-by-month import 
+    held as dict-backed objects, __slots__ Observations and ObservationBatch 
+    columns.
+    """
+    sources = list()
+    for (y, m, d) in import_history.month_range(2000, 1, 2100, 12):
+        if len(sources) == months:
+            break
+        sources.append(import_history.parse_month(
+                           io.BytesIO(synthetic.month_xml(1, y, m)), 1,
+                           tz_name)[1])
+    rows = sum(len(month) for month in sources)
+
+    builders = {
+        'dict': lambda: [[DictObservation(obs) for obs in month]
+                         for month in sources],
+        'slots': lambda: [[_copy_observation(obs) for obs in month]
+                          for month in sources],
+        'batch': lambda: [_batch_month(month) for month in sources]}
+
+    results = list()
+    for case in ['dict', 'slots', 'batch']:
+        [build_secs, peak, built] = _measure(builders[case])
+        start = time.perf_counter()
+        iterated = 0
+        for month in built:
+            for obs in month:
+                iterated += obs.temp_c is not None
+        iter_secs = time.perf_counter() - start
+        results.append({'case': case, 'rows': rows,
+                        'bytes_per_row': peak / rows,
+                        'build_rows_per_sec': rows / build_secs,
+                        'iter_rows_per_sec': rows / iter_secs})
+        del built
+    return results
+
+def _copy_observation(observation):
+    """Copy an Observation so the source rows are not what is measured."""
+    copy = Observation()
+    for name in Observation.__slots__:
+        setattr(copy, name, getattr(observation, name))
+    return copy
+
+def _batch_month(month):
+    """Pack a list of Observations into an ObservationBatch."""
+    batch = ObservationBatch(1)
+    for obs in month:
+        batch.append(obs)
+    return batch
+
+BENCH_STATION_ID = 999999
+
+def _bench_observations(months, tz_name):
+    """
+    Return [station, observations] for about months synthetic months under 
+    BENCH_STATION_ID.
+    """
+    observations = list()
+    station = None
+    for (y, m, d) in import_history.month_range(2000, 1, 2100, 12):
+        if len(observations) >= months * 28 * 24:
+            break
+        [station, month_observations] = import_history.parse_month(
+            io.BytesIO(synthetic.month_xml(BENCH_STATION_ID, y, m)),
+            BENCH_STATION_ID, tz_name, station)
+        observations.extend(month_observations)
+    return [station, observations]
+
+def legacy_sql_insert(cursor, observations, batch_size):
+    """
+    The pre-MySQLWriter INSERT loop, which rebuilds the statement string and 
+    parameter tuple with += for every row of every batch.
+    """
+    batch_start_idx = 0
+    while batch_start_idx < len(observations):
+        batch_idx_upperbound = min(batch_start_idx + batch_size,
+                                   len(observations))
+        ins_data = ()
+        ins_obs = ('INSERT INTO envcan_observation (' +
+                   ', '.join(storage.OBSERVATION_COLUMNS) + ') VALUES ')
+        for i in range(batch_start_idx, batch_idx_upperbound):
+            ins_obs += '(' + ', '.join(['%s'] * 14) + ')'
+            ins_data += storage.observation_row(observations[i])
+            if i != (batch_idx_upperbound - 1):
+                ins_obs += ', '
+        cursor.execute(ins_obs, ins_data)
+        batch_start_idx = batch_idx_upperbound
+
+def bench_sql(batch_sizes, months, tz_name):
+    """
+    Compare rows/sec of the legacy INSERT loop, MySQLWriter's executemany 
+    path and its LOAD DATA LOCAL INFILE path against the MySQL schema named 
+    by config.mysql_config(). Rows are written under a dedicated 
+    stationID and deleted between runs, so use a scratch schema.
+    """
+    from config import mysql_config
+    
+    [station, observations] = _bench_observations(months, tz_name)
+    config = mysql_config()
+    config['raise_on_warnings'] = False
+    writers = {'executemany': storage.MySQLWriter(config, pool_name='bench'),
+               'load_data': storage.MySQLWriter(config, bulk=True, 
+                                                pool_name='bench_bulk')}
+    writers['executemany'].write_station(station)
+    
+    results = list()
+    for batch_size in batch_sizes:
+        for case in ['legacy', 'executemany', 'load_data']:
+            cnx = writers['executemany'].pool.get_connection()
+            cursor = cnx.cursor()
+            cursor.execute('DELETE FROM envcan_observation ' +
+                           'WHERE stationID = %s', (BENCH_STATION_ID,))
+            cnx.commit()
+            
+            start = time.perf_counter()
+            if case == 'legacy':
+                legacy_sql_insert(cursor, observations, batch_size)
+                cnx.commit()
+            else:
+                writers[case].batch_size = batch_size
+                writers[case].write_observations(observations)
+            elapsed = time.perf_counter() - start
+            cursor.close()
+            cnx.close()
+            results.append({'case': case, 'batch_size': batch_size,
+                            'rows': len(observations),
+                            'rows_per_sec': len(observations) / elapsed})
+    for writer in writers.values():
+        writer.close()
+    return results
+
+def _stored_rows(cursor):
+    """Return the number of observations stored for BENCH_STATION_ID."""
+    cursor.execute('SELECT COUNT(*) FROM envcan_observation ' + 
+                   'WHERE stationID = ' + str(BENCH_STATION_ID))
+    return cursor.fetchone()[0]
+
+def bench_upsert(months, tz_name, dest='sqlite', batch_size=1000):
+    """
+    Compare rows/sec of plain INSERT and upsert writes. The '_again' cases 
+    time writing every row a second time, which updates the stored rows in 
+    place; test_import_history.py checks that such re-imports are no-ops.
+    
+    Keyword arguments:
+    dest -- 'sqlite' (a fresh database per case, 'insert_no_key' being the 
+            schema before station_dt_std_uniq) or 'sql' for the MySQL 
+            schema named by config.mysql_config(), where rows are written 
+            under a dedicated stationID and deleted between cases, so use a 
+            scratch schema.
+    """
+    [station, observations] = _bench_observations(months, tz_name)
+    results = list()
+    
+    def measure(case, writer, cursor):
+        start = time.perf_counter()
+        writer.write_observations(observations)
+        elapsed = time.perf_counter() - start
+        results.append({'case': case, 'dest': dest, 'rows': len(observations), 
+                        'stored': _stored_rows(cursor), 
+                        'rows_per_sec': len(observations) / elapsed})
+    
+    if dest == 'sqlite':
+        cases = [['insert_no_key', False], ['insert', False], 
+                 ['upsert', True]]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for [case, upsert] in cases:
+                writer = storage.SQLiteWriter(os.path.join(tmp_dir, case + 
+                                                           '.sqlite'), 
+                                              batch_size, upsert=upsert)
+                if case == 'insert_no_key':
+                    writer.cnx.execute('DROP INDEX station_dt_std_uniq')
+                    writer.cnx.execute('CREATE INDEX station_dt_std_idx ' + 
+                                       'ON envcan_observation ' + 
+                                       '(stationID, obs_datetime_std)')
+                writer.write_station(station)
+                measure(case, writer, writer.cnx.cursor())
+                if upsert:
+                    measure(case + '_again', writer, writer.cnx.cursor())
+                writer.close()
+        return results
+    
+    from config import mysql_config
+    
+    config = mysql_config()
+    config['raise_on_warnings'] = False
+    writers = {'insert': storage.MySQLWriter(config, batch_size, 
+                                             pool_name='bench', 
+                                             upsert=False), 
+               'upsert': storage.MySQLWriter(config, batch_size, 
+                                             pool_name='bench_upsert'), 
+               'load_data_replace': storage.MySQLWriter(
+                   config, batch_size, bulk=True, pool_name='bench_bulk')}
+    writers['insert'].write_station(station)
+    for case in ['insert', 'upsert', 'load_data_replace']:
+        cnx = writers['insert'].pool.get_connection()
+        cursor = cnx.cursor()
+        cursor.execute('DELETE FROM envcan_observation ' +
+                       'WHERE stationID = %s', (BENCH_STATION_ID,))
+        cnx.commit()
+        measure(case, writers[case], cursor)
+        if writers[case].upsert:
+            cnx.commit()
+            measure(case + '_again', writers[case], cursor)
+        cursor.close()
+        cnx.close()
+    for writer in writers.values():
+        writer.close()
+    return results
+
+def bench_tz(year_start, year_end):
+    """
+    Compare the throughput of tzconvert's batched conversion and per-row 
+    pytz astimezone for every hour of every month in the range, in every 
+    zone of canadian_timezones(). test_import_history.py checks that both 
+    give identical results.
+    """
+    import tzconvert
+    
+    results = list()
+    for tz_name in import_history.canadian_timezones():
+        [std_tz, local_tz] = import_history.station_timezones(tz_name)
+        table = tzconvert.transition_table(tz_name)
+        rows = 0
+        pytz_secs = 0.0
+        table_secs = 0.0
+        for (y, m, d) in import_history.month_range(year_start, 1, year_end, 
+                                                    12):
+            first = datetime(y, m, 1, tzinfo=std_tz)
+            days = calendar.monthrange(y, m)[1]
+            std_datetimes = [first + timedelta(hours=h) 
+                             for h in range(days * 24)]
+            
+            start = time.perf_counter()
+            expected = [dt.astimezone(local_tz) for dt in std_datetimes]
+            pytz_secs += time.perf_counter() - start
+            start = time.perf_counter()
+            actual = table.localize(std_datetimes)
+            table_secs += time.perf_counter() - start
+            rows += len(std_datetimes)
+        results.append({'tz_name': tz_name, 'rows': rows,
+                        'pytz_rows_per_sec': rows / pytz_secs,
+                        'table_rows_per_sec': rows / table_secs})
+    return results
+
+def legacy_decode_stationdata(sd_elmnt, observation):
+    """
+    The find()-per-field decode that import_history.parse_stationdata used 
+    before models.OBSERVATION_FIELDS.
+    """
+    temp_txt = sd_elmnt.find('temp').text
+    if temp_txt and temp_txt != ' ':
+        observation.temp_c = float(temp_txt)
+    dptemp_txt = sd_elmnt.find('dptemp').text
+    if dptemp_txt and dptemp_txt != ' ':
+        observation.dewpoint_temp_c = float(dptemp_txt)
+    relhum_txt = sd_elmnt.find('relhum').text
+    if relhum_txt and relhum_txt != ' ':
+        observation.rel_humidity_pct = int(relhum_txt)
+    winddir_txt = sd_elmnt.find('winddir').text
+    if winddir_txt and winddir_txt != ' ':
+        observation.wind_dir_deg = int(winddir_txt) * 10
+    windspd_txt = sd_elmnt.find('windspd').text
+    if windspd_txt and windspd_txt != ' ':
+        observation.wind_speed_kph = int(windspd_txt)
+    visibility_txt = sd_elmnt.find('visibility').text
+    if visibility_txt and visibility_txt != ' ':
+        observation.visibility_km = float(visibility_txt)
+    stnpress_txt = sd_elmnt.find('stnpress').text
+    if stnpress_txt and stnpress_txt != ' ':
+        observation.station_pressure_kpa = float(stnpress_txt)
+    humidex_txt = sd_elmnt.find('humidex').text
+    if humidex_txt and humidex_txt != ' ':
+        observation.humidex = float(humidex_txt)
+    windchill_txt = sd_elmnt.find('windchill').text
+    if windchill_txt and windchill_txt != ' ':
+        observation.wind_chill = int(windchill_txt)
+    observation.weather_desc = sd_elmnt.find('weather').text
+
+DECODERS = {'legacy': legacy_decode_stationdata,
+            'field_table': import_history.decode_stationdata}
+
+def bench_decode(years, repeat=5):
+    """
+    Time only the per-row child-element decode over a synthetic corpus of 
+    years * 12 months, with the elements already parsed, and check that both 
+    decoders produce identical observations. The best of repeat runs is 
+    reported for each decoder.
+    """
+    elements = list()
+    for (y, m, d) in import_history.month_range(2000, 1, 2000 + years - 1, 
+                                                12):
+        root = ElementTree.fromstring(synthetic.month_xml(1, y, m))
+        elements.extend(root.iter('stationdata'))
+
+    decoded = dict()
+    results = list()
+    for case in sorted(DECODERS):
+        decode = DECODERS[case]
+        elapsed = None
+        for i in range(repeat):
+            observations = [Observation() for sd_elmnt in elements]
+            start = time.perf_counter()
+            for (sd_elmnt, observation) in zip(elements, observations):
+                decode(sd_elmnt, observation)
+            run_secs = time.perf_counter() - start
+            if elapsed is None or run_secs < elapsed:
+                elapsed = run_secs
+        decoded[case] = observations
+        results.append({'case': case, 'rows': len(elements), 
+                        'seconds': elapsed,
+                        'ns_per_row': elapsed * 1e9 / len(elements)})
+
+    values = operator.attrgetter(*OBSERVATION_ATTRIBUTES)
+    for (legacy, field_table) in zip(decoded['legacy'], 
+                                     decoded['field_table']):
+        assert values(legacy) == values(field_table), (values(legacy), 
+                                                       values(field_table))
+    return results
+
+def bench_formats(months, tz_name, repeat=3):
+    """
+    Parse the same synthetic months from bulkdata XML and CSV and compare 
+    document size and the best-of-repeat parse throughput of each format. 
+    test_import_history.py checks that both give identical results.
+    """
+    documents = {'xml': list(), 'csv': list()}
+    for (y, m, d) in import_history.month_range(2000, 1, 2100, 12):
+        if len(documents['xml']) == months:
+            break
+        documents['xml'].append(synthetic.month_xml(1, y, m))
+        documents['csv'].append(synthetic.month_csv(1, y, m))
+
+    results = list()
+    for source_format in sorted(documents):
+        parse_func = import_history.MONTH_PARSERS[source_format]
+        elapsed = None
+        for i in range(repeat):
+            station = None
+            observations = list()
+            start = time.perf_counter()
+            for payload in documents[source_format]:
+                [station, month_observations] = parse_func(
+                    io.BytesIO(payload), 1, tz_name, station)
+                observations.extend(month_observations)
+            run_secs = time.perf_counter() - start
+            if elapsed is None or run_secs < elapsed:
+                elapsed = run_secs
+        results.append({'format': source_format, 'rows': len(observations),
+                        'bytes': sum(len(payload) for payload 
+                                     in documents[source_format]),
+                        'seconds': elapsed,
+                        'rows_per_sec': len(observations) / elapsed})
+    return results
+
+def bench_timeframes(years, tz_name):
+    """
+    Import the same range of years from a local BulkdataServer as hourly 
+    observations and as daily and monthly summaries, comparing the number 
+    of requests, rows and elapsed time of each, from both XML and CSV.
+    """
+    server = synthetic.BulkdataServer().start()
+    results = list()
+    try:
+        year_end = 2000 + years - 1
+        for (name, range_func) in [('hourly', import_history.range_hourly), 
+                                   ('daily', import_history.range_daily), 
+                                   ('monthly', import_history.range_monthly)]:
+            parsed = dict()
+            for source_format in ['csv', 'xml']:
+                requests_before = server.request_count
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    parsed[source_format] = range_func(
+                        1, 2000, year_end, 1, 12, 1, tz_name, 
+                        base_url=server.url, source_format=source_format)
+                elapsed = time.perf_counter() - start
+                results.append({'timeframe': name, 'format': source_format,
+                                'requests': (server.request_count - 
+                                             requests_before),
+                                'rows': len(parsed[source_format][1]),
+                                'seconds': elapsed})
+    finally:
+        server.stop()
+    return results
+
+def legacy_fetch(url):
+    """Baseline fetch: one urlopen (and one connection) per request."""
+    with request.urlopen(url) as response:
+        return response.read()
+
+def bench_http(months, workers):
+    """
+    Fetch the same months from a local BulkdataServer with urllib's urlopen 
+    and with an HTTPSession, comparing requests, connections, bytes on the 
+    wire and elapsed time, then measure conditional revalidation of an 
+    expired cache and recovery from injected 503s and dropped connections.
+    """
+    server = synthetic.BulkdataServer().start()
+    tasks = list(import_history.month_range(2000, 1, 2100, 12))[:months]
+    urls = [server.url + '?format=xml&stationID=1&Year=' + str(y) + 
+            '&Month=' + str(m) + '&Day=1&timeframe=1' for (y, m, d) in tasks]
+    expected = [synthetic.month_xml(1, y, m) for (y, m, d) in tasks]
+    session = HTTPSession(backoff=0.01)
+
+    def session_fetch(url):
+        with session.get(url) as response:
+            return response.read()
+
+    def counters():
+        return [server.request_count, server.connection_count, 
+                server.bytes_sent, server.not_modified_count]
+
+    def run(name, fetch_func):
+        before = counters()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            payloads = list(fetch_func())
+        elapsed = time.perf_counter() - start
+        after = counters()
+        return {'case': name, 'workers': workers, 'months': len(payloads),
+                'requests': after[0] - before[0],
+                'connections': after[1] - before[1],
+                'bytes': after[2] - before[2],
+                'not_modified': after[3] - before[3], 'seconds': elapsed}
+
+    results = list()
+    try:
+        results.append(run('urlopen', lambda: import_history.ordered_map(
+            legacy_fetch, urls, workers)))
+        results.append(run('session', lambda: import_history.ordered_map(
+            session_fetch, urls, workers)))
+        assert list(import_history.ordered_map(session_fetch, urls, 
+                                               workers)) == expected
+
+        # An expired cache is revalidated rather than downloaded again
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(cache_dir, ttl=0, recent_days=10 ** 6)
+
+            def cached_fetch():
+                for (y, m, d) in tasks:
+                    with import_history.open_content(
+                            1, y, m, d, base_url=server.url, cache=cache, 
+                            session=session) as source:
+                        yield source.read()
+            with contextlib.redirect_stdout(io.StringIO()):
+                list(cached_fetch())
+            results.append(run('revalidate', cached_fetch))
+            with contextlib.redirect_stdout(io.StringIO()):
+                assert list(cached_fetch()) == expected
+
+        # Every month fails once, with a 503 or a dropped connection
+        server.fail_statuses = [503, None, 0, None] * (len(urls) // 2)
+        retries_before = session.stats['retries']
+        results.append(run('retry', lambda: import_history.ordered_map(
+            session_fetch, urls, 1)))
+        results[-1]['retries'] = session.stats['retries'] - retries_before
+        assert not server.fail_statuses
+    finally:
+        server.stop()
+    return results
+
+def _git_revision():
+    """Return [commit, dirty] for the working tree, or [None, None]."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                check=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        status = subprocess.run(['git', 'status', '--porcelain', '-uno'],
+                                cwd=here, check=True, stdout=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return [None, None]
+    return [commit.stdout.decode().strip(), bool(status.stdout.strip())]
+
+def suite_fetch(server, entries, source_format, workers):
+    """Download every month of the corpus through an HTTPSession."""
+    session = HTTPSession()
+    tasks = [(entry['station_id'], y, m)
+             for entry in entries
+             for (y, m, d) in import_history.month_range(
+                 entry['year_start'], entry['month_start'],
+                 entry['year_end'], entry['month_end'])]
+
+    def fetch(task):
+        (station_id, y, m) = task
+        with session.get(server.url + '?format=' + source_format +
+                         '&stationID=' + str(station_id) + '&Year=' +
+                         str(y) + '&Month=' + str(m) +
+                         '&Day=1&timeframe=1') as response:
+            return len(response.read())
+
+    wire_before = server.bytes_sent
+    start = time.perf_counter()
+    body_bytes = sum(import_history.ordered_map(fetch, tasks, workers))
+    elapsed = time.perf_counter() - start
+    return {'bench': 'fetch', 'format': source_format, 'workers': workers,
+            'months': len(tasks), 'bytes': body_bytes,
+            'wire_bytes': server.bytes_sent - wire_before,
+            'connections': session.stats['connections'],
+            'seconds': elapsed, 'months_per_sec': len(tasks) / elapsed}
+
+def suite_parse(corpus_dir, entries, source_format):
+    """Parse every month of the corpus from disk."""
+    parse_func = import_history.MONTH_PARSERS[source_format]
+    rows = 0
+    elapsed = 0.0
+    for entry in entries:
+        station = None
+        for (y, m, d) in import_history.month_range(
+                entry['year_start'], entry['month_start'],
+                entry['year_end'], entry['month_end']):
+            with open(synthetic.corpus_path(corpus_dir, source_format,
+                                            entry['station_id'], y, m),
+                      'rb') as source:
+                payload = source.read()
+            start = time.perf_counter()
+            [station, observations] = parse_func(
+                io.BytesIO(payload), entry['station_id'], entry['tz_name'],
+                station)
+            elapsed += time.perf_counter() - start
+            rows += len(observations)
+    return {'bench': 'parse', 'format': source_format, 'rows': rows,
+            'seconds': elapsed, 'rows_per_sec': rows / elapsed}
+
+def suite_import(server, entries, source_format, dest, workers, work_dir,
+                 parse_workers=1):
+    """
+    Import every station of the corpus from the server with iter_hourly and
+    write_months, as import_history.py does, into dest ('csv', 'sqlite' or
+    'sql'). Files are written under work_dir. For 'sql' the corpus stations'
+    rows are deleted first, so point config.mysql_config() at a scratch
+    schema.
+    """
+    writer = None
+    if dest == 'sqlite':
+        writer = storage.open_writer('sqlite', db_path=os.path.join(
+            work_dir, source_format + '.sqlite'), batch_size=1000)
+    elif dest == 'sql':
+        writer = storage.open_writer('sql', batch_size=1000)
+        cnx = writer.pool.get_connection()
+        cursor = cnx.cursor()
+        for entry in entries:
+            cursor.execute('DELETE FROM envcan_observation ' +
+                           'WHERE stationID = %s', (entry['station_id'],))
+        cnx.commit()
+        cursor.close()
+        cnx.close()
+
+    cwd = os.getcwd()
+    METRICS.reset()
+    start = time.perf_counter()
+    try:
+        # CSV files are named after the station in the working directory
+        os.chdir(work_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for entry in entries:
+                months = import_history.iter_hourly(
+                    entry['station_id'], entry['year_start'],
+                    entry['year_end'], entry['month_start'],
+                    entry['month_end'], 1, entry['tz_name'], workers=workers,
+                    base_url=server.url, source_format=source_format,
+                    parse_workers=parse_workers)
+                import_history.write_months(months, entry['station_id'],
+                                            dest, writer=writer)
+            if writer is not None:
+                writer.close()
+    finally:
+        os.chdir(cwd)
+    elapsed = time.perf_counter() - start
+    report = METRICS.report()
+    rows = report['counters'].get('rows', 0)
+
+    if dest == 'csv':
+        written = 0
+        for entry in entries:
+            with open(os.path.join(work_dir, str(entry['station_id']) +
+                                   'observations.csv'), 'r') as obs_file:
+                written += sum(1 for line in obs_file) - 1
+        assert written == rows, (written, rows)
+    elif dest == 'sqlite':
+        import sqlite3
+        cnx = sqlite3.connect(os.path.join(work_dir,
+                                           source_format + '.sqlite'))
+        written = cnx.execute('SELECT COUNT(*) FROM envcan_observation'
+                              ).fetchone()[0]
+        cnx.close()
+        assert written == rows, (written, rows)
+    return {'bench': 'import', 'format': source_format, 'dest': dest,
+            'workers': workers, 'parse_workers': parse_workers,
+            'rows': rows, 'seconds': elapsed,
+            'rows_per_sec': rows / elapsed,
+            'stages': dict((stage, summary['seconds']) for (stage, summary)
+                           in report['stages'].items())}
+
+def bench_suite(corpus_dir, stations, years, workers, formats, dests):
+    """
+    Run the fetch, parse and end-to-end import benchmarks over a synthetic
+    corpus of stations x years (see synthetic.write_corpus), served by a
+    local BulkdataServer. The corpus is written to corpus_dir unless one
+    with the same parameters is already there.
+
+    Return:
+    A dict with the git commit, interpreter, corpus parameters and the list
+    of results, ready to be saved as JSON and compared with compare_suite.
+    """
+    [wanted, entries] = _corpus_entries(corpus_dir, stations, years, formats)
+
+    results = list()
+    server = synthetic.BulkdataServer(corpus_dir=corpus_dir).start()
+    try:
+        for source_format in sorted(formats):
+            results.append(suite_fetch(server, entries, source_format,
+                                       workers))
+            results.append(suite_parse(corpus_dir, entries, source_format))
+            for dest in dests:
+                with tempfile.TemporaryDirectory() as work_dir:
+                    results.append(suite_import(server, entries,
+                                                source_format, dest,
+                                                workers, work_dir))
+    finally:
+        server.stop()
+
+    [commit, dirty] = _git_revision()
+    return {'commit': commit, 'dirty': dirty,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'corpus': wanted, 'results': results}
+
+def _corpus_entries(corpus_dir, stations, years, formats):
+    """Write a corpus unless an identical one exists and load its manifest."""
+    info = synthetic.read_corpus(corpus_dir)
+    wanted = {'stations': stations, 'years': years, 'year_start': 2000,
+              'formats': sorted(formats)}
+    if info is None or dict(info, formats=sorted(info['formats'])) != wanted:
+        synthetic.write_corpus(corpus_dir, stations, years,
+                               formats=sorted(formats))
+    return [wanted, load_manifest(os.path.join(corpus_dir, 'manifest.csv'))]
+
+def _digest_dir(directory, suffix):
+    """Return the md5 of the concatenated files ending in suffix."""
+    digest = hashlib.md5()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(suffix):
+            with open(os.path.join(directory, name), 'rb') as data_file:
+                digest.update(data_file.read())
+    return digest.hexdigest()
+
+def bench_scaling(corpus_dir, stations, years, source_format, worker_counts,
+                  workers):
+    """
+    Parse the synthetic corpus with import_history.parse_month_payload in
+    pools of each size in worker_counts (1 means in this process), then run
+    the end-to-end CSV import with the same numbers of parse_workers,
+    checking that every run writes byte-identical files.
+    """
+    [corpus, entries] = _corpus_entries(corpus_dir, stations, years,
+                                        [source_format])
+    tasks = list()
+    for entry in entries:
+        for (y, m, d) in import_history.month_range(
+                entry['year_start'], entry['month_start'],
+                entry['year_end'], entry['month_end']):
+            with open(synthetic.corpus_path(corpus_dir, source_format,
+                                            entry['station_id'], y, m),
+                      'rb') as source:
+                tasks.append((source_format, source.read(),
+                              entry['station_id'], entry['tz_name']))
+
+    results = list()
+    digests = set()
+    server = synthetic.BulkdataServer(corpus_dir=corpus_dir).start()
+    try:
+        for parse_workers in worker_counts:
+            start = time.perf_counter()
+            rows = 0
+            pickled = 0
+            for [station, batch, stages] in import_history.ordered_map(
+                    import_history.parse_month_payload, tasks, parse_workers,
+                    processes=True):
+                rows += len(batch)
+                pickled += len(pickle.dumps(batch))
+            elapsed = time.perf_counter() - start
+            results.append({'bench': 'parse', 'format': source_format,
+                            'parse_workers': parse_workers, 'rows': rows,
+                            'pickled_bytes_per_row': pickled / rows,
+                            'seconds': elapsed, 'rows_per_sec': rows / elapsed,
+                            'cpus': os.cpu_count()})
+
+            with tempfile.TemporaryDirectory() as work_dir:
+                result = suite_import(server, entries, source_format, 'csv',
+                                      workers, work_dir, parse_workers)
+                digests.add(_digest_dir(work_dir, 'observations.csv'))
+            result['cpus'] = os.cpu_count()
+            results.append(result)
+    finally:
+        server.stop()
+    assert len(digests) == 1, digests
+    return results
+
+def _suite_key(result):
+    return (result['bench'], result['format'], result.get('dest'))
+
+def compare_suite(baseline, current, tolerance):
+    """
+    Compare two bench_suite documents case by case.
+
+    Return:
+    A list of [case name, baseline seconds, current seconds, ratio,
+    regressed] where ratio is current / baseline and regressed is set when
+    the case got more than tolerance (eg. 0.1 for 10%) slower.
+    """
+    if baseline['corpus'] != current['corpus']:
+        raise ValueError('Results were measured on different corpora: ' +
+                         json.dumps(baseline['corpus']) + ' and ' +
+                         json.dumps(current['corpus']))
+    previous = dict((_suite_key(result), result)
+                    for result in baseline['results'])
+    rows = list()
+    for result in current['results']:
+        old = previous.get(_suite_key(result))
+        if old is None:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        rows.append(['/'.join(part for part in _suite_key(result) if part),
+                     old['seconds'], result['seconds'], ratio,
+                     ratio > 1 + tolerance])
+    return rows
+
+def main():
+    """Command-line entry point for the benchmarks."""
+    parser = argparse.ArgumentParser(description='import_history benchmarks')
+    parser.add_argument('--tz_name', default='America/Toronto', type=str,
+                        help='IANA timezone string used when parsing')
+    subparsers = parser.add_subparsers(dest='bench')
+    parse_parser = subparsers.add_parser('parse',
+                                         help='Compare XML parse loops')
+    parse_parser.add_argument('--months', default=12, type=int,
+                              help='Number of synthetic months to parse')
+    models_parser = subparsers.add_parser('models',
+                                          help='Compare observation storage')
+    models_parser.add_argument('--months', default=12, type=int,
+                               help='Number of synthetic months to hold')
+    sql_parser = subparsers.add_parser('sql',
+                                       help='Compare MySQL write paths')
+    sql_parser.add_argument('--months', default=12, type=int,
+                            help='Number of synthetic months to write')
+    sql_parser.add_argument('--batch_sizes', default='100,1000,5000,10000',
+                            type=str, help='Comma separated batch sizes')
+    upsert_parser = subparsers.add_parser(
+        'upsert', help='Compare INSERT and idempotent upsert writes')
+    upsert_parser.add_argument('--months', default=12, type=int,
+                               help='Number of synthetic months to write')
+    upsert_parser.add_argument('--dest', default='sqlite', type=str,
+                               choices=['sqlite', 'sql'],
+                               help='Database written; sql is MySQL '
+                                    '(scratch schema only)')
+    upsert_parser.add_argument('--batch_size', default=1000, type=int,
+                               help='Rows per executemany call')
+    suite_parser = subparsers.add_parser(
+        'suite', help='Fetch, parse and import a synthetic corpus')
+    suite_parser.add_argument('--stations', default=4, type=int,
+                              help='Stations in the corpus')
+    suite_parser.add_argument('--years', default=2, type=int,
+                              help='Years per station')
+    suite_parser.add_argument('--corpus_dir', default='bench_corpus',
+                              type=str,
+                              help='Where the corpus is written and reused')
+    suite_parser.add_argument('--workers', default=4, type=int,
+                              help='Concurrent fetches')
+    suite_parser.add_argument('--formats', default='xml,csv', type=str,
+                              help='Comma separated source formats')
+    suite_parser.add_argument('--dests', default='csv,sqlite', type=str,
+                              help='Comma separated import destinations; '
+                                   'add sql for MySQL (scratch schema only)')
+    suite_parser.add_argument('--output', default=None, type=str,
+                              help='Save the results to this JSON file')
+    suite_parser.add_argument('--compare', default=None, type=str,
+                              help='Earlier --output file to compare with')
+    suite_parser.add_argument('--tolerance', default=0.1, type=float,
+                              help='Slowdown (eg. 0.1 = 10%%) reported as '
+                                   'a regression by --compare')
+    scaling_parser = subparsers.add_parser(
+        'scaling', help='Scale parsing over worker processes')
+    scaling_parser.add_argument('--stations', default=4, type=int,
+                                help='Stations in the corpus')
+    scaling_parser.add_argument('--years', default=2, type=int,
+                                help='Years per station')
+    scaling_parser.add_argument('--corpus_dir', default='bench_corpus',
+                                type=str,
+                                help='Where the corpus is written and reused')
+    scaling_parser.add_argument('--format', default='xml', type=str,
+                                choices=['xml', 'csv'],
+                                help='Source format parsed')
+    scaling_parser.add_argument('--parse_workers', default=None, type=str,
+                                help='Comma separated pool sizes (default '
+                                     '1, 2, 4... up to the CPU count)')
+    scaling_parser.add_argument('--workers', default=4, type=int,
+                                help='Concurrent fetches in the imports')
+    http_parser = subparsers.add_parser('http',
+                                        help='Compare urlopen and HTTPSession')
+    http_parser.add_argument('--months', default=120, type=int,
+                             help='Number of synthetic months to fetch')
+    http_parser.add_argument('--workers', default=4, type=int,
+                             help='Concurrent fetches')
+    timeframes_parser = subparsers.add_parser(
+        'timeframes', help='Compare hourly, daily and monthly imports')
+    timeframes_parser.add_argument('--years', default=10, type=int,
+                                   help='Number of synthetic years imported')
+    formats_parser = subparsers.add_parser('formats',
+                                           help='Compare XML and CSV parsing')
+    formats_parser.add_argument('--months', default=12, type=int,
+                                help='Number of synthetic months to parse')
+    decode_parser = subparsers.add_parser('decode',
+                                          help='Compare stationdata decoders')
+    decode_parser.add_argument('--years', default=10, type=int,
+                               help='Number of synthetic years to decode')
+    decode_parser.add_argument('--repeat', default=5, type=int,
+                               help='Runs per decoder; the best is reported')
+    tz_parser = subparsers.add_parser('tz', 
+                                      help='Verify and time tz conversion')
+    tz_parser.add_argument('--year_start', default=1990, type=int,
+                           help='First year checked')
+    tz_parser.add_argument('--year_end', default=2030, type=int,
+                           help='Last year checked (inclusive)')
+    case_parser = subparsers.add_parser('parse-case')
+    case_parser.add_argument('case', choices=sorted(PARSERS))
+    case_parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    if args.bench == 'parse-case':
+        print(json.dumps(run_parse_case(args.case, args.paths, args.tz_name)))
+    elif args.bench == 'parse':
+        for result in bench_parse(args.months, args.tz_name):
+            print(json.dumps(result))
+    elif args.bench == 'sql':
+        batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+        for result in bench_sql(batch_sizes, args.months, args.tz_name):
+            print(json.dumps(result))
+    elif args.bench == 'upsert':
+        for result in bench_upsert(args.months, args.tz_name, args.dest,
+                                   args.batch_size):
+            print(json.dumps(result))
+    elif args.bench == 'suite':
+        suite = bench_suite(args.corpus_dir, args.stations, args.years,
+                            args.workers, args.formats.split(','),
+                            args.dests.split(','))
+        for result in suite['results']:
+            print(json.dumps(result))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(suite, output_file, indent=2)
+        if args.compare:
+            with open(args.compare, 'r') as baseline_file:
+                baseline = json.load(baseline_file)
+            regressions = 0
+            for [name, old_secs, new_secs, ratio, regressed] in \
+                    compare_suite(baseline, suite, args.tolerance):
+                print('%-20s %8.3fs -> %8.3fs  x%.2f%s' % (
+                    name, old_secs, new_secs, ratio,
+                    '  REGRESSION' if regressed else ''))
+                regressions += regressed
+            if regressions:
+                sys.exit(1)
+    elif args.bench == 'scaling':
+        if args.parse_workers:
+            worker_counts = [int(count)
+                             for count in args.parse_workers.split(',')]
+        else:
+            worker_counts = [1]
+            while worker_counts[-1] * 2 <= (os.cpu_count() or 1):
+                worker_counts.append(worker_counts[-1] * 2)
+        for result in bench_scaling(args.corpus_dir, args.stations,
+                                    args.years, args.format, worker_counts,
+                                    args.workers):
+            print(json.dumps(result))
+    elif args.bench == 'http':
+        for result in bench_http(args.months, args.workers):
+            print(json.dumps(result))
+    elif args.bench == 'timeframes':
+        for result in bench_timeframes(args.years, args.tz_name):
+            print(json.dumps(result))
+    elif args.bench == 'formats':
+        for result in bench_formats(args.months, args.tz_name):
+            print(json.dumps(result))
+    elif args.bench == 'decode':
+        for result in bench_decode(args.years, args.repeat):
+            print(json.dumps(result))
+    elif args.bench == 'tz':
+        for result in bench_tz(args.year_start, args.year_end):
+            print(json.dumps(result))
+    elif args.bench == 'models':
+        for result in bench_models(args.months, args.tz_name):
+            print(json.dumps(result))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
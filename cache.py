@@ -0,0 +1,148 @@
+import calendar
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+class CacheMissError(LookupError):
+    """Raised in offline mode when a response is not in the cache."""
+
+class ResponseCache():
+    """
+    Compressed, on-disk cache of bulk data responses keyed on
+    (station_id, year, month, timeframe, format).
+
+    Historical data does not change once a period is over, so responses for
+    closed periods never expire. Periods that ended less than recent_days ago
+    (or have not ended yet) are only reused for ttl seconds, because
+    Environment Canada is still filling them in. Once expired they are
+    revalidated with a conditional request using the ETag/Last-Modified
+    stored beside them, so an unchanged month costs a 304 and no body.
+    """
+    def __init__(self, cache_dir, ttl=86400, recent_days=35, offline=False):
+        """
+        Keyword arguments:
+        cache_dir -- Directory responses are stored under (created if needed).
+        ttl -- Seconds a response for an open or recent period stays fresh
+               (default 86400, one day).
+        recent_days -- Days after a period ends during which it is still
+                       treated as open (default 35).
+        offline -- Never touch the network; a miss raises CacheMissError
+                   (default False).
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.recent_days = recent_days
+        self.offline = offline
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, station_id, year_num, month_num, timeframe, frmt):
+        """Return the hex digest identifying a request."""
+        parts = [str(station_id), str(year_num), str(month_num),
+                 str(timeframe), frmt]
+        return hashlib.sha256('/'.join(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """Return the file a key is stored in, fanned out by prefix."""
+        return os.path.join(self.cache_dir, key[:2], key + '.gz')
+
+    def is_closed(self, year_num, month_num, timeframe, now=None):
+        """
+        True if the requested period ended more than recent_days ago. A
+        timeframe=1 (hourly) request covers one month, timeframe=2 (daily) a
+        whole year and timeframe=3 (monthly) the station's entire history,
+        which is never closed.
+        """
+        if timeframe == 1:
+            last_day = calendar.monthrange(year_num, month_num)[1]
+            period_end = datetime(year_num, month_num, last_day)
+        elif timeframe == 2:
+            period_end = datetime(year_num, 12, 31)
+        else:
+            return False
+        now = now or datetime.utcnow()
+        return period_end + timedelta(days=self.recent_days + 1) <= now
+
+    def get(self, station_id, year_num, month_num, timeframe, frmt):
+        """
+        Return an open binary file of the cached response, decompressing as
+        it is read, or None if it is missing or has expired.
+        """
+        path = self.path(self.key(station_id, year_num, month_num, timeframe,
+                                  frmt))
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        if (not self.offline and
+                not self.is_closed(year_num, month_num, timeframe) and
+                time.time() - mtime > self.ttl):
+            return None
+        return gzip.open(path, 'rb')
+
+    def validators(self, station_id, year_num, month_num, timeframe, frmt):
+        """
+        Return the conditional request headers (If-None-Match and/or
+        If-Modified-Since) for a cached response, expired or not, or None if
+        nothing usable is stored.
+        """
+        path = self.path(self.key(station_id, year_num, month_num, timeframe,
+                                  frmt))
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path[:-len('.gz')] + '.json', 'r') as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        headers = dict()
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers or None
+
+    def refresh(self, station_id, year_num, month_num, timeframe, frmt):
+        """
+        Mark a cached response as fresh again after the host confirmed it is
+        unchanged (HTTP 304), and return it as get() would.
+        """
+        path = self.path(self.key(station_id, year_num, month_num, timeframe,
+                                  frmt))
+        os.utime(path)
+        return gzip.open(path, 'rb')
+
+    def put(self, station_id, year_num, month_num, timeframe, frmt, payload,
+            etag=None, last_modified=None):
+        """
+        Compress and store a response body (bytes), along with the
+        response's ETag and Last-Modified headers when it had them.
+        """
+        path = self.path(self.key(station_id, year_num, month_num, timeframe,
+                                  frmt))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see partial data
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                with gzip.GzipFile(fileobj=tmp_file, mode='wb') as gz_file:
+                    gz_file.write(payload)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        meta_path = path[:-len('.gz')] + '.json'
+        if not (etag or last_modified):
+            if os.path.exists(meta_path):
+                os.unlink(meta_path)
+            return
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump({'etag': etag, 'last_modified': last_modified}, 
+                      tmp_file)
+        os.replace(tmp_path, meta_path)
@@ -0,0 +1,44 @@
+import json
+import os
+import tempfile
+
+def read_checkpoint(filename, station_id):
+    """
+    Read the last written month for a station from a JSON checkpoint file.
+
+    Return:
+    A dict with 'year', 'month', 'offset' (the size in bytes of the
+    observations file once that month was written) and 'latest' (the last
+    obs_datetime_std written, as 'YYYY-MM-DD HH:MM:SS', or None), or None if
+    the file or station entry does not exist. Checkpoints written before
+    'latest' was recorded lack it and mark the month as complete.
+    """
+    try:
+        with open(filename, 'r') as checkpoint_file:
+            checkpoints = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+    return checkpoints.get(str(station_id))
+
+def write_checkpoint(filename, station_id, year_num, month_num, offset,
+                     latest=None):
+    """
+    Record that every observation up to latest, in year_num/month_num, has
+    been written for a station. The month may still be filling (eg. the
+    current one), so a later run starts from it again. Other stations in the
+    same file are kept. The file is replaced atomically so a crash never
+    leaves it half written.
+    """
+    try:
+        with open(filename, 'r') as checkpoint_file:
+            checkpoints = json.load(checkpoint_file)
+    except FileNotFoundError:
+        checkpoints = dict()
+    checkpoints[str(station_id)] = {'year': year_num, 'month': month_num,
+                                    'offset': offset, 'latest': latest}
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    (fd, tmp_path) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(checkpoints, tmp_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, filename)
@@ -0,0 +1,257 @@
+import http.client
+import io
+import random
+import threading
+import time
+import zlib
+from urllib import error, parse
+
+# Statuses worth retrying; anything else >= 400 is raised straight away
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Statuses followed to their Location, like urlopen does
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+class HTTPSession():
+    """
+    Keep-alive HTTP/1.1 client for the bulk data host, shared by every
+    fetch thread. Idle connections are pooled per (scheme, host), so a long
+    import reuses a handful of TCP (and TLS) connections instead of opening
+    one per month. Responses are requested gzip-compressed and decompressed
+    as they are read. Redirects are followed, including to another host or
+    scheme (eg. http to https). Connection errors, timeouts and 5xx
+    responses are retried with jittered exponential backoff. A body that
+    ends early raises http.client.IncompleteRead instead of passing for a
+    complete one.
+    """
+    def __init__(self, timeout=30, retries=4, backoff=0.5, max_backoff=30,
+                 max_redirects=5):
+        """
+        Keyword arguments:
+        timeout -- Seconds to wait for a connection or a read (default 30).
+        retries -- Retries after the first attempt of a request (default 4).
+        backoff -- Base delay in seconds; attempt n sleeps a random time
+                   between 0 and backoff * 2**n (default 0.5).
+        max_backoff -- Cap on a single delay in seconds (default 30).
+        max_redirects -- Redirects followed for one request (default 5).
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        self.idle = dict()
+        self.stats = {'requests': 0, 'connections': 0, 'retries': 0,
+                      'redirects': 0, 'not_modified': 0, 'bytes': 0}
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def _connection(self, host_key):
+        """Return [connection, reused] for a host, reusing an idle one."""
+        with self.lock:
+            idle = self.idle.get(host_key)
+            if idle:
+                return [idle.pop(), True]
+            self.stats['connections'] += 1
+        (scheme, netloc) = host_key
+        if scheme == 'https':
+            return [http.client.HTTPSConnection(netloc,
+                                                timeout=self.timeout), False]
+        return [http.client.HTTPConnection(netloc, timeout=self.timeout),
+                False]
+
+    def _release(self, host_key, cnx, response):
+        """Return a connection to the pool once its response is consumed."""
+        if response.will_close or not response.isclosed():
+            cnx.close()
+            return
+        with self.lock:
+            self.idle.setdefault(host_key, []).append(cnx)
+
+    def _sleep(self, attempt, retry_after=None):
+        self._count('retries')
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * (2 ** attempt)))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        time.sleep(delay)
+
+    def get(self, url, headers=None, preload=False):
+        """
+        Send a GET request.
+
+        Keyword arguments:
+        url -- Absolute http(s) URL.
+        headers -- Optional dict of extra request headers (eg.
+                   If-None-Match for a conditional request).
+        preload -- Read the whole body before returning, so that a
+                   connection dropped mid-body is retried like one dropped
+                   before the headers (default False, stream the body).
+
+        Return:
+        A SessionResponse for the URL redirects ended at. Its status is
+        200, or 304 (with an empty body) when a conditional request found
+        the resource unchanged.
+
+        Raises urllib.error.HTTPError for a 4xx response, a 5xx one that
+        outlasted the retries, a redirect without a Location or past
+        max_redirects, and any other status than 200 or 304, so callers
+        never see (or cache) such a body. The last connection error (or
+        http.client.IncompleteRead for a truncated body) is raised if every
+        attempt failed.
+        """
+        request_headers = {'Accept-Encoding': 'gzip',
+                           'User-Agent': 'envcan-import-history'}
+        if headers:
+            request_headers.update(headers)
+
+        attempt = 0
+        redirects = 0
+        while True:
+            parts = parse.urlsplit(url)
+            host_key = (parts.scheme, parts.netloc)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+            [cnx, reused] = self._connection(host_key)
+            try:
+                self._count('requests')
+                cnx.request('GET', target, headers=request_headers)
+                response = cnx.getresponse()
+            except (OSError, http.client.HTTPException):
+                cnx.close()
+                if reused:
+                    # The host closed an idle keep-alive connection; try
+                    # again on a fresh one without counting an attempt
+                    continue
+                if attempt >= self.retries:
+                    raise
+                self._sleep(attempt)
+                attempt += 1
+                continue
+
+            if response.status in REDIRECT_STATUSES:
+                response.read()
+                self._release(host_key, cnx, response)
+                location = response.getheader('Location')
+                if location is None or redirects >= self.max_redirects:
+                    reason = 'Too many redirects'
+                    if location is None:
+                        reason = 'Redirect without a Location'
+                    raise error.HTTPError(url, response.status, reason,
+                                          response.headers, io.BytesIO(b''))
+                self._count('redirects')
+                redirects += 1
+                # The next host may be another pool entry (eg. https)
+                url = parse.urljoin(url, location)
+                continue
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                response.read()
+                self._release(host_key, cnx, response)
+                self._sleep(attempt, response.getheader('Retry-After'))
+                attempt += 1
+                continue
+            if response.status not in (200, 304):
+                body = response.read()
+                self._release(host_key, cnx, response)
+                raise error.HTTPError(url, response.status, response.reason,
+                                      response.headers, io.BytesIO(body))
+            if response.status == 304:
+                self._count('not_modified')
+            stream = _ResponseStream(self, host_key, cnx, response)
+            if not preload:
+                return SessionResponse(stream, response.status,
+                                       response.headers, url)
+            try:
+                with stream:
+                    body = stream.read()
+            except (OSError, http.client.HTTPException):
+                if attempt >= self.retries:
+                    raise
+                self._sleep(attempt)
+                attempt += 1
+                continue
+            return SessionResponse(io.BytesIO(body), response.status,
+                                   response.headers, url)
+
+class _ResponseStream(io.RawIOBase):
+    """
+    Raw stream over an http.client response that decompresses gzip bodies
+    incrementally and hands the connection back to the session on close.
+    http.client.IncompleteRead is raised if the connection ends before
+    Content-Length bytes arrived or before the end of the gzip stream;
+    http.client itself reports neither for a partial read.
+    """
+    def __init__(self, session, host_key, cnx, response):
+        self.session = session
+        self.host_key = host_key
+        self.cnx = cnx
+        self.response = response
+        self.decompressor = None
+        if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.expected = response.length
+        self.received = 0
+        self.pending = b''
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.pending and not self.eof:
+            chunk = self.response.read(65536)
+            self.session._count('bytes', len(chunk))
+            self.received += len(chunk)
+            if not chunk:
+                if self.expected is not None and self.received < self.expected:
+                    self._abandon()
+                    raise http.client.IncompleteRead(
+                        b'', self.expected - self.received)
+                if self.decompressor is not None:
+                    self.pending = self.decompressor.flush()
+                    if self.received and not self.decompressor.eof:
+                        self._abandon()
+                        raise http.client.IncompleteRead(b'')
+                self.eof = True
+            elif self.decompressor is not None:
+                self.pending = self.decompressor.decompress(chunk)
+            else:
+                self.pending = chunk
+        size = min(len(buf), len(self.pending))
+        buf[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def _abandon(self):
+        """Close a connection whose body was cut off instead of pooling it."""
+        if self.cnx is not None:
+            self.cnx.close()
+            self.cnx = None
+
+    def close(self):
+        if self.cnx is not None:
+            if not self.response.isclosed() and self.response.length == 0:
+                # Bodiless responses (eg. 304) are complete once read
+                self.response.read()
+            self.session._release(self.host_key, self.cnx, self.response)
+            self.cnx = None
+        super().close()
+
+class SessionResponse(io.BufferedReader):
+    """
+    Buffered, decompressed response body returned by HTTPSession.get, with
+    the response's status and headers. Closing it (or leaving a with block)
+    returns a fully read connection to the session's pool.
+    """
+    def __init__(self, raw, status, headers, url):
+        super().__init__(raw, buffer_size=65536)
+        self.status = status
+        self.headers = headers
+        self.url = url
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
@@ -1,14 +1,35 @@
 import argparse
+import collections
+import concurrent.futures
 import csv
-from datetime import datetime, timezone
-from urllib import request
+import functools
+import io
+import itertools
+import multiprocessing
+import operator
+import os
+import threading
+import time
+from datetime import date, datetime, timezone
+from urllib import parse
 from xml.etree import ElementTree
 
-import mysql.connector 
 import pytz
 
-from config import mysql_config
-from models import Observation, Station
+from cache import CacheMissError, ResponseCache
+from checkpoint import read_checkpoint, write_checkpoint
+from http_session import HTTPSession
+from metrics import METRICS, profiled
+from models import (OBSERVATION_ATTRIBUTES, TIMEFRAME_MODELS, Observation, 
+                    ObservationBatch, Station, bulkdata_csv_decoder, 
+                    iter_observations, stationdata_decoder)
+from storage import DATABASE_DESTS, MySQLWriter, WRITER_DESTS, open_writer
+from tzconvert import localize_observations
+
+BULKDATA_URL = 'http://climate.weather.gc.ca/climateData/bulkdata_e.html'
+
+# Keep-alive connections shared by every fetch (see --timeout/--retries)
+HTTP_SESSION = HTTPSession()
 
 def canadian_timezones():
     """
@@ -44,33 +65,45 @@ def csv_write_station(station, filename='station.csv'):
                        station.climate_identifier, station.local_tz_str])
     
     
-def csv_write_observations(observations, filename='observations.csv'):
-    """Write model.Observation list to CSV file."""
+def csv_write_observations(observations, filename='observations.csv', 
+                           append=False):
+    """
+    Write model.Observation objects to CSV file. Observations may be any 
+    iterable (eg. a generator) and may contain models.ObservationBatch 
+    blocks; each row is written as it arrives.
+    
+    When append is True rows are added to the end of an existing file and 
+    the header is only written if the file is empty.
+    """
+    with open(filename, 'a' if append else 'w', newline='') as csvfile:
+        csvw = csv.writer(csvfile)
+        if csvfile.tell() == 0:
+            csvw.writerow(OBSERVATION_ATTRIBUTES)
+        csv_row = operator.attrgetter(*OBSERVATION_ATTRIBUTES)
+        for obs in iter_observations(observations):
+            csvw.writerow(csv_row(obs))
+
+def csv_write_summaries(summaries, timeframe, filename):
+    """
+    Write daily (timeframe=2) or monthly (timeframe=3) summaries to a CSV 
+    file, one row per summary as it arrives.
+    """
+    fields = TIMEFRAME_MODELS[timeframe][1]
+    attributes = [field[0] for field in fields]
+    csv_row = operator.attrgetter(*attributes)
     with open(filename, 'w', newline='') as csvfile:
         csvw = csv.writer(csvfile)
-        csvw.writerow(['station_id', 'temp_c', 'dewpoint_temp_c', 
-                       'rel_humidity_pct', 'wind_dir_deg', 'wind_speed_kph', 
-                       'visibility_km', 'station_pressure_kpa', 'humidex',
-                       'wind_chill', 'weather_desc', 'obs_datetime_std', 
-                       'obs_datetime_dst', 'obs_quality'])
-        for obs in observations:
-            csvw.writerow([obs.station_id, obs.temp_c, obs.dewpoint_temp_c, 
-                           obs.rel_humidity_pct, obs.wind_dir_deg, 
-                           obs.wind_speed_kph, obs.visibility_km, 
-                           obs.station_pressure_kpa, obs.humidex, 
-                           obs.wind_chill, obs.weather_desc, 
-                           obs.obs_datetime_std, obs.obs_datetime_dst, 
-                           obs.obs_quality])
+        csvw.writerow(attributes)
+        for summary in summaries:
+            csvw.writerow(csv_row(summary))
 
 def fetch_content(station_id, year_num, month_num, day_num_start,
-                  timeframe=1, frmt='xml'):
+                  timeframe=1, frmt='xml', base_url=BULKDATA_URL,
+                  rate_limiter=None, headers=None, session=None, 
+                  preload=False):
     """
     Fetch weather history data from Environment Canada.
     
-    TODO(r24mille): Allow a user to switch between XML/CSV data for parsing.
-    TODO(r24mille): Allow user to change the timeframe parameter for different 
-                    data resolution (ie. daily, hourly, etc.)
-    
     Keyword arguments:
     station_id -- Integer corresponding to an Environment Canada station ID 
                   (ie. location of weather reading).
@@ -81,126 +114,766 @@ def fetch_content(station_id, year_num, month_num, day_num_start,
     timeframe -- Controls the time span of data that is returned 
                  (default 1=month of hourly observations).
     frmt -- Controls the format that Environment Canada data should be 
-            returned in (default 'xml').
+            returned in, 'xml' or 'csv' (default 'xml').
+    base_url -- Bulk data endpoint, overridable so that a local stand-in 
+                server can be used (default BULKDATA_URL).
+    rate_limiter -- Optional RateLimiter consulted before the request is 
+                    sent (default None, no limiting).
+    headers -- Optional dict of extra request headers, eg. validators for a 
+               conditional request (default None).
+    session -- http_session.HTTPSession to send the request through 
+               (default HTTP_SESSION).
+    preload -- Download the whole body before returning, retrying a 
+               connection that drops mid-body (default False, stream it).
                      
     Return:
-    The request.urlopen response.
+    An http_session.SessionResponse, already decompressed.
     """
-    data_url = ('http://climate.weather.gc.ca/climateData/bulkdata_e.html' + 
+    data_url = (base_url + 
                '?format=' + frmt + 
                '&stationID=' + str(station_id) + 
                '&Year=' + str(year_num) + 
                '&Month=' + str(month_num) + 
                '&Day=' + str(day_num_start) + 
                '&timeframe=' + str(timeframe))
+    if rate_limiter is not None:
+        rate_limiter.wait(parse.urlsplit(base_url).netloc)
+    if session is None:
+        session = HTTP_SESSION
     print('URL: ' + data_url)
-    url_response = request.urlopen(data_url)
+    url_response = session.get(data_url, headers, preload)
     return url_response
 
-def sql_insert_observations(observations, config, batch_size=100):
+def open_content(station_id, year_num, month_num, day_num_start, 
+                 timeframe=1, frmt='xml', base_url=BULKDATA_URL, 
+                 rate_limiter=None, cache=None, session=None):
     """
-    Inserts Observations (ie. stationdata) into a database.
+    Open a bulk data response, consulting a cache.ResponseCache first when 
+    one is given. An expired cache entry is revalidated with a conditional 
+    request, and reused as-is if the host answers 304 Not Modified. 
+    Arguments match fetch_content, plus:
     
-    TODO (r24mille): Decouple this method from the main file
-    TODO (r24mille): Support some other driver other than mysql.connector
+    cache -- Optional cache.ResponseCache (default None, always download).
     
-    Keyword arguments:
-    observation -- A list of models.Observation objects to be inserted into a 
-                   MySQL database
-    config -- A dict of MySQL configuration credentials (see config-example.py)
-    batch_size -- INSERT min(batch_size, len(observations)) rows at a time for 
-                  fairly fast INSERT times (default batch_size=100).
-    """
-    cnx = mysql.connector.connect(**config)
-    cursor = cnx.cursor()
-    
-    # Batch size of query
-    insert_complete = False
-    batch_start_idx = 0
-    batch_size = min(batch_size, len(observations))
-    
-    # Continue batched INSERTs until Observations list has been processed
-    while insert_complete == False:
-        batch_idx_upperbound = (batch_start_idx + batch_size)
-        ins_data = ()
-        ins_obs = ("INSERT INTO envcan_observation (stationID, " + 
-                   "obs_datetime_std, obs_datetime_dst, temp_c, " + 
-                   "dewpoint_temp_c, rel_humidity_pct, wind_dir_deg, " + 
-                   "wind_speed_kph, visibility_km, station_pressure_kpa, " + 
-                   "humidex, wind_chill, weather_desc, quality) VALUES ")
-        for i in range(batch_start_idx, batch_idx_upperbound):
-            obs = observations[i]
-            ins_obs += "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-            ins_data += (obs.station_id,
-                         obs.obs_datetime_std.strftime('%Y-%m-%d %H:%M:%S'),
-                         obs.obs_datetime_dst.strftime('%Y-%m-%d %H:%M:%S'),
-                         obs.temp_c, obs.dewpoint_temp_c,
-                         obs.rel_humidity_pct, obs.wind_dir_deg,
-                         obs.wind_speed_kph, obs.visibility_km,
-                         obs.station_pressure_kpa, obs.humidex, obs.wind_chill,
-                         obs.weather_desc, obs.obs_quality)
-            
-            # If i isn't the last item in batch, add a comma to the VALUES items
-            if i != (batch_idx_upperbound - 1):
-                ins_obs += ", "
+    Return:
+    A readable binary file-like object holding the response body.
+    """
+    # Everything up to a readable body is the fetch stage, including rate 
+    # limiting, downloading the whole body and, with a cache, storing it. 
+    # Downloading here means a body cut off mid-transfer is retried by the 
+    # session and never reaches the cache or the parser.
+    with METRICS.stage('fetch'):
+        if cache is not None:
+            cached = cache.get(station_id, year_num, month_num, timeframe, 
+                               frmt)
+            if cached is not None:
+                METRICS.count('cache_hits')
+                return cached
+            if cache.offline:
+                raise CacheMissError('No cached response for station ' + 
+                                     str(station_id) + ' ' + str(year_num) + 
+                                     '-' + str(month_num) + ' (timeframe=' + 
+                                     str(timeframe) + ', format=' + frmt + 
+                                     ')')
         
-        cursor.execute(ins_obs, ins_data)
+        validators = None
+        if cache is not None:
+            validators = cache.validators(station_id, year_num, month_num, 
+                                          timeframe, frmt)
+        response = fetch_content(station_id=station_id, year_num=year_num, 
+                                 month_num=month_num, 
+                                 day_num_start=day_num_start, 
+                                 timeframe=timeframe, frmt=frmt, 
+                                 base_url=base_url, rate_limiter=rate_limiter, 
+                                 headers=validators, session=session, 
+                                 preload=True)
+        if cache is None:
+            return response
+        with response:
+            if response.status == 304:
+                return cache.refresh(station_id, year_num, month_num, 
+                                     timeframe, frmt)
+            payload = response.read()
+        cache.put(station_id, year_num, month_num, timeframe, frmt, payload, 
+                  etag=response.getheader('ETag'), 
+                  last_modified=response.getheader('Last-Modified'))
+        return io.BytesIO(payload)
+
+def read_content(source):
+    """
+    Read and close a response from open_content, timed as the decode stage.
+    
+    Return:
+    The response body as bytes.
+    """
+    with source, METRICS.stage('decode'):
+        payload = source.read()
+    METRICS.count('bytes', len(payload))
+    return payload
+
+class RateLimiter():
+    """
+    Thread-safe, per-host request spacing. Each host is allowed at most 
+    max_rate requests per second across every thread sharing the limiter.
+    """
+    def __init__(self, max_rate):
+        self.min_interval = 1.0 / max_rate
+        self.lock = threading.Lock()
+        self.next_slot = dict()
+
+    def wait(self, host):
+        """Block until a request to host may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+def month_range(year_start, month_start, year_end, month_end, day_start=1):
+    """
+    Generate the (year, month, day) request tuples between a start and end 
+    month (inclusive), one tuple per month.
+    """
+    y = year_start
+    m = month_start
+    req_date = datetime(y, m, day_start)
+    end_date = datetime(year_end, month_end, day_start)
+    while req_date <= end_date:
+        yield (y, m, day_start)
         
-        # If the upper bound is the last observation, mark INSERTs complete
-        if len(observations) - batch_idx_upperbound == 0:
-            insert_complete = True
-        else:  # Slide batch window
-            batch_size = min(batch_size,
-                             len(observations) - batch_idx_upperbound)
-            batch_start_idx = batch_idx_upperbound
-    
-    # Make sure data is committed to the database
-    cnx.commit()
-    cursor.close()
-    cnx.close()
+        # Increment year and month to populate date range
+        if m < 12:
+            m += 1
+        else:
+            y += 1
+            m = 1
+        req_date = datetime(y, m, day_start)
+
+def ordered_map(func, items, workers=1, processes=False):
+    """
+    Apply func to each item using a pool of worker threads, yielding results 
+    in the same order as items. At most 2 * workers calls are in flight (or 
+    holding an unconsumed result) at once, so memory stays bounded no matter 
+    how many items there are.
+    
+    With processes set the pool is made of worker processes instead, for 
+    CPU-bound work the GIL would serialise; func must then be a module-level 
+    function and items and results must pickle. Workers are spawned rather 
+    than forked, so they never inherit a lock held by a fetch thread.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    
+    if processes:
+        context = multiprocessing.get_context('spawn')
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, 
+                                                      mp_context=context)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def sql_insert_observations(observations, config, batch_size=100):
+    """
+    Inserts Observations (ie. stationdata) into a database. Convenience 
+    wrapper around storage.MySQLWriter; create one writer and reuse it when 
+    writing more than once.
+    
+    Keyword arguments:
+    observation -- An iterable (eg. a generator) of models.Observation 
+                   objects or models.ObservationBatch blocks to be inserted 
+                   into a MySQL database. It is consumed incrementally, so 
+                   only one batch is held at once.
+    config -- A dict of MySQL configuration credentials (see config-example.py)
+    batch_size -- INSERT batch_size rows at a time for fairly fast INSERT 
+                  times, flushing each batch as soon as it fills 
+                  (default batch_size=100).
+    """
+    writer = MySQLWriter(config, batch_size=batch_size)
+    try:
+        writer.write_observations(observations)
+    finally:
+        writer.close()
+
+def observations_after(observations, after_dt):
+    """
+    Yield the observations whose obs_datetime_std is later than after_dt, a 
+    naive datetime in Local Standard Time (eg. from 
+    storage.StorageWriter.latest_observation).
+    """
+    for obs in iter_observations(observations):
+        if obs.obs_datetime_std.replace(tzinfo=None) > after_dt:
+            yield obs
 
 def sql_insert_station(station, config):
     """
     Checks if a station matching the stationID exists. If no match exists, 
-    then one is inserted.
-    
-    TODO (r24mille): Decouple this method from the main file
-    TODO (r24mille): Support some other driver other than mysql.connector
+    then one is inserted. See storage.MySQLWriter.write_station.
     
     Keyword arguments:
     station -- A models.Station object to be inserted into a MySQL database
     config -- A dict of MySQL configuration credentials (see config-example.py)
     """
-    cnx = mysql.connector.connect(**config)
-    cursor = cnx.cursor()
-
-    # Query envcan_station for matching stationID
-    query_station = ("SELECT * FROM envcan_station " + 
-                     "WHERE stationID = %(station_id)s")
-    cursor.execute(query_station, {'station_id':station.station_id})
-    
-    station_row = cursor.fetchone()
-    # If no station exists matching that stationID, insert one
-    if station_row == None:
-        insert_station = ("INSERT INTO envcan_station (stationID, name, " + 
-                          "province, latitude, longitude, elevation, " + 
-                          "climate_identifier, local_timezone) " + 
-                          "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)")
-        insert_data = (station.station_id, station.name, station.province,
-                    station.latitude, station.longitude, station.elevation,
-                    station.climate_identifier, station.local_tz_str)
-        cursor.execute(insert_station, insert_data)
-    
-    # Make sure data is committed to the database
-    cnx.commit()
-    cursor.close()
-    cnx.close()
+    writer = MySQLWriter(config)
+    try:
+        writer.write_station(station)
+    finally:
+        writer.close()
+
+def iterparse_bulkdata(source):
+    """
+    Stream the stationinformation and stationdata elements of a bulkdata XML 
+    document as each one is fully parsed.
+    
+    Elements are cleared and detached from the document root once the caller 
+    advances past them, so only one element is held in memory at a time 
+    regardless of how many observations the document contains.
+    
+    Keyword arguments:
+    source -- A binary file-like object (eg. the fetch_content response) or 
+              filename to read XML from.
+    """
+    depth = 0
+    root = None
+    for event, elmnt in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elmnt
+            depth += 1
+            continue
+        
+        depth -= 1
+        if depth == 1:
+            if elmnt.tag == 'stationinformation' or elmnt.tag == 'stationdata':
+                yield elmnt
+            # Drop every finished top-level element from the root
+            elmnt.clear()
+            root.clear()
+
+def parse_station(si_elmnt, station_id, local_tz_name):
+    """
+    Build a models.Station from a stationinformation XML element.
+    """
+    station = Station()
+    station.station_id = station_id
+    station.local_tz_str = local_tz_name
+    
+    name_txt = si_elmnt.find('name').text
+    if name_txt and name_txt != ' ':
+        station.name = name_txt
+        
+    province_txt = si_elmnt.find('province').text
+    if province_txt and province_txt != ' ':
+        station.province = province_txt
+    
+    latitude_txt = si_elmnt.find('latitude').text
+    if latitude_txt and latitude_txt != ' ':
+        station.latitude = float(latitude_txt)
+    
+    longitude_txt = si_elmnt.find('longitude').text
+    if longitude_txt and longitude_txt != ' ':
+        station.longitude = float(longitude_txt)
+        
+    elevation_txt = si_elmnt.find('elevation').text
+    if elevation_txt and elevation_txt != ' ':
+        station.elevation = float(elevation_txt)
+        
+    climate_id_txt = si_elmnt.find('climate_identifier').text
+    if climate_id_txt and climate_id_txt != ' ':
+        station.climate_identifier = int(climate_id_txt)
+    return station
+
+def station_timezones(local_tz_name):
+    """
+    Return the [standard, local] tzinfo pair for a station. Environment 
+    Canada reports every observation in Local Standard Time, so the standard 
+    zone is a fixed offset.
+    """
+    station_local_tz = pytz.timezone(local_tz_name)
+    epoch = datetime.utcfromtimestamp(0)
+    offset_delta = station_local_tz.utcoffset(epoch)
+    station_std_tz = timezone(offset_delta)
+    return [station_std_tz, station_local_tz]
+
+# Fills an Observation's measurement fields from models.OBSERVATION_FIELDS
+decode_stationdata = stationdata_decoder()
+
+def parse_stationdata(sd_elmnt, station_id, station_std_tz, 
+                      station_local_tz=None):
+    """
+    Build a models.Observation from a stationdata XML element. When 
+    station_local_tz is None obs_datetime_dst is left unset, for callers that 
+    convert a whole month at once with tzconvert.localize_observations.
+    """
+    observation = Observation()
+    
+    # Get portions of date_time for observation
+    year_txt = sd_elmnt.attrib['year']
+    month_txt = sd_elmnt.attrib['month']
+    day_txt = sd_elmnt.attrib['day']
+    hour_txt = sd_elmnt.attrib['hour']
+    minute_txt = sd_elmnt.attrib['minute']
+    if year_txt and month_txt and day_txt and hour_txt and minute_txt:
+        observation.obs_datetime_std = datetime(year=int(year_txt),
+                                                 month=int(month_txt),
+                                                 day=int(day_txt),
+                                                 hour=int(hour_txt),
+                                                 minute=int(minute_txt),
+                                                 second=0,
+                                                 microsecond=0,
+                                                 tzinfo=station_std_tz)
+        if station_local_tz is not None:
+            observation.obs_datetime_dst = observation.obs_datetime_std.astimezone(station_local_tz)
+
+    if 'quality' in sd_elmnt.attrib:
+        quality_txt = sd_elmnt.attrib['quality']
+    else:
+        quality_txt = None
+    if quality_txt and quality_txt != ' ':
+        observation.obs_quality = quality_txt
+    
+    # Set StationData fields based on child elements' values
+    observation.station_id = station_id
+    decode_stationdata(sd_elmnt, observation)
+    return observation
+
+def parse_month(source, station_id, local_tz_name, station=None, 
+                columnar=False):
+    """
+    Stream-parse one month of bulkdata XML.
+    
+    Keyword arguments:
+    source -- A binary file-like object holding the XML document.
+    station_id -- Integer corresponding to an Environment Canada station ID.
+    local_tz_name -- String representation of local timezone name.
+    station -- A models.Station already parsed from an earlier month, or None 
+               to parse one from this document (default None).
+    columnar -- Collect the month into a models.ObservationBatch rather than 
+                a list (default False).
+    
+    Return:
+    Two-item vector [station, observations] with the month's hourly 
+    model.Observation objects in document order, either as a list or as a 
+    models.ObservationBatch.
+    """
+    [station_std_tz, station_local_tz] = station_timezones(local_tz_name)
+    observations = list()
+    for elmnt in iterparse_bulkdata(source):
+        if elmnt.tag == 'stationdata':
+            observations.append(parse_stationdata(elmnt, station_id, 
+                                                  station_std_tz))
+        elif station is None:
+            station = parse_station(elmnt, station_id, local_tz_name)
+    
+    return [station, finish_month(observations, station_id, local_tz_name, 
+                                  columnar)]
+
+def finish_month(observations, station_id, local_tz_name, columnar=False):
+    """
+    Fill obs_datetime_dst for a parsed month and, if columnar is set, pack 
+    it into a models.ObservationBatch.
+    """
+    with METRICS.stage('convert'):
+        # Convert the month's standard times to local time in a single pass
+        localize_observations(observations, local_tz_name)
+    
+    if columnar:
+        batch = ObservationBatch(station_id)
+        for observation in observations:
+            batch.append(observation)
+        observations = batch
+    return observations
+
+# Station header rows of a bulkdata CSV document, as (heading, 
+# models.Station attribute, converter)
+CSV_STATION_FIELDS = [('Station Name', 'name', str), 
+                      ('Province', 'province', str), 
+                      ('Latitude', 'latitude', float), 
+                      ('Longitude', 'longitude', float), 
+                      ('Elevation', 'elevation', float), 
+                      ('Climate Identifier', 'climate_identifier', int)]
+
+def parse_station_csv(header, station_id, local_tz_name):
+    """
+    Build a models.Station from the header block of a bulkdata CSV 
+    document, given as a dict of heading to value.
+    """
+    station = Station()
+    station.station_id = station_id
+    station.local_tz_str = local_tz_name
+    for (heading, attribute, converter) in CSV_STATION_FIELDS:
+        txt = header.get(heading)
+        if txt and txt != ' ':
+            setattr(station, attribute, converter(txt))
+    return station
+
+def read_csv_header(reader):
+    """
+    Consume the station header block of a bulkdata CSV document from a 
+    csv.reader, up to and including the Date/Time column heading row.
+    
+    Return:
+    Two-item vector [header, headings]: a dict of the "heading","value" 
+    rows, and the list of column headings (None if the document has no 
+    data rows).
+    """
+    header = dict()
+    for row in reader:
+        if row and row[0].startswith('Date/Time'):
+            return [header, row]
+        if len(row) >= 2:
+            header[row[0]] = row[1]
+    return [header, None]
+
+@functools.lru_cache(maxsize=None)
+def csv_decoder(headings, timeframe=1):
+    """
+    Return the shared bulkdata_csv_decoder for a tuple of headings and a 
+    timeframe's field table.
+    """
+    if timeframe == 1:
+        return bulkdata_csv_decoder(list(headings))
+    return bulkdata_csv_decoder(list(headings), TIMEFRAME_MODELS[timeframe][1])
+
+def parse_month_csv(source, station_id, local_tz_name, station=None, 
+                    columnar=False):
+    """
+    Parse one month of bulkdata CSV (format=csv). Arguments and return value 
+    match parse_month, and the results are identical to parsing the same 
+    month's XML.
+    
+    The document opens with "heading","value" rows describing the station 
+    and a legend, followed by a row of column headings starting with 
+    Date/Time and one row per hour. Columns are found by heading.
+    """
+    [station_std_tz, station_local_tz] = station_timezones(local_tz_name)
+    reader = csv.reader(io.TextIOWrapper(source, encoding='utf-8-sig', 
+                                         newline=''))
+    [header, headings] = read_csv_header(reader)
+    if station is None:
+        station = parse_station_csv(header, station_id, local_tz_name)
+    
+    observations = list()
+    if headings is None:
+        return [station, finish_month(observations, station_id, 
+                                      local_tz_name, columnar)]
+    
+    decode = csv_decoder(tuple(headings))
+    year_idx = headings.index('Year')
+    month_idx = headings.index('Month')
+    day_idx = headings.index('Day')
+    if 'Time' in headings:
+        time_idx = headings.index('Time')
+    else:
+        time_idx = headings.index('Time (LST)')
+    quality_idx = None
+    if 'Data Quality' in headings:
+        quality_idx = headings.index('Data Quality')
+    
+    for row in reader:
+        if not row:
+            continue
+        observation = Observation()
+        time_txt = row[time_idx]
+        observation.obs_datetime_std = datetime(year=int(row[year_idx]), 
+                                                month=int(row[month_idx]), 
+                                                day=int(row[day_idx]), 
+                                                hour=int(time_txt[:2]), 
+                                                minute=int(time_txt[3:5]), 
+                                                tzinfo=station_std_tz)
+        if quality_idx is not None and row[quality_idx]:
+            observation.obs_quality = row[quality_idx]
+        observation.station_id = station_id
+        decode(row, observation)
+        observations.append(observation)
+    return [station, finish_month(observations, station_id, local_tz_name, 
+                                  columnar)]
+
+# Month parser for each bulkdata format
+MONTH_PARSERS = {'xml': parse_month, 'csv': parse_month_csv}
+
+def parse_month_payload(task):
+    """
+    Parse one downloaded month into a models.ObservationBatch. Runs in a 
+    parse worker process (see iter_hourly's parse_workers), so it takes and 
+    returns only picklable values; a batch pickles as a few flat arrays 
+    rather than one object per hour.
+    
+    Keyword arguments:
+    task -- (source_format, payload, station_id, local_tz_name) where 
+            payload is the month's document as bytes.
+    
+    Return:
+    Three-item vector [station, batch, stages] where stages maps the parse 
+    and convert stages to the seconds they took in the worker.
+    """
+    (source_format, payload, station_id, local_tz_name) = task
+    # Each task is timed on its own; the parent process records the result
+    METRICS.reset()
+    with METRICS.stage('parse'):
+        [station, batch] = MONTH_PARSERS[source_format](io.BytesIO(payload), 
+                                                        station_id, 
+                                                        local_tz_name, 
+                                                        columnar=True)
+    return [station, batch, METRICS.stage_totals()]
+
+# --timeframe names of the bulkdata timeframe parameter
+TIMEFRAME_NAMES = {1: 'hourly', 2: 'daily', 3: 'monthly'}
+
+@functools.lru_cache(maxsize=None)
+def summary_decoder(timeframe):
+    """Return the shared stationdata_decoder for a summary timeframe."""
+    return stationdata_decoder(TIMEFRAME_MODELS[timeframe][1])
+
+def parse_summaries(source, station_id, local_tz_name, timeframe, 
+                    station=None, source_format='xml'):
+    """
+    Parse one timeframe=2 (daily, a year per document) or timeframe=3 
+    (monthly, the station's whole history) bulkdata document.
+    
+    Keyword arguments:
+    source -- A binary file-like object holding the document.
+    station_id -- Integer corresponding to an Environment Canada station ID.
+    local_tz_name -- String representation of local timezone name.
+    timeframe -- 2 for models.DailyObservation or 3 for 
+                 models.MonthlyObservation rows.
+    station -- A models.Station already parsed from an earlier document, or 
+               None to parse one from this document (default None).
+    source_format -- 'xml' or 'csv' (default 'xml').
+    
+    Return:
+    Two-item vector [station, summaries] with the rows in document order.
+    """
+    model = TIMEFRAME_MODELS[timeframe][0]
+    summaries = list()
+    if source_format == 'xml':
+        decode = summary_decoder(timeframe)
+        for elmnt in iterparse_bulkdata(source):
+            if elmnt.tag != 'stationdata':
+                if station is None:
+                    station = parse_station(elmnt, station_id, local_tz_name)
+                continue
+            summary = model()
+            summary.station_id = station_id
+            summary.obs_date = date(int(elmnt.attrib['year']), 
+                                    int(elmnt.attrib['month']), 
+                                    int(elmnt.attrib.get('day') or 1))
+            quality_txt = elmnt.attrib.get('quality')
+            if quality_txt and quality_txt != ' ':
+                summary.obs_quality = quality_txt
+            decode(elmnt, summary)
+            summaries.append(summary)
+        return [station, summaries]
+    
+    reader = csv.reader(io.TextIOWrapper(source, encoding='utf-8-sig', 
+                                         newline=''))
+    [header, headings] = read_csv_header(reader)
+    if station is None:
+        station = parse_station_csv(header, station_id, local_tz_name)
+    if headings is None:
+        return [station, summaries]
+    
+    decode = csv_decoder(tuple(headings), timeframe)
+    year_idx = headings.index('Year')
+    month_idx = headings.index('Month')
+    day_idx = None
+    if 'Day' in headings:
+        day_idx = headings.index('Day')
+    quality_idx = None
+    if 'Data Quality' in headings:
+        quality_idx = headings.index('Data Quality')
+    for row in reader:
+        if not row:
+            continue
+        summary = model()
+        summary.station_id = station_id
+        day_num = 1
+        if day_idx is not None:
+            day_num = int(row[day_idx])
+        summary.obs_date = date(int(row[year_idx]), int(row[month_idx]), 
+                                day_num)
+        if quality_idx is not None and row[quality_idx]:
+            summary.obs_quality = row[quality_idx]
+        decode(row, summary)
+        summaries.append(summary)
+    return [station, summaries]
+
+def summary_requests(timeframe, year_start, month_start, year_end, month_end):
+    """
+    Return the (year, month, day) requests needed to cover a range of months 
+    at a summary timeframe: one per year for daily data, which Environment 
+    Canada serves a year at a time, and a single request for monthly data, 
+    which covers the station's whole history.
+    """
+    years = list()
+    for (y, m, d) in month_range(year_start, month_start, year_end, 
+                                 month_end):
+        if y not in years:
+            years.append(y)
+    if timeframe == 3:
+        years = years[:1]
+    return [(y, 1, 1) for y in years]
+
+def iter_summaries(station_id, timeframe, year_start, year_end, month_start, 
+                   month_end, day_start, local_tz_name, workers=1, 
+                   max_rate=None, base_url=BULKDATA_URL, cache=None, 
+                   source_format='xml'):
+    """
+    Lazily fetch daily (timeframe=2) or monthly (timeframe=3) summaries, 
+    yielding [station, summaries] once per document with rows outside the 
+    requested range dropped. Other arguments match range_hourly.
+    """
+    station = None
+    first_date = date(year_start, month_start, day_start)
+    months = set((y, m) for (y, m, d) in month_range(year_start, month_start, 
+                                                     year_end, month_end))
+    
+    rate_limiter = None
+    if max_rate:
+        rate_limiter = RateLimiter(max_rate)
+    
+    def fetch_document(ymd):
+        (y, m, d) = ymd
+        return read_content(open_content(station_id=station_id, year_num=y, 
+                                         month_num=m, day_num_start=d, 
+                                         timeframe=timeframe, 
+                                         frmt=source_format, 
+                                         base_url=base_url, 
+                                         rate_limiter=rate_limiter, 
+                                         cache=cache))
+    
+    requests = summary_requests(timeframe, year_start, month_start, 
+                                year_end, month_end)
+    payloads = ordered_map(fetch_document, requests, workers)
+    for payload in METRICS.timed_next('wait', payloads):
+        with METRICS.stage('parse'):
+            [station, summaries] = parse_summaries(io.BytesIO(payload), 
+                                                   station_id, local_tz_name, 
+                                                   timeframe, station, 
+                                                   source_format)
+        yield [station, [summary for summary in summaries 
+                         if summary.obs_date >= first_date and 
+                         (summary.obs_date.year, 
+                          summary.obs_date.month) in months]]
+
+def range_daily(station_id, year_start, year_end, month_start, month_end, 
+                day_start, local_tz_name, workers=1, max_rate=None, 
+                base_url=BULKDATA_URL, cache=None, source_format='xml'):
+    """
+    Calls Environment Canada endpoint with timeframe=2 and parses one 
+    models.DailyObservation per day of the range. Arguments match 
+    range_hourly; a request is made per year rather than per month.
+    
+    Return:
+    Two-item vector [station, summaries] in chronological order.
+    """
+    station = None
+    summaries = list()
+    for [station, year_summaries] in iter_summaries(
+            station_id, 2, year_start, year_end, month_start, month_end, 
+            day_start, local_tz_name, workers, max_rate, base_url, cache, 
+            source_format):
+        summaries.extend(year_summaries)
+    return [station, summaries]
+
+def range_monthly(station_id, year_start, year_end, month_start, month_end, 
+                  day_start, local_tz_name, workers=1, max_rate=None, 
+                  base_url=BULKDATA_URL, cache=None, source_format='xml'):
+    """
+    Calls Environment Canada endpoint with timeframe=3 and parses one 
+    models.MonthlyObservation per month of the range. Arguments match 
+    range_hourly; a single request covers the whole range.
+    
+    Return:
+    Two-item vector [station, summaries] in chronological order.
+    """
+    station = None
+    summaries = list()
+    for [station, document_summaries] in iter_summaries(
+            station_id, 3, year_start, year_end, month_start, month_end, 
+            day_start, local_tz_name, workers, max_rate, base_url, cache, 
+            source_format):
+        summaries.extend(document_summaries)
+    return [station, summaries]
+
+def iter_hourly(station_id, year_start, year_end, month_start, month_end,
+                day_start, local_tz_name, workers=1, max_rate=None,
+                base_url=BULKDATA_URL, columnar=False, cache=None, 
+                source_format='xml', parse_workers=1):
+    """
+    Lazily calls Environment Canada endpoint, yielding the parsed 
+    observations one month at a time so that a long range is never fully 
+    held in memory. Arguments match range_hourly, plus:
+    
+    columnar -- Yield each month as a compact models.ObservationBatch 
+                instead of a list of models.Observation (default False).
+                Always the case when parse_workers is above 1.
+                         
+    Return:
+    A generator of two-item vectors [station, month_observations] in 
+    chronological order. The same model.Station object is yielded with every 
+    month.
+    """
+    station = None
+    parse_func = MONTH_PARSERS[source_format]
+    
+    rate_limiter = None
+    if max_rate:
+        rate_limiter = RateLimiter(max_rate)
+    
+    def fetch_month(ymd):
+        (y, m, d) = ymd
+        response = open_content(station_id=station_id, year_num=y,
+                                month_num=m, day_num_start=d, timeframe=1, 
+                                frmt=source_format, base_url=base_url, 
+                                rate_limiter=rate_limiter, cache=cache)
+        # Download in the worker so parsing overlaps with fetching, and so 
+        # network time is not counted as parse time
+        return read_content(response)
+    
+    months = month_range(year_start, month_start, year_end, month_end, 
+                         day_start)
+    payloads = ordered_map(fetch_month, months, workers)
+    if parse_workers > 1:
+        # Parse in worker processes; months still arrive in order
+        tasks = ((source_format, payload, station_id, local_tz_name) 
+                 for payload in METRICS.timed_next('wait', payloads))
+        for [month_station, batch, stages] in ordered_map(
+                parse_month_payload, tasks, parse_workers, processes=True):
+            for (stage, seconds) in stages.items():
+                METRICS.observe(stage, seconds)
+            if station is None:
+                station = month_station
+            yield [station, batch]
+        return
+    
+    for payload in METRICS.timed_next('wait', payloads):
+        with METRICS.stage('parse'):
+            # Station is only populated from the first month
+            [station, month_observations] = parse_func(io.BytesIO(payload), 
+                                                       station_id, 
+                                                       local_tz_name, 
+                                                       station, columnar)
+        yield [station, month_observations]
 
 def range_hourly(station_id, year_start, year_end, month_start, month_end,
-                 day_start, local_tz_name):
+                 day_start, local_tz_name, workers=1, max_rate=None,
+                 base_url=BULKDATA_URL, cache=None, source_format='xml', 
+                 parse_workers=1):
     """
-    Calls Environment Canada endpoint and parses the returned XML into 
-    StationData objects.
+    Calls Environment Canada endpoint and parses the returned XML (or CSV) 
+    into StationData objects. See iter_hourly for a variant that does not build 
+    the full list.
         
     Keyword arguments:
     station_id -- Integer corresponding to an Environment Canada station ID 
@@ -221,141 +894,35 @@ def range_hourly(station_id, year_start, year_end, month_start, month_end,
                  though multiple days of forecasted data will be returned.
     local_tz_name -- String representation of local timezone name 
                      (eg. 'America/Toronto').
+    workers -- Number of months fetched concurrently (default 1, sequential).
+    max_rate -- Maximum requests per second sent to the bulk data host, or 
+                None for no limit (default None).
+    base_url -- Bulk data endpoint (default BULKDATA_URL).
+    cache -- Optional cache.ResponseCache consulted before downloading each 
+             month (default None).
+    source_format -- Bulkdata format requested and parsed, 'xml' or 'csv'. 
+                     CSV is smaller on the wire and faster to parse; both 
+                     give identical results (default 'xml').
+    parse_workers -- Number of processes parsing months concurrently; above 
+                     1 each month comes back as a models.ObservationBatch 
+                     (default 1, parse in this process).
                          
     Return:
     Two two-item vector [station, observations] where station is a 
     model.Station object and observations is a list of hourly 
-    model.Observation objects.
+    model.Observation objects in chronological order.
     """
     # Instantiate objects that are returned by this method
     station = None
     observations = list()
     
-    y = year_start
-    m = month_start
-    d = day_start
-    req_date = datetime(y, m, d)
-    end_date = datetime(year_end, month_end, day_start)
-    while req_date <= end_date:
-        xml_response = fetch_content(station_id=station_id, year_num=y,
-                                    month_num=m, day_num_start=d, timeframe=1,
-                                    frmt='xml')
-        xml_string = xml_response.read().decode('utf-8')
-        weather_root = ElementTree.fromstring(xml_string)
-        
-        # Only populate Station once
-        if station == None:
-            station = Station()
-            station.station_id = station_id
-            station.local_tz_str = local_tz_name
-            station_local_tz = pytz.timezone(local_tz_name)
-            epoch = datetime.utcfromtimestamp(0)
-            offset_delta = station_local_tz.utcoffset(epoch)
-            station_std_tz = timezone(offset_delta)
-            for si_elmnt in weather_root.iter('stationinformation'):
-                name_txt = si_elmnt.find('name').text
-                if name_txt and name_txt != ' ':
-                    station.name = name_txt
-                    
-                province_txt = si_elmnt.find('province').text
-                if province_txt and province_txt != ' ':
-                    station.province = province_txt
-                
-                latitude_txt = si_elmnt.find('latitude').text
-                if latitude_txt and latitude_txt != ' ':
-                    station.latitude = float(latitude_txt)
-                
-                longitude_txt = si_elmnt.find('longitude').text
-                if longitude_txt and longitude_txt != ' ':
-                    station.longitude = float(longitude_txt)
-                    
-                elevation_txt = si_elmnt.find('elevation').text
-                if elevation_txt and elevation_txt != ' ':
-                    station.elevation = float(elevation_txt)
-                    
-                climate_id_txt = si_elmnt.find('climate_identifier').text
-                if climate_id_txt and climate_id_txt != ' ':
-                    station.climate_identifier = int(climate_id_txt)
-        
-        # Iterate stationdata XML elements and append Observations to list
-        for sd_elmnt in weather_root.iter('stationdata'):
-            observation = Observation()
-            
-            # Get portions of date_time for observation
-            year_txt = sd_elmnt.attrib['year']
-            month_txt = sd_elmnt.attrib['month']
-            day_txt = sd_elmnt.attrib['day']
-            hour_txt = sd_elmnt.attrib['hour']
-            minute_txt = sd_elmnt.attrib['minute']
-            if year_txt and month_txt and day_txt and hour_txt and minute_txt:
-                observation.obs_datetime_std = datetime(year=int(year_txt),
-                                                         month=int(month_txt),
-                                                         day=int(day_txt),
-                                                         hour=int(hour_txt),
-                                                         minute=int(minute_txt),
-                                                         second=0,
-                                                         microsecond=0,
-                                                         tzinfo=station_std_tz)
-                observation.obs_datetime_dst = observation.obs_datetime_std.astimezone(station_local_tz)
-    
-            if 'quality' in sd_elmnt.attrib:
-                quality_txt = sd_elmnt.attrib['quality']
-            else:
-                quality_txt = None
-            if quality_txt and quality_txt != ' ':
-                observation.obs_quality = quality_txt
-            
-            # Set StationData fields based on child elements' values
-            observation.station_id = station_id
-            
-            temp_txt = sd_elmnt.find('temp').text
-            if temp_txt and temp_txt != ' ':
-                observation.temp_c = float(temp_txt)
-            
-            dptemp_txt = sd_elmnt.find('dptemp').text
-            if dptemp_txt and dptemp_txt != ' ':
-                observation.dewpoint_temp_c = float(dptemp_txt)
-            
-            relhum_txt = sd_elmnt.find('relhum').text
-            if relhum_txt and relhum_txt != ' ':
-                observation.rel_humidity_pct = int(relhum_txt)
-                
-            winddir_txt = sd_elmnt.find('winddir').text
-            if winddir_txt and winddir_txt != ' ':
-                observation.wind_dir_deg = int(winddir_txt) * 10
-                
-            windspd_txt = sd_elmnt.find('windspd').text
-            if windspd_txt and windspd_txt != ' ':
-                observation.wind_speed_kph = int(windspd_txt)
-                
-            visibility_txt = sd_elmnt.find('visibility').text
-            if visibility_txt and visibility_txt != ' ':
-                observation.visibility_km = float(visibility_txt)
-                
-            stnpress_txt = sd_elmnt.find('stnpress').text
-            if stnpress_txt and stnpress_txt != ' ':
-                observation.station_pressure_kpa = float(stnpress_txt)
-                
-            humidex_txt = sd_elmnt.find('humidex').text
-            if humidex_txt and humidex_txt != ' ':
-                observation.humidex = float(humidex_txt)
-                
-            windchill_txt = sd_elmnt.find('windchill').text
-            if windchill_txt and windchill_txt != ' ':
-                observation.wind_chill = int(windchill_txt)
-                
-            observation.weather_desc = sd_elmnt.find('weather').text
-            
-            # Add StationData element to list
-            observations.append(observation)
-    
-        # Increment year and month to populate date range
-        if m < 12:
-            m += 1
-        else:
-            y += 1
-            m = 1
-        req_date = datetime(y, m, d)
+    months = iter_hourly(station_id, year_start, year_end, month_start, 
+                         month_end, day_start, local_tz_name, workers, 
+                         max_rate, base_url, cache=cache, 
+                         source_format=source_format, 
+                         parse_workers=parse_workers)
+    for [station, month_observations] in months:
+        observations.extend(month_observations)
     
     # Return XML elements parsed into a list of StationData objects
     return [station, observations]
@@ -387,36 +954,347 @@ def main():
     parser.add_argument('--day_start', default=1, type=int,
                         help='Starting day for the historical weather range')
     parser.add_argument('--dest', default='csv', type=str, 
-                        choices=['csv', 'sql'],
+                        choices=['csv'] + WRITER_DESTS,
                         help='Destination of the parsed weather information')
+    parser.add_argument('--db_path', default=None, type=str,
+                        help='Database file for sqlite/duckdb, or directory for parquet/arrow')
     parser.add_argument('--batch_size', default=100, type=int,
                         help='If destination is SQL, control the INSERT batch size')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of months to download concurrently')
+    parser.add_argument('--parse_workers', default=1, type=int,
+                        help='Number of processes parsing months (hourly imports)')
+    parser.add_argument('--max_rate', default=None, type=float,
+                        help='Maximum requests per second to the data host')
+    parser.add_argument('--timeout', default=30, type=float,
+                        help='Seconds to wait for the data host to connect or respond')
+    parser.add_argument('--retries', default=4, type=int,
+                        help='Retries, with jittered backoff, for failed requests')
+    parser.add_argument('--source_format', default='xml', type=str,
+                        choices=sorted(MONTH_PARSERS),
+                        help='Bulkdata format to download and parse')
+    parser.add_argument('--timeframe', default='hourly', type=str,
+                        choices=[TIMEFRAME_NAMES[t] for t in [1, 2, 3]],
+                        help='Import hourly observations or daily/monthly summaries')
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='Directory for a compressed cache of responses')
+    parser.add_argument('--cache_ttl', default=86400, type=int,
+                        help='Seconds before cached current/recent months expire')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only read responses from --cache_dir, never the network')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only import months newer than what was already written')
+    parser.add_argument('--checkpoint', default=None, type=str,
+                        help='Checkpoint file for --incremental CSV imports')
+    parser.add_argument('--commit_interval', default=10000, type=int,
+                        help='If destination is SQL, COMMIT after this many rows')
+    parser.add_argument('--load_data', action='store_true',
+                        help='If destination is SQL, bulk load with LOAD DATA LOCAL INFILE')
+    parser.add_argument('--metrics_json', default=None, type=str,
+                        help='Write per-stage timings and counters to this JSON file')
+    parser.add_argument('--metrics_prom', default=None, type=str,
+                        help='Write the same metrics as a Prometheus textfile')
+    parser.add_argument('--profile', default=None, type=str, 
+                        choices=['cprofile', 'tracemalloc'],
+                        help='Profile the import and print the top entries')
+    parser.add_argument('--profile_out', default=None, type=str,
+                        help='Save the raw cProfile stats or tracemalloc snapshot here')
     args = parser.parse_args()
     
     print(args)        
     
-    # Fetch range of hourly weather observations
-    [station, observations] = range_hourly(station_id=args.station_id,
-                                           year_start=args.year_start,
-                                           year_end=args.year_end, 
-                                           month_start=args.month_start,
-                                           month_end=args.month_end, 
-                                           day_start=args.day_start,
-                                           local_tz_name=args.tz_name)
+    HTTP_SESSION.timeout = args.timeout
+    HTTP_SESSION.retries = args.retries
+    
+    cache = None
+    if args.cache_dir:
+        cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl, 
+                              offline=args.offline)
+    elif args.offline:
+        parser.error('--offline requires --cache_dir')
+    
+    timeframe = [t for t in TIMEFRAME_NAMES 
+                 if TIMEFRAME_NAMES[t] == args.timeframe][0]
+    if timeframe != 1 and args.incremental:
+        parser.error('--incremental only applies to hourly imports')
+    if timeframe != 1 and args.dest not in ['csv'] + DATABASE_DESTS:
+        parser.error('--timeframe ' + args.timeframe + ' requires --dest ' + 
+                     'csv or one of ' + ', '.join(DATABASE_DESTS))
+    
+    METRICS.reset()
+    try:
+        with profiled(args.profile, args.profile_out):
+            import_station(args, timeframe, cache)
+    finally:
+        report_metrics(args)
+
+def report_metrics(args):
+    """
+    Print the per-stage timings of an import and export them to the 
+    --metrics_json and --metrics_prom files, if given.
+    """
+    METRICS.set_counters(HTTP_SESSION.stats, prefix='http_')
+    for line in METRICS.summary_lines():
+        print(line)
+    labels = {'station_id': args.station_id, 'timeframe': args.timeframe, 
+              'source_format': args.source_format, 'dest': args.dest}
+    if args.metrics_json:
+        METRICS.write_json(args.metrics_json, labels)
+    if args.metrics_prom:
+        METRICS.write_prometheus(args.metrics_prom, labels)
+
+def import_station(args, timeframe, cache=None):
+    """
+    Run the import described by main's parsed command-line arguments, for 
+    timeframe 1 (hourly), 2 (daily) or 3 (monthly), reading responses 
+    through an optional cache.ResponseCache.
+    """
+    writer = None
+    if args.dest == 'sql':
+        writer = open_writer(args.dest, batch_size=args.batch_size, 
+                             commit_interval=args.commit_interval, 
+                             bulk=args.load_data)
+    elif args.dest in WRITER_DESTS:
+        writer = open_writer(args.dest, db_path=args.db_path, 
+                             batch_size=args.batch_size)
+    
+    if timeframe != 1:
+        # Daily data is fetched a year per request, monthly data in one
+        documents = iter_summaries(station_id=args.station_id, 
+                                   timeframe=timeframe, 
+                                   year_start=args.year_start, 
+                                   year_end=args.year_end, 
+                                   month_start=args.month_start, 
+                                   month_end=args.month_end, 
+                                   day_start=args.day_start, 
+                                   local_tz_name=args.tz_name, 
+                                   workers=args.workers, 
+                                   max_rate=args.max_rate, 
+                                   cache=cache, 
+                                   source_format=args.source_format)
+        try:
+            if write_summaries(documents, args.station_id, timeframe, 
+                               args.dest, batch_size=args.batch_size, 
+                               writer=writer) is None:
+                print('No data in requested range')
+        finally:
+            if writer is not None:
+                writer.close()
+        return
+    
+    obs_filename = str(args.station_id) + 'observations.csv'
+    year_start = args.year_start
+    month_start = args.month_start
+    if args.incremental:
+        [year_start, month_start] = resume_month(args, obs_filename, writer)
+        if [year_start, month_start] > [args.year_end, args.month_end]:
+            print('Station ' + str(args.station_id) + ' is up to date')
+            return
+    
+    # Lazily fetch range of hourly weather observations, month by month
+    months = iter_hourly(station_id=args.station_id,
+                         year_start=year_start,
+                         year_end=args.year_end, 
+                         month_start=month_start,
+                         month_end=args.month_end, 
+                         day_start=args.day_start,
+                         local_tz_name=args.tz_name,
+                         workers=args.workers,
+                         max_rate=args.max_rate,
+                         cache=cache,
+                         source_format=args.source_format,
+                         parse_workers=args.parse_workers)
+    
+    try:
+        if args.incremental:
+            write_incremental(args, months, year_start, month_start, 
+                              obs_filename, writer)
+        elif write_months(months, args.station_id, args.dest, 
+                          batch_size=args.batch_size, writer=writer) is None:
+            print('No months in requested range')
+    finally:
+        if writer is not None:
+            writer.close()
+
+def write_months(months, station_id, dest, batch_size=100, writer=None):
+    """
+    Stream the [station, month_observations] vectors produced by iter_hourly 
+    into a destination.
+    
+    Keyword arguments:
+    months -- Iterator of [station, month_observations] vectors.
+    station_id -- Integer Environment Canada station ID, used to name the CSV 
+                  files.
+    dest -- 'csv' or one of storage.WRITER_DESTS.
+    batch_size -- INSERT batch size for database destinations (default 100).
+    writer -- storage.StorageWriter to reuse for a database destination, or 
+              None to create one with storage.open_writer (default None).
+    
+    Return:
+    The models.Station that was written, or None if months was empty.
+    """
+    months = METRICS.timed_consumer('write', months)
+    
+    # The first month supplies the Station, which is written before any of 
+    # the observations stream through to the destination
+    first_month = next(months, None)
+    if first_month is None:
+        return None
+    [station, first_observations] = first_month
+    observations = itertools.chain(first_observations, 
+                                   itertools.chain.from_iterable(
+                                       obs for [stn, obs] in months))
  
     # Write parsed information to appropriate destination
-    if args.dest == 'sql':
-        sql_insert_station(station=station, config=mysql_config())
-        sql_insert_observations(observations=observations, 
-                                config=mysql_config(), 
-                                batch_size=args.batch_size)
-    elif args.dest == 'csv':
+    if dest == 'csv':
         csv_write_station(station=station, 
-                          filename=(str(args.station_id) + 
-                                    'station.csv'))
+                          filename=(str(station_id) + 'station.csv'))
         csv_write_observations(observations=observations, 
-                               filename=(str(args.station_id) + 
+                               filename=(str(station_id) + 
                                          'observations.csv'))
+    elif writer is None:
+        writer = open_writer(dest, batch_size=batch_size)
+        try:
+            writer.write_station(station)
+            writer.write_observations(observations)
+        finally:
+            writer.close()
+    else:
+        writer.write_station(station)
+        writer.write_observations(observations)
+    return station
+
+def write_summaries(documents, station_id, timeframe, dest, batch_size=100, 
+                    writer=None):
+    """
+    Stream the [station, summaries] vectors produced by iter_summaries into 
+    a destination, like write_months. CSV output goes to <station_id>daily.csv 
+    or <station_id>monthly.csv.
+    
+    Return:
+    The models.Station that was written, or None if documents was empty.
+    """
+    documents = METRICS.timed_consumer('write', documents)
+    first_document = next(documents, None)
+    if first_document is None:
+        return None
+    [station, first_summaries] = first_document
+    summaries = itertools.chain(first_summaries, 
+                                itertools.chain.from_iterable(
+                                    rows for [stn, rows] in documents))
+    
+    if dest == 'csv':
+        csv_write_station(station=station, 
+                          filename=(str(station_id) + 'station.csv'))
+        csv_write_summaries(summaries, timeframe, 
+                            str(station_id) + TIMEFRAME_NAMES[timeframe] + 
+                            '.csv')
+    elif writer is None:
+        writer = open_writer(dest, batch_size=batch_size)
+        try:
+            writer.write_station(station)
+            writer.write_summaries(timeframe, summaries)
+        finally:
+            writer.close()
+    else:
+        writer.write_station(station)
+        writer.write_summaries(timeframe, summaries)
+    return station
+
+def checkpoint_filename(args):
+    """Checkpoint file used by --incremental CSV imports."""
+    return args.checkpoint or (str(args.station_id) + 'checkpoint.json')
+
+def resume_month(args, obs_filename, writer=None):
+    """
+    Work out the first month an --incremental import still needs.
+    
+    For a database the newest stored obs_datetime_std is the high-water mark 
+    and its month is fetched again, since it may only be partly imported. For 
+    CSV the checkpoint names the last written month and its high-water mark, 
+    and that month is fetched again for the same reason. The observations 
+    file is truncated back to its size at that point to discard any rows 
+    from a month that was interrupted part way.
+    
+    Return:
+    Two-item vector [year, month] of the first month to fetch.
+    """
+    start = [args.year_start, args.month_start]
+    if args.dest != 'csv':
+        latest = writer.latest_observation(args.station_id)
+        if latest is None:
+            return start
+        return max(start, [latest.year, latest.month])
+    
+    checkpoint = read_checkpoint(checkpoint_filename(args), args.station_id)
+    if checkpoint is None:
+        # Nothing was checkpointed, so any existing rows are incomplete
+        if os.path.exists(obs_filename):
+            os.truncate(obs_filename, 0)
+        return start
+    os.truncate(obs_filename, checkpoint['offset'])
+    if 'latest' in checkpoint:
+        resume = [checkpoint['year'], checkpoint['month']]
+    elif checkpoint['month'] < 12:
+        # Older checkpoints only named fully written months
+        resume = [checkpoint['year'], checkpoint['month'] + 1]
+    else:
+        resume = [checkpoint['year'] + 1, 1]
+    return max(start, resume)
+
+def write_incremental(args, months, year_start, month_start, obs_filename, 
+                      writer=None):
+    """
+    Write an --incremental import one month at a time so that a crash can be 
+    resumed at month granularity. Rows at or before the high-water mark (the 
+    newest stored obs_datetime_std, or the checkpointed one for CSV) are 
+    skipped. Database months are committed individually; CSV months are 
+    appended and then checkpointed along with their new high-water mark.
+    """
+    latest = None
+    if args.dest != 'csv':
+        latest = writer.latest_observation(args.station_id)
+    else:
+        checkpoint = read_checkpoint(checkpoint_filename(args), 
+                                     args.station_id)
+        if checkpoint is not None and checkpoint.get('latest'):
+            latest = datetime.strptime(checkpoint['latest'], 
+                                       '%Y-%m-%d %H:%M:%S')
+    if latest is not None:
+        # Filter before timed_consumer so only rows written are counted
+        months = ([station, list(observations_after(month_observations, 
+                                                    latest))]
+                  for [station, month_observations] in months)
+    
+    station_written = False
+    high_water = latest
+    month_iter = month_range(year_start, month_start, args.year_end, 
+                             args.month_end, args.day_start)
+    # months goes first so that zip resumes timed_consumer once it runs 
+    # out, which records the last month's write sample
+    months = METRICS.timed_consumer('write', months)
+    for [[station, month_observations], (y, m, d)] in zip(months, month_iter):
+        if args.dest == 'csv':
+            if not station_written:
+                csv_write_station(station=station, 
+                                  filename=(str(args.station_id) + 
+                                            'station.csv'))
+            month_observations = list(iter_observations(month_observations))
+            csv_write_observations(observations=month_observations, 
+                                   filename=obs_filename, append=True)
+            if month_observations:
+                high_water = max(obs.obs_datetime_std for obs 
+                                 in month_observations).replace(tzinfo=None)
+            high_water_txt = None
+            if high_water is not None:
+                high_water_txt = high_water.strftime('%Y-%m-%d %H:%M:%S')
+            write_checkpoint(checkpoint_filename(args), args.station_id, y, m, 
+                             os.path.getsize(obs_filename), high_water_txt)
+        else:
+            if not station_written:
+                writer.write_station(station)
+            writer.write_observations(month_observations)
+        station_written = True
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
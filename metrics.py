@@ -0,0 +1,322 @@
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+# Pipeline stages, in the order a month passes through them:
+#   fetch   -- cache lookup or HTTP request, up to the response headers
+#   decode  -- reading (and gunzipping) the response body
+#   wait    -- the importing thread blocked on a fetch still in flight
+#   parse   -- XML/CSV into models, excluding convert
+#   convert -- standard to local time conversion
+#   write   -- the destination consuming the month's rows
+STAGES = ['fetch', 'decode', 'wait', 'parse', 'convert', 'write']
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram():
+    """
+    Fixed-bucket latency histogram, cumulative like a Prometheus histogram
+    when exported. Quantiles are estimated by interpolating within the
+    bucket that holds them.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Return the estimated q-quantile (0 <= q <= 1), or None if empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (idx, bucket_count) in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = 0.0
+                if idx > 0:
+                    lower = self.buckets[idx - 1]
+                upper = self.max
+                if idx < len(self.buckets):
+                    upper = min(self.buckets[idx], self.max)
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.max
+
+    def summary(self):
+        summary = {'count': self.count, 'seconds': self.sum,
+                   'mean': None, 'p50': self.quantile(0.5),
+                   'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+                   'max': self.max}
+        if self.count:
+            summary['mean'] = self.sum / self.count
+        return summary
+
+class PipelineMetrics():
+    """
+    Thread-safe per-stage timers and counters for an import run.
+
+    Stage times are exclusive: a stage entered while another is open on the
+    same thread (eg. convert inside parse) is subtracted from the outer one,
+    so the stage totals add up to the time actually spent. Each stage
+    records one histogram sample per month (or per summary document).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far and restart the wall clock."""
+        with self.lock:
+            self.histograms = dict((stage, Histogram()) for stage in STAGES)
+            self.counters = dict()
+            self.started = time.time()
+            self.started_monotonic = time.monotonic()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_counters(self, counters, prefix=''):
+        """Copy counters kept elsewhere (eg. HTTPSession.stats) in."""
+        with self.lock:
+            for (name, value) in counters.items():
+                self.counters[prefix + name] = value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one sample of a stage."""
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = list()
+        # Each open stage accumulates the time of the stages nested in it
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.observe(name, elapsed - nested)
+
+    def stage_totals(self):
+        """Return {stage: seconds} for every stage that has samples."""
+        with self.lock:
+            return dict((stage, histogram.sum) for (stage, histogram)
+                        in self.histograms.items() if histogram.count)
+
+    def timed_next(self, name, iterable):
+        """
+        Yield from iterable, timing each next() call as a sample of a stage
+        (eg. 'wait' on an ordered_map of fetches).
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def timed_consumer(self, name, months):
+        """
+        Yield [station, rows] vectors from months, timing how long the
+        consumer holds each one before asking for the next as a sample of a
+        stage (eg. 'write'), and counting the rows.
+        """
+        for month in months:
+            self.count('rows', len(month[1]))
+            start = time.perf_counter()
+            yield month
+            self.observe(name, time.perf_counter() - start)
+
+    def report(self):
+        """
+        Return:
+        A JSON-serialisable dict with the run's start time, wall seconds,
+        rows per second, counters and a summary of each stage's histogram.
+        """
+        with self.lock:
+            wall_secs = time.monotonic() - self.started_monotonic
+            rows = self.counters.get('rows', 0)
+            stages = dict()
+            for (stage, histogram) in self.histograms.items():
+                stages[stage] = histogram.summary()
+                if histogram.sum > 0:
+                    stages[stage]['rows_per_sec'] = rows / histogram.sum
+            report = {'started': self.started, 'wall_seconds': wall_secs,
+                      'rows_per_sec': rows / wall_secs if wall_secs else None,
+                      'counters': dict(self.counters), 'stages': stages}
+        return report
+
+    def summary_lines(self):
+        """Return human-readable lines describing each stage."""
+        report = self.report()
+        lines = ['%-8s %7s %9s %9s %9s %9s' % ('stage', 'count', 'seconds',
+                                               'p50', 'p95', 'max')]
+        for stage in sorted(report['stages'], key=_stage_order):
+            summary = report['stages'][stage]
+            if not summary['count']:
+                continue
+            lines.append('%-8s %7d %9.3f %9.4f %9.4f %9.4f' % (
+                stage, summary['count'], summary['seconds'], summary['p50'],
+                summary['p95'], summary['max']))
+        lines.append('%d rows in %.1fs (%.0f rows/s)' % (
+            report['counters'].get('rows', 0), report['wall_seconds'],
+            report['rows_per_sec'] or 0))
+        return lines
+
+    def write_json(self, filename, labels=None):
+        """Write report(), plus an optional dict of labels, as JSON."""
+        report = self.report()
+        report['labels'] = dict(labels or {})
+        _write_atomic(filename, json.dumps(report, indent=2, sort_keys=True)
+                      + '\n')
+
+    def write_prometheus(self, filename, labels=None, prefix='envcan_import'):
+        """
+        Write a Prometheus textfile (for node_exporter's textfile
+        collector). labels is an optional dict added to every sample, eg.
+        {'station_id': '48569'}. The file is replaced atomically so the
+        collector never reads a partial one.
+        """
+        report = self.report()
+        base_labels = [(name, str(value))
+                       for (name, value) in sorted((labels or {}).items())]
+        lines = list()
+
+        def sample(name, value, extra=()):
+            pairs = base_labels + list(extra)
+            label_txt = ''
+            if pairs:
+                label_txt = '{' + ','.join(
+                    name + '="' + _escape_label(value) + '"'
+                    for (name, value) in pairs) + '}'
+            lines.append(prefix + '_' + name + label_txt + ' ' +
+                         repr(float(value)))
+
+        lines.append('# HELP ' + prefix + '_stage_seconds Time per month '
+                     'spent in each import stage.')
+        lines.append('# TYPE ' + prefix + '_stage_seconds histogram')
+        with self.lock:
+            histograms = sorted(self.histograms.items(),
+                                key=lambda item: _stage_order(item[0]))
+            for (stage, histogram) in histograms:
+                cumulative = 0
+                for (bucket, bucket_count) in zip(histogram.buckets,
+                                                  histogram.counts):
+                    cumulative += bucket_count
+                    sample('stage_seconds_bucket', cumulative,
+                           [('stage', stage), ('le', repr(bucket))])
+                sample('stage_seconds_bucket', histogram.count,
+                       [('stage', stage), ('le', '+Inf')])
+                sample('stage_seconds_sum', histogram.sum,
+                       [('stage', stage)])
+                sample('stage_seconds_count', histogram.count,
+                       [('stage', stage)])
+
+        for name in sorted(report['counters']):
+            lines.append('# TYPE ' + prefix + '_' + name + '_total counter')
+            sample(name + '_total', report['counters'][name])
+        lines.append('# TYPE ' + prefix + '_wall_seconds gauge')
+        sample('wall_seconds', report['wall_seconds'])
+        lines.append('# TYPE ' + prefix + '_rows_per_second gauge')
+        sample('rows_per_second', report['rows_per_sec'] or 0)
+        lines.append('# TYPE ' + prefix + '_last_run_timestamp_seconds gauge')
+        sample('last_run_timestamp_seconds', report['started'])
+        _write_atomic(filename, '\n'.join(lines) + '\n')
+
+def _stage_order(stage):
+    if stage in STAGES:
+        return (STAGES.index(stage), stage)
+    return (len(STAGES), stage)
+
+def _escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def _write_atomic(filename, text):
+    directory = os.path.dirname(os.path.abspath(filename))
+    (fd, tmp_path) = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(text)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# Shared by every stage of an import, across fetch threads
+METRICS = PipelineMetrics()
+
+@contextlib.contextmanager
+def profiled(kind, filename=None, limit=25):
+    """
+    Profile the enclosed block.
+
+    Keyword arguments:
+    kind -- None (no profiling), 'cprofile' for a cProfile of the main
+            thread, or 'tracemalloc' for the largest allocation sites and
+            peak traced memory.
+    filename -- Where to keep the raw result: a pstats file for cprofile or
+                a tracemalloc snapshot (default None, only print).
+    limit -- Number of functions or allocation sites printed (default 25).
+    """
+    if kind is None:
+        yield
+        return
+    if kind == 'cprofile':
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if filename:
+                profiler.dump_stats(filename)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(limit)
+        return
+    if kind == 'tracemalloc':
+        import tracemalloc
+
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            [current, peak] = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if filename:
+                snapshot.dump(filename)
+            print('tracemalloc: current %.1f MiB, peak %.1f MiB' %
+                  (current / 2 ** 20, peak / 2 ** 20))
+            for stat in snapshot.statistics('lineno')[:limit]:
+                print(stat)
+        return
+    raise ValueError('Unknown profiler ' + repr(kind))
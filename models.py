@@ -1,8 +1,20 @@
+from array import array
+from datetime import datetime, timedelta, timezone
+
 class Observation():
     """
     An object structured similar to the stationdata XML element so that data 
     retrieved via the XML data source is easier to manipulate.
+    
+    Attributes are declared in __slots__ because millions of these are 
+    created on long imports and a per-instance __dict__ dominated memory.
     """    
+    __slots__ = ('station_id', 'temp_c', 'dewpoint_temp_c', 
+                 'rel_humidity_pct', 'wind_dir_deg', 'wind_speed_kph', 
+                 'visibility_km', 'station_pressure_kpa', 'humidex', 
+                 'wind_chill', 'weather_desc', 'obs_datetime_std', 
+                 'obs_datetime_dst', 'obs_quality')
+    
     def __init__(self):
         self.station_id = None
         self.temp_c = None
@@ -38,6 +50,440 @@ class Observation():
                 ', obs_quality=' + str(self.obs_quality or 'None') + 
                 ']')
 
+def tens_of_degrees(txt):
+    """Convert a bulkdata winddir (tens of degrees) to degrees."""
+    return int(txt) * 10
+
+def gust_speed(txt):
+    """
+    Convert a maximum gust speed. Gusts below the reporting threshold are 
+    given as eg. '<31' and are stored as the threshold.
+    """
+    return int(txt.lstrip('<'))
+
+# Every Observation attribute, in CSV column order, as (attribute, 
+# envcan_observation column, stationdata child tag, bulkdata CSV heading, 
+# converter). Parsing, the CSV header and the SQL column list are all 
+# derived from this table so they cannot drift apart. A tag or heading of 
+# None marks a value that is not a plain measurement (it is set from the 
+# date/quality fields or by the caller). A converter of None stores the 
+# text unchanged; otherwise blank text leaves the attribute None.
+OBSERVATION_FIELDS = [
+    ('station_id', 'stationID', None, None, None),
+    ('temp_c', 'temp_c', 'temp', 'Temp (\u00b0C)', float),
+    ('dewpoint_temp_c', 'dewpoint_temp_c', 'dptemp', 
+     'Dew Point Temp (\u00b0C)', float),
+    ('rel_humidity_pct', 'rel_humidity_pct', 'relhum', 'Rel Hum (%)', int),
+    ('wind_dir_deg', 'wind_dir_deg', 'winddir', 'Wind Dir (10s deg)', 
+     tens_of_degrees),
+    ('wind_speed_kph', 'wind_speed_kph', 'windspd', 'Wind Spd (km/h)', int),
+    ('visibility_km', 'visibility_km', 'visibility', 'Visibility (km)', 
+     float),
+    ('station_pressure_kpa', 'station_pressure_kpa', 'stnpress', 
+     'Stn Press (kPa)', float),
+    ('humidex', 'humidex', 'humidex', 'Hmdx', float),
+    ('wind_chill', 'wind_chill', 'windchill', 'Wind Chill', int),
+    ('weather_desc', 'weather_desc', 'weather', 'Weather', None),
+    ('obs_datetime_std', 'obs_datetime_std', None, None, None),
+    ('obs_datetime_dst', 'obs_datetime_dst', None, None, None),
+    ('obs_quality', 'quality', None, None, None)]
+
+OBSERVATION_ATTRIBUTES = [field[0] for field in OBSERVATION_FIELDS]
+
+# Converted values remembered per field by the decoders. Readings repeat 
+# heavily (a temperature has a few hundred distinct strings per station), 
+# so most cells cost a dict lookup instead of float()/int(). Every field's 
+# plausible range fits well within this many strings; past it, new text is 
+# converted without being stored, so memory stays bounded on any input.
+MAX_CONVERTED = 4096
+
+def stationdata_decoder(fields=OBSERVATION_FIELDS):
+    """
+    Build a function that fills an Observation from a stationdata element 
+    in a single pass over its children, instead of one find() per field. 
+    The field table is reduced once to a {tag: (attribute, converter, 
+    memo)} dict so each child costs one dict lookup; children with other 
+    tags are ignored. Conversions are memoised up to MAX_CONVERTED values 
+    per field.
+    
+    Keyword arguments:
+    fields -- Field table (default OBSERVATION_FIELDS).
+    
+    Return:
+    A function decode(sd_elmnt, observation).
+    """
+    children = dict()
+    for (attribute, column, tag, heading, converter) in fields:
+        if tag is not None:
+            children[tag] = (attribute, converter, dict())
+    
+    def decode(sd_elmnt, observation):
+        for child in sd_elmnt:
+            try:
+                (attribute, converter, converted) = children[child.tag]
+            except KeyError:
+                continue
+            txt = child.text
+            if converter is None:
+                setattr(observation, attribute, txt)
+                continue
+            try:
+                value = converted[txt]
+            except KeyError:
+                value = None
+                if txt and txt != ' ':
+                    value = converter(txt)
+                if len(converted) < MAX_CONVERTED:
+                    converted[txt] = value
+            setattr(observation, attribute, value)
+    return decode
+
+def bulkdata_csv_decoder(headings, fields=OBSERVATION_FIELDS):
+    """
+    Build a function that fills an Observation from one data row of a 
+    bulkdata CSV document, in the manner of stationdata_decoder. Columns 
+    are located by heading once, so their order in the document does not 
+    matter. Empty cells, including an empty Weather cell, leave the 
+    attribute None just as blank XML elements do.
+    
+    Keyword arguments:
+    headings -- The document's column heading row.
+    fields -- Field table (default OBSERVATION_FIELDS).
+    
+    Return:
+    A function decode(row, observation).
+    """
+    columns = list()
+    for (attribute, column, tag, heading, converter) in fields:
+        if heading is None:
+            continue
+        if heading not in headings:
+            raise ValueError('Bulkdata CSV has no ' + repr(heading) + 
+                             ' column')
+        columns.append((headings.index(heading), attribute, converter, 
+                        dict()))
+    
+    def decode(row, observation):
+        for (idx, attribute, converter, converted) in columns:
+            txt = row[idx]
+            if converter is None:
+                setattr(observation, attribute, txt or None)
+                continue
+            try:
+                value = converted[txt]
+            except KeyError:
+                value = None
+                if txt:
+                    value = converter(txt)
+                if len(converted) < MAX_CONVERTED:
+                    converted[txt] = value
+            setattr(observation, attribute, value)
+    return decode
+
+class DailyObservation():
+    """
+    One day of a station's timeframe=2 (daily) bulkdata, as computed by 
+    Environment Canada from the hourly readings of a Local Standard Time day.
+    """
+    __slots__ = ('station_id', 'obs_date', 'max_temp_c', 'min_temp_c', 
+                 'mean_temp_c', 'heat_deg_days', 'cool_deg_days', 
+                 'total_rain_mm', 'total_snow_cm', 'total_precip_mm', 
+                 'snow_on_grnd_cm', 'max_gust_dir_deg', 'max_gust_speed_kph', 
+                 'obs_quality')
+    
+    def __init__(self):
+        self.station_id = None
+        self.obs_date = None
+        self.max_temp_c = None
+        self.min_temp_c = None
+        self.mean_temp_c = None
+        self.heat_deg_days = None
+        self.cool_deg_days = None
+        self.total_rain_mm = None
+        self.total_snow_cm = None
+        self.total_precip_mm = None
+        self.snow_on_grnd_cm = None
+        self.max_gust_dir_deg = None
+        self.max_gust_speed_kph = None
+        self.obs_quality = None
+    
+    def __str__(self):
+        return ('DailyObservation values [' + 
+                ', '.join(name + '=' + str(getattr(self, name)) 
+                          for name in self.__slots__) + ']')
+
+class MonthlyObservation():
+    """
+    One month of a station's timeframe=3 (monthly) bulkdata. obs_date is the 
+    first day of the month.
+    """
+    __slots__ = ('station_id', 'obs_date', 'mean_max_temp_c', 
+                 'mean_min_temp_c', 'mean_temp_c', 'extr_max_temp_c', 
+                 'extr_min_temp_c', 'total_rain_mm', 'total_snow_cm', 
+                 'total_precip_mm', 'snow_grnd_last_day_cm', 
+                 'max_gust_dir_deg', 'max_gust_speed_kph', 'obs_quality')
+    
+    def __init__(self):
+        self.station_id = None
+        self.obs_date = None
+        self.mean_max_temp_c = None
+        self.mean_min_temp_c = None
+        self.mean_temp_c = None
+        self.extr_max_temp_c = None
+        self.extr_min_temp_c = None
+        self.total_rain_mm = None
+        self.total_snow_cm = None
+        self.total_precip_mm = None
+        self.snow_grnd_last_day_cm = None
+        self.max_gust_dir_deg = None
+        self.max_gust_speed_kph = None
+        self.obs_quality = None
+    
+    def __str__(self):
+        return ('MonthlyObservation values [' + 
+                ', '.join(name + '=' + str(getattr(self, name)) 
+                          for name in self.__slots__) + ']')
+
+# Field tables for DailyObservation and MonthlyObservation, laid out like 
+# OBSERVATION_FIELDS. Column names match envcan_daily and envcan_monthly.
+DAILY_FIELDS = [
+    ('station_id', 'stationID', None, None, None),
+    ('obs_date', 'obs_date', None, None, None),
+    ('max_temp_c', 'max_temp_c', 'maxtemp', 'Max Temp (\u00b0C)', float),
+    ('min_temp_c', 'min_temp_c', 'mintemp', 'Min Temp (\u00b0C)', float),
+    ('mean_temp_c', 'mean_temp_c', 'meantemp', 'Mean Temp (\u00b0C)', 
+     float),
+    ('heat_deg_days', 'heat_deg_days', 'heatdegdays', 
+     'Heat Deg Days (\u00b0C)', float),
+    ('cool_deg_days', 'cool_deg_days', 'cooldegdays', 
+     'Cool Deg Days (\u00b0C)', float),
+    ('total_rain_mm', 'total_rain_mm', 'totalrain', 'Total Rain (mm)', 
+     float),
+    ('total_snow_cm', 'total_snow_cm', 'totalsnow', 'Total Snow (cm)', 
+     float),
+    ('total_precip_mm', 'total_precip_mm', 'totalprecipitation', 
+     'Total Precip (mm)', float),
+    ('snow_on_grnd_cm', 'snow_on_grnd_cm', 'snowonground', 
+     'Snow on Grnd (cm)', int),
+    ('max_gust_dir_deg', 'max_gust_dir_deg', 'dirofmaxgust', 
+     'Dir of Max Gust (10s deg)', tens_of_degrees),
+    ('max_gust_speed_kph', 'max_gust_speed_kph', 'speedofmaxgust', 
+     'Spd of Max Gust (km/h)', gust_speed),
+    ('obs_quality', 'quality', None, None, None)]
+
+MONTHLY_FIELDS = [
+    ('station_id', 'stationID', None, None, None),
+    ('obs_date', 'obs_date', None, None, None),
+    ('mean_max_temp_c', 'mean_max_temp_c', 'meanmaxtemp', 
+     'Mean Max Temp (\u00b0C)', float),
+    ('mean_min_temp_c', 'mean_min_temp_c', 'meanmintemp', 
+     'Mean Min Temp (\u00b0C)', float),
+    ('mean_temp_c', 'mean_temp_c', 'meantemp', 'Mean Temp (\u00b0C)', 
+     float),
+    ('extr_max_temp_c', 'extr_max_temp_c', 'extrmaxtemp', 
+     'Extr Max Temp (\u00b0C)', float),
+    ('extr_min_temp_c', 'extr_min_temp_c', 'extrmintemp', 
+     'Extr Min Temp (\u00b0C)', float),
+    ('total_rain_mm', 'total_rain_mm', 'totalrain', 'Total Rain (mm)', 
+     float),
+    ('total_snow_cm', 'total_snow_cm', 'totalsnow', 'Total Snow (cm)', 
+     float),
+    ('total_precip_mm', 'total_precip_mm', 'totalprecipitation', 
+     'Total Precip (mm)', float),
+    ('snow_grnd_last_day_cm', 'snow_grnd_last_day_cm', 'snowgrndlastday', 
+     'Snow Grnd Last Day (cm)', int),
+    ('max_gust_dir_deg', 'max_gust_dir_deg', 'dirofmaxgust', 
+     "Dir of Max Gust (10's deg)", tens_of_degrees),
+    ('max_gust_speed_kph', 'max_gust_speed_kph', 'speedofmaxgust', 
+     'Spd of Max Gust (km/h)', gust_speed),
+    ('obs_quality', 'quality', None, None, None)]
+
+# Model class and field table for each summary timeframe
+TIMEFRAME_MODELS = {2: (DailyObservation, DAILY_FIELDS), 
+                    3: (MonthlyObservation, MONTHLY_FIELDS)}
+
+class ObservationBatch():
+    """
+    A compact, columnar block of hourly observations for a single station, 
+    typically one month. Measurements are held in typed arrays instead of one 
+    models.Observation per row:
+    
+    obs_epoch -- int64 epoch seconds of obs_datetime_std
+    std_offset_min, dst_offset_min -- int16 UTC offsets (minutes) of the 
+                                      standard and local times
+    temp_c, dewpoint_temp_c, visibility_km, station_pressure_kpa, humidex -- 
+        float32
+    rel_humidity_pct -- uint8
+    wind_dir_deg, wind_speed_kph -- uint16
+    wind_chill -- int16
+    weather_desc, obs_quality -- uint16 codes into a per-batch value list
+    
+    Every nullable column has a bytearray null mask (1 means None). 
+    Iterating a batch yields models.Observation objects, so anything that 
+    consumes observations accepts a batch directly. Floats are restored to 
+    their shortest float32 representation, which is exact for the one or 
+    two decimal places Environment Canada reports. Restored datetimes carry 
+    fixed-offset tzinfo objects, which format identically to pytz's.
+    """
+    FLOAT_COLUMNS = ('temp_c', 'dewpoint_temp_c', 'visibility_km', 
+                     'station_pressure_kpa', 'humidex')
+    INT_COLUMNS = (('rel_humidity_pct', 'B'), ('wind_dir_deg', 'H'), 
+                   ('wind_speed_kph', 'H'), ('wind_chill', 'h'))
+    CODED_COLUMNS = ('weather_desc', 'obs_quality')
+    
+    def __init__(self, station_id):
+        self.station_id = station_id
+        self.length = 0
+        self.columns = {'obs_epoch': array('q'), 
+                        'std_offset_min': array('h'), 
+                        'dst_offset_min': array('h')}
+        self.nulls = {'obs_epoch': bytearray()}
+        for name in self.FLOAT_COLUMNS:
+            self.columns[name] = array('f')
+            self.nulls[name] = bytearray()
+        for (name, typecode) in self.INT_COLUMNS:
+            self.columns[name] = array(typecode)
+            self.nulls[name] = bytearray()
+        self.code_values = dict()
+        self.code_index = dict()
+        for name in self.CODED_COLUMNS:
+            self.columns[name] = array('H')
+            self.code_values[name] = [None]
+            self.code_index[name] = {None: 0}
+    
+    def __len__(self):
+        return self.length
+    
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.observation(i)
+    
+    def __getstate__(self):
+        """Pickle the column buffers only; code_index is rebuilt on load."""
+        state = dict(self.__dict__)
+        del state['code_index']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.code_index = dict()
+        for (name, values) in self.code_values.items():
+            self.code_index[name] = dict((value, code) for (code, value) 
+                                         in enumerate(values))
+    
+    def _append_value(self, name, value):
+        if value is None:
+            self.columns[name].append(0)
+            self.nulls[name].append(1)
+        else:
+            self.columns[name].append(value)
+            self.nulls[name].append(0)
+    
+    def append(self, observation):
+        """Append a models.Observation as the next row of the batch."""
+        obs_std = observation.obs_datetime_std
+        if obs_std is None:
+            self._append_value('obs_epoch', None)
+            self.columns['std_offset_min'].append(0)
+            self.columns['dst_offset_min'].append(0)
+        else:
+            self._append_value('obs_epoch', int(obs_std.timestamp()))
+            self.columns['std_offset_min'].append(
+                int(obs_std.utcoffset().total_seconds()) // 60)
+            self.columns['dst_offset_min'].append(
+                int(observation.obs_datetime_dst.utcoffset().total_seconds()) 
+                // 60)
+        
+        for name in self.FLOAT_COLUMNS:
+            self._append_value(name, getattr(observation, name))
+        for (name, typecode) in self.INT_COLUMNS:
+            self._append_value(name, getattr(observation, name))
+        for name in self.CODED_COLUMNS:
+            value = getattr(observation, name)
+            code = self.code_index[name].get(value)
+            if code is None:
+                code = len(self.code_values[name])
+                self.code_values[name].append(value)
+                self.code_index[name][value] = code
+            self.columns[name].append(code)
+        self.length += 1
+    
+    def observation(self, i):
+        """Rebuild row i of the batch as a models.Observation."""
+        observation = Observation()
+        observation.station_id = self.station_id
+        
+        if not self.nulls['obs_epoch'][i]:
+            epoch = self.columns['obs_epoch'][i]
+            observation.obs_datetime_std = datetime.fromtimestamp(
+                epoch, _fixed_offset(self.columns['std_offset_min'][i]))
+            observation.obs_datetime_dst = datetime.fromtimestamp(
+                epoch, _fixed_offset(self.columns['dst_offset_min'][i]))
+        else:
+            observation.obs_datetime_std = None
+            observation.obs_datetime_dst = None
+        
+        for name in self.FLOAT_COLUMNS:
+            if self.nulls[name][i]:
+                setattr(observation, name, None)
+            else:
+                setattr(observation, name, 
+                        float('%.7g' % self.columns[name][i]))
+        for (name, typecode) in self.INT_COLUMNS:
+            if self.nulls[name][i]:
+                setattr(observation, name, None)
+            else:
+                setattr(observation, name, self.columns[name][i])
+        for name in self.CODED_COLUMNS:
+            setattr(observation, name, 
+                    self.code_values[name][self.columns[name][i]])
+        return observation
+    
+    def nbytes(self):
+        """Approximate number of bytes held by the column buffers."""
+        total = 0
+        for column in self.columns.values():
+            total += column.itemsize * len(column)
+        for mask in self.nulls.values():
+            total += len(mask)
+        return total
+    
+    def as_numpy(self):
+        """
+        Return the columns as NumPy arrays, keyed by column name, with null 
+        masks as boolean arrays keyed by '<column>_null'. NumPy is only 
+        imported when this is called.
+        """
+        import numpy
+        
+        arrays = dict()
+        for (name, column) in self.columns.items():
+            arrays[name] = numpy.frombuffer(column, dtype=column.typecode)
+        for (name, mask) in self.nulls.items():
+            arrays[name + '_null'] = numpy.frombuffer(mask, dtype=numpy.bool_)
+        return arrays
+
+def iter_observations(observations):
+    """
+    Flatten an iterable that may mix models.Observation objects and 
+    models.ObservationBatch blocks into models.Observation objects.
+    """
+    for item in observations:
+        if isinstance(item, ObservationBatch):
+            yield from item
+        else:
+            yield item
+
+_FIXED_OFFSETS = dict()
+
+def _fixed_offset(minutes):
+    """Return a shared timezone object for a UTC offset in minutes."""
+    tz = _FIXED_OFFSETS.get(minutes)
+    if tz is None:
+        tz = timezone(timedelta(minutes=minutes))
+        _FIXED_OFFSETS[minutes] = tz
+    return tz
+
 class Station():
     """
     An object structured similar to the stationinformation XML element so that 
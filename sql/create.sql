@@ -44,7 +44,7 @@ CREATE TABLE `envcan_observation` (
   `quality` CHAR(2) NULL, 
   PRIMARY KEY (`envcan_obs_id`), 
   INDEX `envcan_station_fk_idx` (`stationID` ASC), 
-  INDEX `station_dt_std_idx` (`stationID` ASC, `obs_datetime_std` ASC), 
+  UNIQUE KEY `station_dt_std_uniq` (`stationID` ASC, `obs_datetime_std` ASC), 
   INDEX `station_dt_dst_idx` (`stationID` ASC, `obs_datetime_dst` ASC), 
   CONSTRAINT `envcan_station_fk` 
     FOREIGN KEY (`stationID`) 
@@ -57,4 +57,63 @@ CREATE TABLE `envcan_observation` (
     ON DELETE NO ACTION 
     ON UPDATE NO ACTION) 
 Engine=InnoDB 
-CHARACTER SET utf8;
\ No newline at end of file
+CHARACTER SET utf8;
+-- Create the tables which hold timeframe=2 (daily) and timeframe=3 (monthly) 
+-- stationdata content. Monthly rows are dated on the first of the month.
+CREATE TABLE `envcan_daily` ( 
+  `stationID` MEDIUMINT UNSIGNED NOT NULL, 
+  `obs_date` DATE NOT NULL, 
+  `max_temp_c` FLOAT NULL, 
+  `min_temp_c` FLOAT NULL, 
+  `mean_temp_c` FLOAT NULL, 
+  `heat_deg_days` FLOAT NULL, 
+  `cool_deg_days` FLOAT NULL, 
+  `total_rain_mm` FLOAT NULL, 
+  `total_snow_cm` FLOAT NULL, 
+  `total_precip_mm` FLOAT NULL, 
+  `snow_on_grnd_cm` SMALLINT UNSIGNED NULL, 
+  `max_gust_dir_deg` SMALLINT UNSIGNED NULL, 
+  `max_gust_speed_kph` SMALLINT UNSIGNED NULL, 
+  `quality` CHAR(2) NULL, 
+  PRIMARY KEY (`stationID`, `obs_date`), 
+  CONSTRAINT `envcan_daily_station_fk` 
+    FOREIGN KEY (`stationID`) 
+    REFERENCES `envcan_station` (`stationID`) 
+    ON DELETE NO ACTION 
+    ON UPDATE NO ACTION, 
+  CONSTRAINT `envcan_daily_legend_fk` 
+    FOREIGN KEY (`quality`) 
+    REFERENCES `envcan_legend` (`envcan_quality`) 
+    ON DELETE NO ACTION 
+    ON UPDATE NO ACTION) 
+Engine=InnoDB 
+CHARACTER SET utf8;
+
+CREATE TABLE `envcan_monthly` ( 
+  `stationID` MEDIUMINT UNSIGNED NOT NULL, 
+  `obs_date` DATE NOT NULL, 
+  `mean_max_temp_c` FLOAT NULL, 
+  `mean_min_temp_c` FLOAT NULL, 
+  `mean_temp_c` FLOAT NULL, 
+  `extr_max_temp_c` FLOAT NULL, 
+  `extr_min_temp_c` FLOAT NULL, 
+  `total_rain_mm` FLOAT NULL, 
+  `total_snow_cm` FLOAT NULL, 
+  `total_precip_mm` FLOAT NULL, 
+  `snow_grnd_last_day_cm` SMALLINT UNSIGNED NULL, 
+  `max_gust_dir_deg` SMALLINT UNSIGNED NULL, 
+  `max_gust_speed_kph` SMALLINT UNSIGNED NULL, 
+  `quality` CHAR(2) NULL, 
+  PRIMARY KEY (`stationID`, `obs_date`), 
+  CONSTRAINT `envcan_monthly_station_fk` 
+    FOREIGN KEY (`stationID`) 
+    REFERENCES `envcan_station` (`stationID`) 
+    ON DELETE NO ACTION 
+    ON UPDATE NO ACTION, 
+  CONSTRAINT `envcan_monthly_legend_fk` 
+    FOREIGN KEY (`quality`) 
+    REFERENCES `envcan_legend` (`envcan_quality`) 
+    ON DELETE NO ACTION 
+    ON UPDATE NO ACTION) 
+Engine=InnoDB 
+CHARACTER SET utf8;
@@ -0,0 +1,84 @@
+-- DuckDB version of create.sql, applied automatically by storage.DuckDBWriter.
+-- Every statement is idempotent so it can run against an existing database.
+
+-- Create the table which holds stationinformation data
+CREATE TABLE IF NOT EXISTS envcan_station ( 
+  stationID UINTEGER NOT NULL PRIMARY KEY, 
+  name VARCHAR(100), 
+  province VARCHAR(45), 
+  latitude FLOAT, 
+  longitude FLOAT, 
+  elevation FLOAT, 
+  climate_identifier UINTEGER, 
+  local_timezone VARCHAR(45));
+
+-- Create the table which holds legend content (ie. descriptions for 'quality')
+CREATE TABLE IF NOT EXISTS envcan_legend ( 
+  envcan_quality VARCHAR(2) NOT NULL PRIMARY KEY, 
+  description VARCHAR(100));
+
+INSERT OR IGNORE INTO envcan_legend(envcan_quality, description) 
+VALUES ('M', 'Missing'), ('E', 'Estimated'), ('NA', 'Not Available'), 
+('**', 'Partner data that is not subject to review by the National Climate Archives');
+
+-- Create the table which holds stationdata content (ie. historical weather 
+-- observations).
+CREATE SEQUENCE IF NOT EXISTS envcan_obs_id_seq;
+
+CREATE TABLE IF NOT EXISTS envcan_observation ( 
+  envcan_obs_id UINTEGER PRIMARY KEY DEFAULT nextval('envcan_obs_id_seq'), 
+  stationID UINTEGER NOT NULL, 
+  obs_datetime_std TIMESTAMP, 
+  obs_datetime_dst TIMESTAMP, 
+  temp_c FLOAT, 
+  dewpoint_temp_c FLOAT, 
+  rel_humidity_pct UTINYINT, 
+  wind_dir_deg USMALLINT, 
+  wind_speed_kph USMALLINT, 
+  visibility_km FLOAT, 
+  station_pressure_kpa FLOAT, 
+  humidex FLOAT, 
+  wind_chill SMALLINT, 
+  weather_desc VARCHAR(75), 
+  quality VARCHAR(2));
+
+CREATE UNIQUE INDEX IF NOT EXISTS station_dt_std_uniq 
+  ON envcan_observation (stationID, obs_datetime_std);
+CREATE INDEX IF NOT EXISTS station_dt_dst_idx 
+  ON envcan_observation (stationID, obs_datetime_dst);
+
+-- Create the tables which hold timeframe=2 (daily) and timeframe=3 (monthly) 
+-- stationdata content. Monthly rows are dated on the first of the month.
+CREATE TABLE IF NOT EXISTS envcan_daily ( 
+  stationID UINTEGER NOT NULL, 
+  obs_date DATE NOT NULL, 
+  max_temp_c FLOAT, 
+  min_temp_c FLOAT, 
+  mean_temp_c FLOAT, 
+  heat_deg_days FLOAT, 
+  cool_deg_days FLOAT, 
+  total_rain_mm FLOAT, 
+  total_snow_cm FLOAT, 
+  total_precip_mm FLOAT, 
+  snow_on_grnd_cm USMALLINT, 
+  max_gust_dir_deg USMALLINT, 
+  max_gust_speed_kph USMALLINT, 
+  quality VARCHAR(2), 
+  PRIMARY KEY (stationID, obs_date));
+
+CREATE TABLE IF NOT EXISTS envcan_monthly ( 
+  stationID UINTEGER NOT NULL, 
+  obs_date DATE NOT NULL, 
+  mean_max_temp_c FLOAT, 
+  mean_min_temp_c FLOAT, 
+  mean_temp_c FLOAT, 
+  extr_max_temp_c FLOAT, 
+  extr_min_temp_c FLOAT, 
+  total_rain_mm FLOAT, 
+  total_snow_cm FLOAT, 
+  total_precip_mm FLOAT, 
+  snow_grnd_last_day_cm USMALLINT, 
+  max_gust_dir_deg USMALLINT, 
+  max_gust_speed_kph USMALLINT, 
+  quality VARCHAR(2), 
+  PRIMARY KEY (stationID, obs_date));
@@ -0,0 +1,93 @@
+-- SQLite version of create.sql, applied automatically by storage.SQLiteWriter.
+-- Every statement is idempotent so it can run against an existing database.
+
+-- Create the table which holds stationinformation data
+CREATE TABLE IF NOT EXISTS `envcan_station` ( 
+  `stationID` INTEGER NOT NULL, 
+  `name` VARCHAR(100) NULL, 
+  `province` VARCHAR(45) NULL, 
+  `latitude` REAL NULL, 
+  `longitude` REAL NULL, 
+  `elevation` REAL NULL, 
+  `climate_identifier` INTEGER NULL, 
+  `local_timezone` VARCHAR(45) NULL, 
+  PRIMARY KEY (`stationID`));
+
+-- Create the table which holds legend content (ie. descriptions for 'quality')
+CREATE TABLE IF NOT EXISTS `envcan_legend` ( 
+  `envcan_quality` CHAR(2) NOT NULL, 
+  `description` VARCHAR(100) NULL, 
+  PRIMARY KEY (`envcan_quality`));
+
+INSERT OR IGNORE INTO envcan_legend(envcan_quality, description) 
+VALUES ('M', 'Missing'), ('E', 'Estimated'), ('NA', 'Not Available'), 
+('**', 'Partner data that is not subject to review by the National Climate Archives');
+
+-- Create the table which holds stationdata content (ie. historical weather 
+-- observations). Datetimes are stored as 'YYYY-MM-DD HH:MM:SS' text.
+CREATE TABLE IF NOT EXISTS `envcan_observation` ( 
+  `envcan_obs_id` INTEGER PRIMARY KEY AUTOINCREMENT, 
+  `stationID` INTEGER NOT NULL 
+    REFERENCES `envcan_station` (`stationID`), 
+  `obs_datetime_std` DATETIME NULL, 
+  `obs_datetime_dst` DATETIME NULL, 
+  `temp_c` REAL NULL, 
+  `dewpoint_temp_c` REAL NULL, 
+  `rel_humidity_pct` INTEGER NULL, 
+  `wind_dir_deg` INTEGER NULL, 
+  `wind_speed_kph` INTEGER NULL, 
+  `visibility_km` REAL NULL, 
+  `station_pressure_kpa` REAL NULL, 
+  `humidex` REAL NULL, 
+  `wind_chill` INTEGER NULL, 
+  `weather_desc` VARCHAR(75) NULL, 
+  `quality` CHAR(2) NULL 
+    REFERENCES `envcan_legend` (`envcan_quality`));
+
+CREATE INDEX IF NOT EXISTS `envcan_station_fk_idx` 
+  ON `envcan_observation` (`stationID` ASC);
+CREATE UNIQUE INDEX IF NOT EXISTS `station_dt_std_uniq` 
+  ON `envcan_observation` (`stationID` ASC, `obs_datetime_std` ASC);
+CREATE INDEX IF NOT EXISTS `station_dt_dst_idx` 
+  ON `envcan_observation` (`stationID` ASC, `obs_datetime_dst` ASC);
+
+-- Create the tables which hold timeframe=2 (daily) and timeframe=3 (monthly) 
+-- stationdata content. Dates are stored as 'YYYY-MM-DD' text; monthly rows 
+-- are dated on the first of the month.
+CREATE TABLE IF NOT EXISTS `envcan_daily` ( 
+  `stationID` INTEGER NOT NULL 
+    REFERENCES `envcan_station` (`stationID`), 
+  `obs_date` DATE NOT NULL, 
+  `max_temp_c` REAL NULL, 
+  `min_temp_c` REAL NULL, 
+  `mean_temp_c` REAL NULL, 
+  `heat_deg_days` REAL NULL, 
+  `cool_deg_days` REAL NULL, 
+  `total_rain_mm` REAL NULL, 
+  `total_snow_cm` REAL NULL, 
+  `total_precip_mm` REAL NULL, 
+  `snow_on_grnd_cm` INTEGER NULL, 
+  `max_gust_dir_deg` INTEGER NULL, 
+  `max_gust_speed_kph` INTEGER NULL, 
+  `quality` CHAR(2) NULL 
+    REFERENCES `envcan_legend` (`envcan_quality`), 
+  PRIMARY KEY (`stationID`, `obs_date`));
+
+CREATE TABLE IF NOT EXISTS `envcan_monthly` ( 
+  `stationID` INTEGER NOT NULL 
+    REFERENCES `envcan_station` (`stationID`), 
+  `obs_date` DATE NOT NULL, 
+  `mean_max_temp_c` REAL NULL, 
+  `mean_min_temp_c` REAL NULL, 
+  `mean_temp_c` REAL NULL, 
+  `extr_max_temp_c` REAL NULL, 
+  `extr_min_temp_c` REAL NULL, 
+  `total_rain_mm` REAL NULL, 
+  `total_snow_cm` REAL NULL, 
+  `total_precip_mm` REAL NULL, 
+  `snow_grnd_last_day_cm` INTEGER NULL, 
+  `max_gust_dir_deg` INTEGER NULL, 
+  `max_gust_speed_kph` INTEGER NULL, 
+  `quality` CHAR(2) NULL 
+    REFERENCES `envcan_legend` (`envcan_quality`), 
+  PRIMARY KEY (`stationID`, `obs_date`));
@@ -0,0 +1,23 @@
+-- Add the natural key (stationID, obs_datetime_std) to an envcan_observation 
+-- table created by an earlier create.sql. With it in place the importer's 
+-- INSERT ... ON DUPLICATE KEY UPDATE makes re-importing any range a no-op.
+--
+-- Duplicates left by overlapping imports are removed first, keeping the most 
+-- recently imported (highest envcan_obs_id) copy of each observation. The 
+-- DELETE is driven by the existing station_dt_std_idx index, so it costs one 
+-- pass over that index plus the duplicate rows themselves. Imports running 
+-- while this script does can add new duplicates and make the ALTER fail; 
+-- run it again if that happens.
+
+DELETE older 
+  FROM envcan_observation AS older 
+  JOIN envcan_observation AS newer 
+    ON newer.stationID = older.stationID 
+   AND newer.obs_datetime_std = older.obs_datetime_std 
+   AND newer.envcan_obs_id > older.envcan_obs_id;
+
+-- The unique key replaces the plain index on the same columns
+ALTER TABLE `envcan_observation` 
+  ADD UNIQUE KEY `station_dt_std_uniq` (`stationID` ASC, `obs_datetime_std` ASC), 
+  DROP INDEX `station_dt_std_idx`, 
+  ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,21 @@
+-- DuckDB version of migrate_observation_key.sql, for databases created by an 
+-- earlier create_duckdb.sql. storage.DuckDBWriter refuses to open such a 
+-- database while it still holds duplicate observations.
+
+BEGIN TRANSACTION;
+
+-- Keep the most recently imported (highest envcan_obs_id) copy of each 
+-- observation
+DELETE FROM envcan_observation 
+ WHERE EXISTS (
+   SELECT 1 FROM envcan_observation AS newer 
+    WHERE newer.stationID = envcan_observation.stationID 
+      AND newer.obs_datetime_std = envcan_observation.obs_datetime_std 
+      AND newer.envcan_obs_id > envcan_observation.envcan_obs_id);
+
+COMMIT;
+
+-- The unique index replaces the plain index on the same columns
+DROP INDEX IF EXISTS station_dt_std_idx;
+CREATE UNIQUE INDEX IF NOT EXISTS station_dt_std_uniq 
+  ON envcan_observation (stationID, obs_datetime_std);
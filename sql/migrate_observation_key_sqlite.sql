@@ -0,0 +1,22 @@
+-- SQLite version of migrate_observation_key.sql, for databases created by an 
+-- earlier create_sqlite.sql. storage.SQLiteWriter refuses to open such a 
+-- database while it still holds duplicate observations; apply this with 
+-- eg. sqlite3 envcan.sqlite < sql/migrate_observation_key_sqlite.sql
+
+BEGIN;
+
+-- Keep the most recently imported (highest envcan_obs_id) copy of each 
+-- observation, looked up through the existing station_dt_std_idx index
+DELETE FROM `envcan_observation` 
+ WHERE EXISTS (
+   SELECT 1 FROM `envcan_observation` AS newer 
+    WHERE newer.`stationID` = `envcan_observation`.`stationID` 
+      AND newer.`obs_datetime_std` = `envcan_observation`.`obs_datetime_std` 
+      AND newer.`envcan_obs_id` > `envcan_observation`.`envcan_obs_id`);
+
+-- The unique index replaces the plain index on the same columns
+DROP INDEX IF EXISTS `station_dt_std_idx`;
+CREATE UNIQUE INDEX IF NOT EXISTS `station_dt_std_uniq` 
+  ON `envcan_observation` (`stationID` ASC, `obs_datetime_std` ASC);
+
+COMMIT;
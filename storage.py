@@ -0,0 +1,554 @@
+import operator
+import os
+import tempfile
+from datetime import datetime
+
+from models import (OBSERVATION_ATTRIBUTES, OBSERVATION_FIELDS,
+                    TIMEFRAME_MODELS, iter_observations)
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql')
+
+# envcan_observation columns, ordered like models.OBSERVATION_FIELDS
+OBSERVATION_COLUMNS = [field[1] for field in OBSERVATION_FIELDS]
+_observation_values = operator.attrgetter(*OBSERVATION_ATTRIBUTES)
+_STD_INDEX = OBSERVATION_ATTRIBUTES.index('obs_datetime_std')
+_DST_INDEX = OBSERVATION_ATTRIBUTES.index('obs_datetime_dst')
+
+STATION_COLUMNS = ['stationID', 'name', 'province', 'latitude', 'longitude',
+                   'elevation', 'climate_identifier', 'local_timezone']
+
+def observation_row(obs):
+    """
+    Return a models.Observation as a tuple ordered like OBSERVATION_COLUMNS,
+    with datetimes formatted the way envcan_observation stores them.
+    """
+    row = list(_observation_values(obs))
+    row[_STD_INDEX] = row[_STD_INDEX].strftime('%Y-%m-%d %H:%M:%S')
+    row[_DST_INDEX] = row[_DST_INDEX].strftime('%Y-%m-%d %H:%M:%S')
+    return tuple(row)
+
+# Natural keys of envcan_observation (the station_dt_std_uniq index) and of 
+# the summary tables (their primary keys)
+OBSERVATION_KEY = ['stationID', 'obs_datetime_std']
+SUMMARY_KEY = ['stationID', 'obs_date']
+
+def upsert_clause(dialect, key, columns, unchanged=()):
+    """
+    Return the clause that turns an INSERT into an upsert: a row whose key 
+    already exists overwrites the stored row's other columns instead of 
+    failing or being duplicated, so re-importing a range is a no-op.
+    
+    Keyword arguments:
+    dialect -- 'mysql' for ON DUPLICATE KEY UPDATE, or 'sqlite'/'duckdb' 
+               for ON CONFLICT ... DO UPDATE.
+    key -- Columns of the unique key conflicts are detected on.
+    columns -- Every column the INSERT sets.
+    unchanged -- Further columns left as stored (default none).
+    """
+    updates = [column for column in columns 
+               if column not in key and column not in unchanged]
+    if dialect == 'mysql':
+        return (' ON DUPLICATE KEY UPDATE ' + 
+                ', '.join(column + ' = VALUES(' + column + ')' 
+                          for column in updates))
+    return (' ON CONFLICT (' + ', '.join(key) + ') DO UPDATE SET ' + 
+            ', '.join(column + ' = excluded.' + column 
+                      for column in updates))
+
+# Table holding each summary timeframe (see models.TIMEFRAME_MODELS)
+SUMMARY_TABLES = {2: 'envcan_daily', 3: 'envcan_monthly'}
+
+def summary_insert(timeframe, dialect=None):
+    """
+    Return the INSERT statement for a timeframe's summary table, as an 
+    upsert on (stationID, obs_date) when a dialect is given (see 
+    upsert_clause).
+    """
+    columns = [field[1] for field in TIMEFRAME_MODELS[timeframe][1]]
+    insert = ('INSERT INTO ' + SUMMARY_TABLES[timeframe] + ' (' + 
+              ', '.join(columns) + ') VALUES (' + 
+              ', '.join(['%s'] * len(columns)) + ')')
+    if dialect:
+        insert += upsert_clause(dialect, SUMMARY_KEY, columns)
+    return insert
+
+def summary_row(summary, timeframe):
+    """
+    Return a models.DailyObservation or models.MonthlyObservation as a 
+    tuple ordered like its field table, with obs_date as 'YYYY-MM-DD'.
+    """
+    row = list()
+    for field in TIMEFRAME_MODELS[timeframe][1]:
+        value = getattr(summary, field[0])
+        if field[0] == 'obs_date':
+            value = value.strftime('%Y-%m-%d')
+        row.append(value)
+    return tuple(row)
+
+def station_row(station):
+    """Return a models.Station as a tuple ordered like STATION_COLUMNS."""
+    return (station.station_id, station.name, station.province,
+            station.latitude, station.longitude, station.elevation,
+            station.climate_identifier, station.local_tz_str)
+
+def _tsv_value(value):
+    """Format a value for LOAD DATA's default escaping rules."""
+    if value is None:
+        return '\\N'
+    text = str(value)
+    return (text.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n'))
+
+class StorageWriter():
+    """
+    Interface shared by the database destinations. Each writer mirrors the 
+    sql/create.sql schema (envcan_station, envcan_legend and 
+    envcan_observation) and imports its database driver only when it is 
+    constructed, so unused backends never need to be installed.
+    
+    The database writers upsert by default: observations are keyed on 
+    (stationID, obs_datetime_std) and summaries on (stationID, obs_date), 
+    so importing an overlapping range again replaces rows rather than 
+    doubling them.
+    """
+    INSERT_OBSERVATION = ('INSERT INTO envcan_observation (' +
+                          ', '.join(OBSERVATION_COLUMNS) + ') VALUES (' +
+                          ', '.join(['%s'] * len(OBSERVATION_COLUMNS)) + ')')
+    INSERT_STATION = ('INSERT INTO envcan_station (' +
+                      ', '.join(STATION_COLUMNS) + ') VALUES (' +
+                      ', '.join(['%s'] * len(STATION_COLUMNS)) + ')')
+    
+    def latest_observation(self, station_id):
+        """
+        Return the newest obs_datetime_std stored for a station (a naive
+        datetime in Local Standard Time), or None if the station has no
+        observations.
+        """
+        raise NotImplementedError
+    
+    def write_station(self, station):
+        """Insert a models.Station unless its stationID already exists."""
+        raise NotImplementedError
+    
+    def write_observations(self, observations):
+        """
+        Write an iterable of models.Observation objects or
+        models.ObservationBatch blocks, consuming it one batch at a time.
+
+        Return:
+        The number of rows written.
+        """
+        raise NotImplementedError
+    
+    def write_summaries(self, timeframe, summaries):
+        """
+        Write an iterable of daily (timeframe=2) or monthly (timeframe=3) 
+        summaries to envcan_daily or envcan_monthly.
+
+        Return:
+        The number of rows written.
+        """
+        raise NotImplementedError
+    
+    def close(self):
+        """Release the writer's connections."""
+        pass
+
+class MySQLWriter(StorageWriter):
+    """
+    Reusable writer for envcan_station and envcan_observation. Connections
+    come from a mysql.connector pool, so one writer can be shared by every
+    station in a run without reconnecting. Observations are written with a
+    single, fixed INSERT ... ON DUPLICATE KEY UPDATE statement through
+    executemany (or a server-side prepared statement), or streamed through
+    LOAD DATA LOCAL INFILE ... REPLACE.
+    """
+
+    def __init__(self, config, batch_size=1000, commit_interval=10000,
+                 bulk=False, prepared=False, pool_size=2,
+                 pool_name='envcan', upsert=True):
+        """
+        Keyword arguments:
+        config -- A dict of MySQL configuration credentials (see
+                  config-example.py).
+        batch_size -- Rows sent per executemany call or per LOAD DATA file
+                      (default 1000).
+        commit_interval -- Commit after at least this many rows
+                           (default 10000). Every write call also commits
+                           when it finishes.
+        bulk -- Load observations through LOAD DATA LOCAL INFILE. The server
+                must permit local_infile (default False).
+        prepared -- Use a server-side prepared statement instead of the
+                    connector's multi-row executemany. Ignored when bulk is
+                    set (default False).
+        pool_size -- Connections kept in the pool (default 2).
+        pool_name -- mysql.connector pool name (default 'envcan').
+        upsert -- Replace rows whose natural key already exists. When 
+                  False, plain INSERTs fail on such rows and LOAD DATA 
+                  skips them (default True).
+        """
+        import mysql.connector.pooling
+        
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.bulk = bulk
+        self.prepared = prepared
+        self.upsert = upsert
+        self.insert_observation = self.INSERT_OBSERVATION
+        if upsert:
+            self.insert_observation += upsert_clause(
+                'mysql', OBSERVATION_KEY, OBSERVATION_COLUMNS)
+        pool_config = dict(config)
+        if bulk:
+            pool_config['allow_local_infile'] = True
+        self.pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name=pool_name, pool_size=pool_size, **pool_config)
+
+    def latest_observation(self, station_id):
+        """
+        Return the newest obs_datetime_std stored for a station, served from 
+        the station_dt_std_uniq index.
+        """
+        cnx = self.pool.get_connection()
+        try:
+            cursor = cnx.cursor()
+            cursor.execute('SELECT MAX(obs_datetime_std) ' +
+                           'FROM envcan_observation ' +
+                           'WHERE stationID = %(station_id)s',
+                           {'station_id': station_id})
+            latest = cursor.fetchone()[0]
+            cursor.close()
+        finally:
+            cnx.close()
+        return latest
+
+    def write_station(self, station):
+        cnx = self.pool.get_connection()
+        try:
+            cursor = cnx.cursor()
+            cursor.execute('SELECT stationID FROM envcan_station ' +
+                           'WHERE stationID = %(station_id)s',
+                           {'station_id': station.station_id})
+            if cursor.fetchone() is None:
+                cursor.execute(self.INSERT_STATION, station_row(station))
+            cnx.commit()
+            cursor.close()
+        finally:
+            cnx.close()
+
+    def write_observations(self, observations):
+        cnx = self.pool.get_connection()
+        try:
+            if self.prepared and not self.bulk:
+                cursor = cnx.cursor(prepared=True)
+            else:
+                cursor = cnx.cursor()
+            written = 0
+            uncommitted = 0
+            batch = list()
+            for obs in iter_observations(observations):
+                batch.append(observation_row(obs))
+                if len(batch) == self.batch_size:
+                    self._write_batch(cursor, batch)
+                    written += len(batch)
+                    uncommitted += len(batch)
+                    batch = list()
+                    if uncommitted >= self.commit_interval:
+                        cnx.commit()
+                        uncommitted = 0
+            if batch:
+                self._write_batch(cursor, batch)
+                written += len(batch)
+            cnx.commit()
+            cursor.close()
+        finally:
+            cnx.close()
+        return written
+
+    def write_summaries(self, timeframe, summaries):
+        # At most a few hundred rows per station-year, so always executemany
+        insert = summary_insert(timeframe, 'mysql' if self.upsert else None)
+        cnx = self.pool.get_connection()
+        try:
+            cursor = cnx.cursor()
+            written = 0
+            batch = list()
+            for summary in summaries:
+                batch.append(summary_row(summary, timeframe))
+                if len(batch) == self.batch_size:
+                    cursor.executemany(insert, batch)
+                    written += len(batch)
+                    batch = list()
+            if batch:
+                cursor.executemany(insert, batch)
+                written += len(batch)
+            cnx.commit()
+            cursor.close()
+        finally:
+            cnx.close()
+        return written
+
+    def _write_batch(self, cursor, rows):
+        if self.bulk:
+            self._load_batch(cursor, rows)
+        else:
+            cursor.executemany(self.insert_observation, rows)
+
+    def _load_batch(self, cursor, rows):
+        """
+        Stream rows through a temporary TSV file and LOAD DATA. With upsert,
+        REPLACE deletes a conflicting row before inserting the new one, so
+        its envcan_obs_id changes; without it, LOCAL loads skip conflicts
+        with a warning.
+        """
+        (fd, tsv_path) = tempfile.mkstemp(suffix='.tsv')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8',
+                           newline='') as tsv_file:
+                for row in rows:
+                    tsv_file.write('\t'.join(_tsv_value(value)
+                                             for value in row) + '\n')
+            cursor.execute("LOAD DATA LOCAL INFILE %s " +
+                           ("REPLACE " if self.upsert else "") +
+                           "INTO TABLE envcan_observation " +
+                           "FIELDS TERMINATED BY '\\t' " +
+                           "LINES TERMINATED BY '\\n' (" +
+                           ', '.join(OBSERVATION_COLUMNS) + ")",
+                           (tsv_path,))
+        finally:
+            os.unlink(tsv_path)
+
+    def close(self):
+        """
+        Close the pool's connections. Every method hands its connection 
+        back before returning, so all of them are idle here.
+        """
+        self.pool._remove_connections()
+
+class SQLiteWriter(StorageWriter):
+    """
+    Embedded SQLite destination using sql/create_sqlite.sql. The database is 
+    opened in WAL mode and each write_observations call is one transaction 
+    of executemany batches, which is the fastest way to bulk load SQLite 
+    from Python without giving up durability of committed data.
+    """
+    def __init__(self, path, batch_size=1000, upsert=True):
+        """
+        Keyword arguments:
+        path -- Database file, created along with the schema if needed.
+        batch_size -- Rows per executemany call (default 1000).
+        upsert -- Replace rows whose natural key already exists instead of 
+                  failing on them (default True).
+        """
+        import sqlite3
+        
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.cnx = sqlite3.connect(path)
+        self.cnx.execute('PRAGMA journal_mode=WAL')
+        self.cnx.execute('PRAGMA synchronous=NORMAL')
+        self.cnx.execute('PRAGMA foreign_keys=ON')
+        with open(os.path.join(SQL_DIR, 'create_sqlite.sql'), 'r') as ddl:
+            try:
+                self.cnx.executescript(ddl.read())
+            except sqlite3.IntegrityError:
+                # station_dt_std_uniq cannot be built over duplicate rows
+                self.cnx.close()
+                raise ValueError(path + ' holds duplicate observations; ' + 
+                                 'apply sql/migrate_observation_key_sqlite' + 
+                                 '.sql to it first')
+        self.insert_observation = self.INSERT_OBSERVATION.replace('%s', '?')
+        if upsert:
+            self.insert_observation += upsert_clause(
+                'sqlite', OBSERVATION_KEY, OBSERVATION_COLUMNS)
+        self.insert_station = self.INSERT_STATION.replace('%s', '?')
+    
+    def latest_observation(self, station_id):
+        row = self.cnx.execute('SELECT MAX(obs_datetime_std) ' + 
+                               'FROM envcan_observation ' + 
+                               'WHERE stationID = ?', 
+                               (station_id,)).fetchone()
+        if row[0] is None:
+            return None
+        return datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S')
+    
+    def write_station(self, station):
+        with self.cnx:
+            row = self.cnx.execute('SELECT stationID FROM envcan_station ' + 
+                                   'WHERE stationID = ?', 
+                                   (station.station_id,)).fetchone()
+            if row is None:
+                self.cnx.execute(self.insert_station, station_row(station))
+    
+    def write_observations(self, observations):
+        written = 0
+        with self.cnx:
+            batch = list()
+            for obs in iter_observations(observations):
+                batch.append(observation_row(obs))
+                if len(batch) == self.batch_size:
+                    self.cnx.executemany(self.insert_observation, batch)
+                    written += len(batch)
+                    batch = list()
+            if batch:
+                self.cnx.executemany(self.insert_observation, batch)
+                written += len(batch)
+        return written
+    
+    def write_summaries(self, timeframe, summaries):
+        insert = summary_insert(timeframe, 
+                                'sqlite' if self.upsert else None)
+        insert = insert.replace('%s', '?')
+        written = 0
+        with self.cnx:
+            batch = list()
+            for summary in summaries:
+                batch.append(summary_row(summary, timeframe))
+                if len(batch) == self.batch_size:
+                    self.cnx.executemany(insert, batch)
+                    written += len(batch)
+                    batch = list()
+            if batch:
+                self.cnx.executemany(insert, batch)
+                written += len(batch)
+        return written
+    
+    def close(self):
+        self.cnx.close()
+
+class DuckDBWriter(StorageWriter):
+    """
+    Embedded DuckDB destination using sql/create_duckdb.sql, for local 
+    analytics. Observations are appended in batches inside one transaction 
+    per write_observations call, and export_parquet writes the tables out 
+    as Parquet files.
+    """
+    def __init__(self, path, batch_size=10000, upsert=True):
+        """
+        Keyword arguments:
+        path -- Database file, created along with the schema if needed.
+        batch_size -- Rows per executemany call (default 10000).
+        upsert -- Replace rows whose natural key already exists instead of 
+                  failing on them (default True).
+        """
+        import duckdb
+        
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.cnx = duckdb.connect(path)
+        with open(os.path.join(SQL_DIR, 'create_duckdb.sql'), 'r') as ddl:
+            try:
+                self.cnx.execute(ddl.read())
+            except duckdb.ConstraintException:
+                self.cnx.close()
+                raise ValueError(path + ' holds duplicate observations; ' + 
+                                 'apply sql/migrate_observation_key_duckdb' + 
+                                 '.sql to it first')
+        self.insert_observation = self.INSERT_OBSERVATION.replace('%s', '?')
+        if upsert:
+            # Older DuckDB releases (eg. 1.0) refuse to assign to a column an 
+            # index covers. obs_datetime_dst (station_dt_dst_idx) follows 
+            # from the key's obs_datetime_std, so the stored value is 
+            # already right.
+            self.insert_observation += upsert_clause(
+                'duckdb', OBSERVATION_KEY, OBSERVATION_COLUMNS, 
+                ['obs_datetime_dst'])
+        self.insert_station = self.INSERT_STATION.replace('%s', '?')
+    
+    def latest_observation(self, station_id):
+        return self.cnx.execute('SELECT MAX(obs_datetime_std) ' + 
+                                'FROM envcan_observation ' + 
+                                'WHERE stationID = ?', 
+                                [station_id]).fetchone()[0]
+    
+    def write_station(self, station):
+        row = self.cnx.execute('SELECT stationID FROM envcan_station ' + 
+                               'WHERE stationID = ?', 
+                               [station.station_id]).fetchone()
+        if row is None:
+            self.cnx.execute(self.insert_station, list(station_row(station)))
+    
+    def write_observations(self, observations):
+        written = 0
+        self.cnx.begin()
+        try:
+            batch = list()
+            for obs in iter_observations(observations):
+                batch.append(observation_row(obs))
+                if len(batch) == self.batch_size:
+                    self.cnx.executemany(self.insert_observation, batch)
+                    written += len(batch)
+                    batch = list()
+            if batch:
+                self.cnx.executemany(self.insert_observation, batch)
+                written += len(batch)
+            self.cnx.commit()
+        except BaseException:
+            self.cnx.rollback()
+            raise
+        return written
+    
+    def write_summaries(self, timeframe, summaries):
+        insert = summary_insert(timeframe, 
+                                'duckdb' if self.upsert else None)
+        insert = insert.replace('%s', '?')
+        written = 0
+        self.cnx.begin()
+        try:
+            batch = list()
+            for summary in summaries:
+                batch.append(summary_row(summary, timeframe))
+                if len(batch) == self.batch_size:
+                    self.cnx.executemany(insert, batch)
+                    written += len(batch)
+                    batch = list()
+            if batch:
+                self.cnx.executemany(insert, batch)
+                written += len(batch)
+            self.cnx.commit()
+        except BaseException:
+            self.cnx.rollback()
+            raise
+        return written
+    
+    def export_parquet(self, directory):
+        """Write the station, observation and summary tables as Parquet."""
+        os.makedirs(directory, exist_ok=True)
+        for table in ['envcan_station', 'envcan_observation', 'envcan_daily', 
+                      'envcan_monthly']:
+            path = os.path.join(directory, table + '.parquet')
+            self.cnx.execute('COPY ' + table + " TO '" + 
+                             path.replace("'", "''") + "' (FORMAT PARQUET)")
+    
+    def close(self):
+        self.cnx.close()
+
+DATABASE_DESTS = ['sql', 'sqlite', 'duckdb']
+
+# Destinations written through a StorageWriter; see open_writer
+WRITER_DESTS = DATABASE_DESTS + ['parquet', 'arrow']
+
+def open_writer(dest, db_path=None, batch_size=100, **options):
+    """
+    Create the StorageWriter for a --dest value. 'sql' is MySQL configured 
+    by config.mysql_config(), which is only imported here.
+    
+    Keyword arguments:
+    dest -- One of WRITER_DESTS.
+    db_path -- Database file for 'sqlite' and 'duckdb' (default 
+               envcan.sqlite / envcan.duckdb), or dataset directory for 
+               'parquet' and 'arrow' (default envcan_parquet / envcan_arrow).
+    batch_size -- Rows per batch written.
+    options -- Extra MySQLWriter keyword arguments (eg. commit_interval).
+    """
+    if dest == 'sql':
+        from config import mysql_config
+        return MySQLWriter(mysql_config(), batch_size=batch_size, **options)
+    elif dest == 'sqlite':
+        return SQLiteWriter(db_path or 'envcan.sqlite', batch_size=batch_size)
+    elif dest == 'duckdb':
+        return DuckDBWriter(db_path or 'envcan.duckdb', batch_size=batch_size)
+    elif dest == 'parquet' or dest == 'arrow':
+        from arrow_export import ArrowWriter
+        return ArrowWriter(db_path or ('envcan_' + dest), fmt=dest)
+    raise ValueError('Unknown database destination: ' + dest)
@@ -0,0 +1,535 @@
+import calendar
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+from xml.sax.saxutils import escape
+
+WEATHER_DESCS = ['Clear', 'Mainly Clear', 'Mostly Cloudy', 'Cloudy', 'Rain',
+                 'Snow', 'Fog', 'Rain Showers', 'Snow,Blowing Snow', None]
+
+# (stationdata child tag, bulkdata CSV heading) of each measurement, in 
+# document order
+MEASUREMENTS = [('temp', 'Temp (\u00b0C)'), 
+                ('dptemp', 'Dew Point Temp (\u00b0C)'), 
+                ('relhum', 'Rel Hum (%)'), ('winddir', 'Wind Dir (10s deg)'), 
+                ('windspd', 'Wind Spd (km/h)'), 
+                ('visibility', 'Visibility (km)'), 
+                ('stnpress', 'Stn Press (kPa)'), ('humidex', 'Hmdx'), 
+                ('windchill', 'Wind Chill')]
+
+# (stationdata child tag, bulkdata CSV heading) of the timeframe=2 (daily) 
+# and timeframe=3 (monthly) summaries
+DAILY_MEASUREMENTS = [('maxtemp', 'Max Temp (\u00b0C)'), 
+                      ('mintemp', 'Min Temp (\u00b0C)'), 
+                      ('meantemp', 'Mean Temp (\u00b0C)'), 
+                      ('heatdegdays', 'Heat Deg Days (\u00b0C)'), 
+                      ('cooldegdays', 'Cool Deg Days (\u00b0C)'), 
+                      ('totalrain', 'Total Rain (mm)'), 
+                      ('totalsnow', 'Total Snow (cm)'), 
+                      ('totalprecipitation', 'Total Precip (mm)'), 
+                      ('snowonground', 'Snow on Grnd (cm)'), 
+                      ('dirofmaxgust', 'Dir of Max Gust (10s deg)'), 
+                      ('speedofmaxgust', 'Spd of Max Gust (km/h)')]
+
+MONTHLY_MEASUREMENTS = [('meanmaxtemp', 'Mean Max Temp (\u00b0C)'), 
+                        ('meanmintemp', 'Mean Min Temp (\u00b0C)'), 
+                        ('meantemp', 'Mean Temp (\u00b0C)'), 
+                        ('extrmaxtemp', 'Extr Max Temp (\u00b0C)'), 
+                        ('extrmintemp', 'Extr Min Temp (\u00b0C)'), 
+                        ('totalrain', 'Total Rain (mm)'), 
+                        ('totalsnow', 'Total Snow (cm)'), 
+                        ('totalprecipitation', 'Total Precip (mm)'), 
+                        ('snowgrndlastday', 'Snow Grnd Last Day (cm)'), 
+                        ('dirofmaxgust', "Dir of Max Gust (10's deg)"), 
+                        ('speedofmaxgust', 'Spd of Max Gust (km/h)')]
+
+# Years covered by a synthetic timeframe=3 (whole history) document
+HISTORY_YEARS = (1950, 2030)
+
+STATION_INFO = [('latitude', 'Latitude', '43.46'), 
+                ('longitude', 'Longitude', '-80.38'), 
+                ('elevation', 'Elevation', '321.60'), 
+                ('climate_identifier', 'Climate Identifier', '6144239')]
+
+def month_rows(station_id, year_num, month_num):
+    """
+    Generate the hourly readings shared by month_xml and month_csv. Values 
+    are pseudo-random but deterministic for a given (station_id, year_num, 
+    month_num).
+
+    Return:
+    A generator of dicts with day, hour, quality, weather and one entry per 
+    MEASUREMENTS tag. A measurement is None for an empty element and ' ' 
+    for a missing reading.
+    """
+    rnd = random.Random((station_id * 10000) + (year_num * 100) + month_num)
+    days = calendar.monthrange(year_num, month_num)[1]
+    for day in range(1, days + 1):
+        for hour in range(24):
+            row = {'day': day, 'hour': hour, 
+                   'quality': rnd.choice([' ', ' ', ' ', '**'])}
+            temp = round(rnd.uniform(-30.0, 35.0), 1)
+            row['temp'] = _measurement(rnd, temp)
+            row['dptemp'] = _measurement(rnd, round(temp - 
+                                                    rnd.uniform(0.0, 10.0), 
+                                                    1))
+            row['relhum'] = _measurement(rnd, rnd.randint(10, 100))
+            row['winddir'] = _measurement(rnd, rnd.randint(0, 36))
+            row['windspd'] = _measurement(rnd, rnd.randint(0, 70))
+            row['visibility'] = _measurement(rnd, 
+                                             round(rnd.uniform(0.0, 48.3), 1))
+            row['stnpress'] = _measurement(rnd, 
+                                           round(rnd.uniform(95.0, 101.5), 2))
+            row['humidex'] = None
+            if temp > 25.0:
+                row['humidex'] = _measurement(rnd, round(temp + 4, 1))
+            row['windchill'] = None
+            if temp < 0.0:
+                row['windchill'] = _measurement(rnd, int(temp) - 5)
+            row['weather'] = rnd.choice(WEATHER_DESCS)
+            yield row
+
+def _measurement(rnd, value):
+    """Render a measurement, leaving roughly 2% of them missing."""
+    if rnd.random() < 0.02:
+        return ' '
+    return str(value)
+
+def summary_rows(station_id, year_num, timeframe):
+    """
+    Generate a year of timeframe=2 (daily) or timeframe=3 (monthly) 
+    summaries, deterministic for a given (station_id, year_num, timeframe).
+
+    Return:
+    A generator of dicts with month, day (None for monthly rows), quality 
+    and one entry per measurement tag, ' ' for a missing value.
+    """
+    rnd = random.Random((station_id * 10000) + (year_num * 100) + 
+                        50 + timeframe)
+    if timeframe == 2:
+        periods = [(month_num, day) for month_num in range(1, 13) 
+                   for day in range(1, calendar.monthrange(year_num, 
+                                                           month_num)[1] + 1)]
+    else:
+        periods = [(month_num, None) for month_num in range(1, 13)]
+    for (month_num, day) in periods:
+        row = {'month': month_num, 'day': day, 
+               'quality': rnd.choice([' ', ' ', ' ', '**'])}
+        high = round(rnd.uniform(-25.0, 35.0), 1)
+        low = round(high - rnd.uniform(2.0, 15.0), 1)
+        mean = round((high + low) / 2, 1)
+        rain = round(max(0.0, rnd.uniform(-10.0, 30.0)), 1)
+        snow = round(max(0.0, rnd.uniform(-20.0, 15.0)), 1)
+        gust = rnd.randint(20, 100)
+        values = [high, low, mean, 
+                  round(max(0.0, 18.0 - mean), 1), 
+                  round(max(0.0, mean - 18.0), 1), 
+                  rain, snow, round(rain + snow, 1), 
+                  rnd.randint(0, 60), rnd.randint(1, 36), 
+                  '<31' if gust < 31 else gust]
+        if timeframe == 3:
+            measurements = MONTHLY_MEASUREMENTS
+            values[0:3] = [round(high - 3.0, 1), round(low + 3.0, 1), mean]
+            values[3:5] = [high, low]
+        else:
+            measurements = DAILY_MEASUREMENTS
+        for ((tag, heading), value) in zip(measurements, values):
+            row[tag] = _measurement(rnd, value)
+        yield row
+
+def _xml_station_info(station_id):
+    """Return the stationinformation element of a synthetic document."""
+    parts = ['<stationinformation>\n',
+             '<name>SYNTHETIC STATION ' + str(station_id) + '</name>\n',
+             '<province>ONTARIO</province>\n']
+    for (tag, heading, value) in STATION_INFO:
+        parts.append('<' + tag + '>' + value + '</' + tag + '>\n')
+    parts.append('</stationinformation>\n')
+    return ''.join(parts)
+
+def _csv_station_header(csvw, out, station_id):
+    """Write the station header block and legend of a CSV document."""
+    csvw.writerow(['Station Name', 'SYNTHETIC STATION ' + str(station_id)])
+    csvw.writerow(['Province', 'ONTARIO'])
+    for (tag, heading, value) in STATION_INFO:
+        csvw.writerow([heading, value])
+    csvw.writerow(['All times are specified in Local Standard Time (LST). '
+                   'Add 1 hour to adjust for Daylight Saving Time where and '
+                   'when it is observed.'])
+    out.write('\n')
+    csvw.writerow(['Legend'])
+    csvw.writerow(['M', 'Missing'])
+    csvw.writerow(['**', 'Partner data that is not subject to review'])
+    out.write('\n')
+
+def _csv_measurements(measurements, row):
+    """Return the value and flag cells of a CSV data row."""
+    cells = list()
+    for (tag, heading) in measurements:
+        value = row[tag]
+        if value == ' ':
+            cells += ['', 'M']
+        else:
+            cells += [value or '', '']
+    return cells
+
+def _csv_headings(measurements):
+    """Return the value and flag headings of a CSV heading row."""
+    headings = list()
+    for (tag, heading) in measurements:
+        headings += [heading, heading.split(' (')[0] + ' Flag']
+    return headings
+
+def month_xml(station_id, year_num, month_num):
+    """
+    Generate a month of hourly bulkdata XML resembling the documents served
+    by climate.weather.gc.ca.
+
+    Return:
+    The XML document as UTF-8 encoded bytes.
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<climatedata>\n<lang>ENG</lang>\n',
+             _xml_station_info(station_id)]
+
+    for row in month_rows(station_id, year_num, month_num):
+        parts.append('<stationdata day="' + str(row['day']) +
+                     '" hour="' + str(row['hour']) + '" minute="0" month="' +
+                     str(month_num) + '" year="' + str(year_num) +
+                     '" quality="' + row['quality'] + '">\n')
+        for (tag, heading) in MEASUREMENTS + [('weather', 'Weather')]:
+            value = row[tag]
+            if value is None:
+                parts.append('<' + tag + '></' + tag + '>\n')
+            else:
+                parts.append('<' + tag + '>' + escape(value) + 
+                             '</' + tag + '>\n')
+        parts.append('</stationdata>\n')
+    parts.append('</climatedata>\n')
+    return ''.join(parts).encode('utf-8')
+
+def month_csv(station_id, year_num, month_num):
+    """
+    Generate the same month as month_xml in the bulkdata CSV layout: a 
+    block of station header rows and a legend, then one row per hour with 
+    a flag column after each measurement.
+
+    Return:
+    The CSV document as UTF-8 encoded bytes (with a byte order mark, as 
+    climate.weather.gc.ca sends it).
+    """
+    out = io.StringIO()
+    csvw = csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    _csv_station_header(csvw, out, station_id)
+    csvw.writerow(['Date/Time', 'Year', 'Month', 'Day', 'Time', 
+                   'Data Quality'] + _csv_headings(MEASUREMENTS) + 
+                  ['Weather'])
+    for row in month_rows(station_id, year_num, month_num):
+        time_txt = '%02d:00' % row['hour']
+        cells = ['%d-%02d-%02d ' % (year_num, month_num, row['day']) + 
+                 time_txt, str(year_num), '%02d' % month_num, 
+                 '%02d' % row['day'], time_txt, row['quality'].strip()]
+        csvw.writerow(cells + _csv_measurements(MEASUREMENTS, row) + 
+                      [row['weather'] or ''])
+    return ('\ufeff' + out.getvalue()).encode('utf-8')
+
+def _summary_years(year_num, timeframe):
+    """Years held by a daily (one year) or monthly (history) document."""
+    if timeframe == 2:
+        return [year_num]
+    return range(HISTORY_YEARS[0], HISTORY_YEARS[1] + 1)
+
+def summary_xml(station_id, year_num, timeframe):
+    """
+    Generate a timeframe=2 document (a year of daily summaries) or a 
+    timeframe=3 document (monthly summaries for every year of 
+    HISTORY_YEARS, whatever year_num is) in bulkdata XML.
+
+    Return:
+    The XML document as UTF-8 encoded bytes.
+    """
+    measurements = DAILY_MEASUREMENTS
+    if timeframe == 3:
+        measurements = MONTHLY_MEASUREMENTS
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<climatedata>\n<lang>ENG</lang>\n',
+             _xml_station_info(station_id)]
+    for y in _summary_years(year_num, timeframe):
+        for row in summary_rows(station_id, y, timeframe):
+            day_attr = ''
+            if row['day'] is not None:
+                day_attr = 'day="' + str(row['day']) + '" '
+            parts.append('<stationdata ' + day_attr + 'month="' + 
+                         str(row['month']) + '" year="' + str(y) + 
+                         '" quality="' + row['quality'] + '">\n')
+            for (tag, heading) in measurements:
+                parts.append('<' + tag + '>' + escape(row[tag]) + 
+                             '</' + tag + '>\n')
+            parts.append('</stationdata>\n')
+    parts.append('</climatedata>\n')
+    return ''.join(parts).encode('utf-8')
+
+def summary_csv(station_id, year_num, timeframe):
+    """
+    Generate the same document as summary_xml in the bulkdata CSV layout.
+
+    Return:
+    The CSV document as UTF-8 encoded bytes, with a byte order mark.
+    """
+    measurements = DAILY_MEASUREMENTS
+    date_headings = ['Date/Time', 'Year', 'Month', 'Day']
+    if timeframe == 3:
+        measurements = MONTHLY_MEASUREMENTS
+        date_headings = ['Date/Time', 'Year', 'Month']
+    out = io.StringIO()
+    csvw = csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    _csv_station_header(csvw, out, station_id)
+    csvw.writerow(date_headings + ['Data Quality'] + 
+                  _csv_headings(measurements))
+    for y in _summary_years(year_num, timeframe):
+        for row in summary_rows(station_id, y, timeframe):
+            if row['day'] is None:
+                cells = ['%d-%02d' % (y, row['month']), str(y), 
+                         '%02d' % row['month']]
+            else:
+                cells = ['%d-%02d-%02d' % (y, row['month'], row['day']), 
+                         str(y), '%02d' % row['month'], '%02d' % row['day']]
+            csvw.writerow(cells + [row['quality'].strip()] + 
+                          _csv_measurements(measurements, row))
+    return ('\ufeff' + out.getvalue()).encode('utf-8')
+
+# Hourly and summary document generators and Content-Type for each bulkdata 
+# format parameter
+FORMATS = {'xml': (month_xml, summary_xml, 'text/xml; charset=utf-8'),
+           'csv': (month_csv, summary_csv, 'text/csv; charset=utf-8')}
+
+# Station time zones of a corpus, assigned in turn: Eastern and Pacific 
+# DST, Newfoundland's half-hour offset and Saskatchewan without DST
+CORPUS_TIMEZONES = ['America/Toronto', 'America/St_Johns', 'America/Regina', 
+                    'America/Vancouver', 'America/Halifax', 
+                    'America/Winnipeg']
+
+def corpus_path(corpus_dir, frmt, station_id, year_num, month_num):
+    """Return the file holding one month of a corpus."""
+    return os.path.join(corpus_dir, frmt, str(station_id), 
+                        str(year_num) + '-%02d.' % month_num + frmt)
+
+def write_corpus(corpus_dir, stations, years, year_start=2000, 
+                 formats=('xml', 'csv')):
+    """
+    Write a corpus of hourly bulkdata documents for stations 1..stations and 
+    every month of years consecutive years, in each of formats, along with 
+    a batch_import.py manifest (manifest.csv) and a corpus.json describing 
+    it. Every month spans the DST transitions of its station's time zone, 
+    about 2% of readings are missing and a quarter carry a quality flag. 
+    The same arguments always give byte-identical files.
+
+    Keyword arguments:
+    corpus_dir -- Directory to write to (created if needed).
+    stations -- Number of stations.
+    years -- Number of years per station.
+    year_start -- First year of every station (default 2000).
+    formats -- Bulkdata formats to write (default both 'xml' and 'csv').
+
+    Return:
+    The list of manifest entries, as dicts.
+    """
+    entries = list()
+    for station_id in range(1, stations + 1):
+        entries.append({'station_id': station_id, 
+                        'tz_name': CORPUS_TIMEZONES[(station_id - 1) % 
+                                                    len(CORPUS_TIMEZONES)], 
+                        'year_start': year_start, 'month_start': 1, 
+                        'year_end': year_start + years - 1, 'month_end': 12})
+        for frmt in formats:
+            month_doc = FORMATS[frmt][0]
+            os.makedirs(os.path.dirname(corpus_path(corpus_dir, frmt, 
+                                                    station_id, year_start, 
+                                                    1)), exist_ok=True)
+            for year_num in range(year_start, year_start + years):
+                for month_num in range(1, 13):
+                    with open(corpus_path(corpus_dir, frmt, station_id, 
+                                          year_num, month_num), 
+                              'wb') as month_file:
+                        month_file.write(month_doc(station_id, year_num, 
+                                                   month_num))
+
+    fields = ['station_id', 'tz_name', 'year_start', 'month_start', 
+              'year_end', 'month_end']
+    with open(os.path.join(corpus_dir, 'manifest.csv'), 'w', 
+              newline='') as manifest_file:
+        manifest = csv.DictWriter(manifest_file, fieldnames=fields)
+        manifest.writeheader()
+        manifest.writerows(entries)
+    with open(os.path.join(corpus_dir, 'corpus.json'), 'w') as info_file:
+        json.dump({'stations': stations, 'years': years, 
+                   'year_start': year_start, 'formats': list(formats)}, 
+                  info_file, indent=2)
+    return entries
+
+def read_corpus(corpus_dir):
+    """
+    Return the corpus.json parameters of a corpus written by write_corpus, 
+    or None if there is none.
+    """
+    try:
+        with open(os.path.join(corpus_dir, 'corpus.json'), 'r') as info_file:
+            return json.load(info_file)
+    except FileNotFoundError:
+        return None
+
+class BulkdataServer():
+    """
+    Local stand-in for the bulk data endpoint. Serves month_xml or month_csv 
+    documents, depending on the format parameter, over HTTP on 127.0.0.1 so 
+    that fetching can be exercised without touching climate.weather.gc.ca.
+
+    Connections are kept alive (HTTP/1.1), bodies are gzip-compressed when 
+    the client accepts it, and every response carries an ETag and 
+    Last-Modified so that conditional requests get 304 Not Modified. 
+    request_count, connection_count, not_modified_count and bytes_sent 
+    (body bytes on the wire) describe the traffic served. Statuses appended 
+    to fail_statuses are answered, one per request, before real documents; 
+    0 drops the connection without a response, 200 sends the real headers 
+    but drops the connection halfway through the body, a 3xx redirects back 
+    to the same URL and None serves normally. Requests to redirect_url are 
+    answered with a 301 to redirect_to (by default url, but eg. another 
+    server's), as climate.weather.gc.ca redirects http to https.
+
+    Given a corpus_dir written by write_corpus, hourly documents are served 
+    from its files (404 for months it does not hold) instead of being 
+    generated per request.
+    """
+    LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+    def __init__(self, port=0, corpus_dir=None):
+        self.corpus_dir = corpus_dir
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.connection_count = 0
+        self.not_modified_count = 0
+        self.bytes_sent = 0
+        self.fail_statuses = list()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; without this a 
+            # kept-alive connection stalls on Nagle and delayed ACKs
+            disable_nagle_algorithm = True
+            truncate_body = False
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connection_count += 1
+
+            def do_GET(self):
+                query = parse.parse_qs(parse.urlsplit(self.path).query)
+                with server.lock:
+                    server.request_count += 1
+                    fail_status = None
+                    if server.fail_statuses:
+                        fail_status = server.fail_statuses.pop(0)
+                if fail_status == 0:
+                    self.close_connection = True
+                    return
+                self.truncate_body = fail_status == 200
+                if self.truncate_body:
+                    fail_status = None
+                if fail_status is not None and 300 <= fail_status < 400:
+                    self._send(fail_status, b'', 'text/plain', 
+                               [('Location', self.path)])
+                    return
+                if fail_status is not None:
+                    self._send(fail_status, b'', 'text/plain', 
+                               [('Retry-After', '0')])
+                    return
+
+                if self.path.startswith('/redirect/'):
+                    self._send(301, b'', 'text/plain', 
+                               [('Location', server.redirect_to + '?' + 
+                                 parse.urlsplit(self.path).query)])
+                    return
+
+                (month_doc, summary_doc, content_type) = FORMATS[
+                    query['format'][0]]
+                timeframe = int(query['timeframe'][0])
+                if timeframe == 1 and server.corpus_dir is not None:
+                    path = corpus_path(server.corpus_dir, query['format'][0], 
+                                       int(query['stationID'][0]), 
+                                       int(query['Year'][0]), 
+                                       int(query['Month'][0]))
+                    if not os.path.exists(path):
+                        self._send(404, b'', 'text/plain', [])
+                        return
+                    with open(path, 'rb') as month_file:
+                        body = month_file.read()
+                elif timeframe == 1:
+                    body = month_doc(int(query['stationID'][0]),
+                                     int(query['Year'][0]),
+                                     int(query['Month'][0]))
+                else:
+                    body = summary_doc(int(query['stationID'][0]),
+                                       int(query['Year'][0]), timeframe)
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                validators = [('ETag', etag), 
+                              ('Last-Modified', server.LAST_MODIFIED)]
+                if self.headers.get('If-None-Match') == etag:
+                    with server.lock:
+                        server.not_modified_count += 1
+                    self._send(304, None, None, validators)
+                    return
+                if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                    # Level 6, as web servers use; 9 is far slower on CSV
+                    body = gzip.compress(body, compresslevel=6, mtime=0)
+                    validators.append(('Content-Encoding', 'gzip'))
+                self._send(200, body, content_type, validators)
+
+            def _send(self, status, body, content_type, headers):
+                self.send_response(status)
+                for (name, value) in headers:
+                    self.send_header(name, value)
+                if body is not None:
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if body and self.truncate_body:
+                    # Content-Length promised the whole body
+                    body = body[:len(body) // 2]
+                    self.close_connection = True
+                if body:
+                    self.wfile.write(body)
+                    with server.lock:
+                        server.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = ('http://127.0.0.1:' + str(self.httpd.server_port) +
+                    '/climateData/bulkdata_e.html')
+        self.redirect_url = ('http://127.0.0.1:' + 
+                             str(self.httpd.server_port) + 
+                             '/redirect/climateData/bulkdata_e.html')
+        self.redirect_to = self.url
+        self.thread = None
+
+    def start(self):
+        """Serve requests from a background thread."""
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Shut the server down and release its socket."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,396 @@
+import argparse
+import csv
+import http.client
+import io
+import operator
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from urllib import error
+
+import pytest
+
+import import_history
+import models
+import storage
+import synthetic
+import tzconvert
+from batch_import import BatchImporter, load_manifest
+from cache import ResponseCache
+from http_session import HTTPSession
+from metrics import METRICS
+from models import (OBSERVATION_ATTRIBUTES, OBSERVATION_FIELDS, Observation, 
+                    bulkdata_csv_decoder, stationdata_decoder)
+
+STATION_ID = 4242
+TZ_NAME = 'America/Toronto'
+
+@pytest.fixture(scope='module')
+def server():
+    server = synthetic.BulkdataServer().start()
+    yield server
+    server.stop()
+
+def parsed_month(year_num, month_num, station=None):
+    """Return [station, observations] parsed from a synthetic month."""
+    return import_history.parse_month(
+        io.BytesIO(synthetic.month_xml(STATION_ID, year_num, month_num)),
+        STATION_ID, TZ_NAME, station)
+
+def incremental_args(dest, year_end, month_end):
+    return argparse.Namespace(dest=dest, station_id=STATION_ID,
+                              year_start=2011, month_start=1,
+                              year_end=year_end, month_end=month_end,
+                              day_start=1, checkpoint=None)
+
+def test_concurrent_fetches_stay_in_order(server):
+    months = list(import_history.iter_hourly(
+        STATION_ID, 2010, 2011, 1, 12, 1, TZ_NAME, workers=4,
+        base_url=server.url))
+    assert len(months) == 24
+    # One Station object shared by every month
+    assert all(station is months[0][0] for [station, observations] in months)
+    stamps = [obs.obs_datetime_std for [station, observations] in months
+              for obs in observations]
+    assert stamps == sorted(stamps)
+    assert len(set(stamps)) == len(stamps) == (365 + 365) * 24
+
+    [serial_station, serial] = import_history.range_hourly(
+        STATION_ID, 2010, 2011, 1, 12, 1, TZ_NAME, base_url=server.url)
+    assert [str(obs) for obs in serial] == [
+        str(obs) for [station, observations] in months
+        for obs in observations]
+
+def test_rate_limiter_spaces_requests_per_host():
+    limiter = import_history.RateLimiter(20)
+    sent = list()
+    lock = threading.Lock()
+
+    def request(host):
+        limiter.wait(host)
+        with lock:
+            sent.append((host, time.monotonic()))
+
+    threads = [threading.Thread(target=request, args=(host,))
+               for host in ['a'] * 6 + ['b'] * 2]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    a_times = sorted(sent_at for (host, sent_at) in sent if host == 'a')
+    b_times = sorted(sent_at for (host, sent_at) in sent if host == 'b')
+    # Slots are 50ms apart; allow for sleep() waking a little early
+    gaps = [later - earlier for (earlier, later)
+            in zip(a_times, a_times[1:])]
+    assert min(gaps) > 0.04
+    assert a_times[-1] - start > 5 * 0.04
+    # Another host has its own slots
+    assert b_times[0] - start < 0.04
+
+def test_rate_limited_concurrent_import(server):
+    start = time.monotonic()
+    [station, observations] = import_history.range_hourly(
+        STATION_ID, 2011, 2011, 1, 6, 1, TZ_NAME, workers=4, max_rate=20,
+        base_url=server.url)
+    assert time.monotonic() - start > 5 * 0.04
+    assert len(observations) == 181 * 24
+
+@pytest.mark.parametrize('tz_name', import_history.canadian_timezones())
+def test_transition_table_matches_astimezone(tz_name):
+    [std_tz, local_tz] = import_history.station_timezones(tz_name)
+    table = tzconvert.transition_table(tz_name)
+    # Years on both sides of the 2007 rule change, and a recent one
+    for year_num in [1999, 2006, 2007, 2024]:
+        first = datetime(year_num, 1, 1, tzinfo=std_tz)
+        std_datetimes = [first + timedelta(hours=h) for h in range(366 * 24)]
+        # Out of order and missing values are handled too
+        std_datetimes[100:200] = reversed(std_datetimes[100:200])
+        std_datetimes[300] = None
+
+        actual = table.localize(std_datetimes)
+        assert len(actual) == len(std_datetimes)
+        for (std_dt, got) in zip(std_datetimes, actual):
+            if std_dt is None:
+                assert got is None
+                continue
+            want = std_dt.astimezone(local_tz)
+            assert want == got
+            assert want.tzinfo is got.tzinfo
+            assert str(want) == str(got)
+            assert want.tzname() == got.tzname()
+
+def test_xml_and_csv_parse_identically(server):
+    # March 2011 holds Toronto's switch to daylight time
+    parsed = dict()
+    for source_format in ['xml', 'csv']:
+        parsed[source_format] = import_history.range_hourly(
+            STATION_ID, 2011, 2011, 2, 4, 1, TZ_NAME, base_url=server.url,
+            source_format=source_format)
+    [xml_station, xml_observations] = parsed['xml']
+    [csv_station, csv_observations] = parsed['csv']
+
+    assert vars(xml_station) == vars(csv_station)
+    assert len(xml_observations) == len(csv_observations) > 0
+    values = operator.attrgetter(*OBSERVATION_ATTRIBUTES)
+    for (xml_obs, csv_obs) in zip(xml_observations, csv_observations):
+        assert values(xml_obs) == values(csv_obs)
+        # str() also compares the UTC offsets of both datetimes
+        assert str(xml_obs.obs_datetime_dst) == str(csv_obs.obs_datetime_dst)
+
+def test_decoders_stay_correct_past_the_memo_cap(monkeypatch):
+    monkeypatch.setattr(models, 'MAX_CONVERTED', 2)
+    headings = [field[3] for field in OBSERVATION_FIELDS if field[3]]
+    decode_row = bulkdata_csv_decoder(headings)
+    decode_element = stationdata_decoder()
+    for temp in range(-40, 40):
+        txt = str(temp) + '.5'
+        row = [''] * len(headings)
+        row[headings.index('Temp (\u00b0C)')] = txt
+        row[headings.index('Wind Dir (10s deg)')] = str(temp % 36)
+        sd_elmnt = ET.Element('stationdata')
+        ET.SubElement(sd_elmnt, 'temp').text = txt
+        ET.SubElement(sd_elmnt, 'winddir').text = str(temp % 36)
+        ET.SubElement(sd_elmnt, 'weather').text = None
+        for (decode, source) in [(decode_row, row), 
+                                 (decode_element, sd_elmnt)]:
+            observation = Observation()
+            decode(source, observation)
+            assert observation.temp_c == float(txt)
+            assert observation.wind_dir_deg == (temp % 36) * 10
+            assert observation.weather_desc is None
+
+def test_redirect_to_another_host_is_followed_and_cached(server, tmp_path):
+    origin = synthetic.BulkdataServer().start()
+    try:
+        origin.redirect_to = server.url
+        cache = ResponseCache(str(tmp_path))
+        # Closed months never expire, so a cached redirect body would stick
+        for i in range(2):
+            [station, observations] = import_history.range_hourly(
+                STATION_ID, 2011, 2011, 1, 1, 1, TZ_NAME,
+                base_url=origin.redirect_url, cache=cache)
+            assert len(observations) == 744
+    finally:
+        origin.stop()
+    assert origin.request_count == 1
+
+def test_body_cut_off_mid_transfer_is_retried_not_cached(server, tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    session = HTTPSession(backoff=0)
+    server.fail_statuses.append(200)
+    try:
+        with import_history.open_content(STATION_ID, 2011, 1, 1, 
+                                         base_url=server.url, cache=cache, 
+                                         session=session) as source:
+            payload = source.read()
+    finally:
+        del server.fail_statuses[:]
+    assert session.stats['retries'] == 1
+    with import_history.fetch_content(STATION_ID, 2011, 1, 1, 
+                                      base_url=server.url, 
+                                      session=session) as response:
+        assert payload == response.read()
+    with cache.get(STATION_ID, 2011, 1, 1, 'xml') as cached:
+        assert cached.read() == payload
+
+def test_body_cut_off_mid_transfer_is_an_error(server, tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    session = HTTPSession(retries=0)
+    server.fail_statuses.append(200)
+    try:
+        with pytest.raises(http.client.IncompleteRead):
+            import_history.open_content(STATION_ID, 2011, 1, 1, 
+                                        base_url=server.url, cache=cache, 
+                                        session=session)
+    finally:
+        del server.fail_statuses[:]
+    assert cache.get(STATION_ID, 2011, 1, 1, 'xml') is None
+    assert session.idle == dict()
+
+def test_redirect_loop_is_an_error(server):
+    session = HTTPSession(max_redirects=3)
+    server.fail_statuses.extend([302] * 4)
+    try:
+        with pytest.raises(error.HTTPError) as raised:
+            session.get(server.url + '?format=xml&stationID=1&Year=2011'
+                        '&Month=1&Day=1&timeframe=1')
+    finally:
+        del server.fail_statuses[:]
+    assert raised.value.code == 302
+    assert session.stats['redirects'] == 3
+
+@pytest.mark.parametrize('range_func', [import_history.range_daily,
+                                        import_history.range_monthly])
+def test_summaries_xml_and_csv_parse_identically(server, range_func):
+    parsed = dict()
+    for source_format in ['xml', 'csv']:
+        parsed[source_format] = range_func(
+            STATION_ID, 2010, 2011, 1, 12, 1, TZ_NAME, base_url=server.url,
+            source_format=source_format)
+    assert len(parsed['xml'][1]) == len(parsed['csv'][1]) > 0
+    for (xml_row, csv_row) in zip(parsed['xml'][1], parsed['csv'][1]):
+        assert str(xml_row) == str(csv_row)
+
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow'])
+def test_incremental_arrow_keeps_earlier_rows(tmp_path, fmt):
+    pytest.importorskip('pyarrow')
+    import pyarrow.dataset
+    from arrow_export import ArrowWriter
+
+    [station, january] = parsed_month(2011, 1)
+    [station, february] = parsed_month(2011, 2, station)
+    root_dir = str(tmp_path / fmt)
+
+    # A nightly run on January 16th stores the first half of the month...
+    writer = ArrowWriter(root_dir, fmt=fmt)
+    import_history.write_incremental(
+        incremental_args(fmt, 2011, 1), iter([[station, january[:360]]]),
+        2011, 1, None, writer)
+    writer.close()
+
+    # ...and the next one resumes at the high-water month
+    writer = ArrowWriter(root_dir, fmt=fmt)
+    import_history.write_incremental(
+        incremental_args(fmt, 2011, 2),
+        iter([[station, january], [station, february]]), 2011, 1, None,
+        writer)
+    writer.close()
+
+    dataset_format = 'ipc' if fmt == 'arrow' else fmt
+    table = pyarrow.dataset.dataset(root_dir, format=dataset_format,
+                                    partitioning='hive').to_table()
+    stored = table.column('obs_datetime_std').to_pylist()
+    assert len(stored) == len(january) + len(february)
+    assert len(set(stored)) == len(stored)
+
+def open_writer(dest, tmp_path):
+    if dest == 'duckdb':
+        pytest.importorskip('duckdb')
+        return storage.DuckDBWriter(str(tmp_path / 'envcan.duckdb'))
+    return storage.SQLiteWriter(str(tmp_path / 'envcan.sqlite'))
+
+@pytest.mark.parametrize('dest', ['sqlite', 'duckdb'])
+def test_incremental_metrics_count_written_rows(tmp_path, dest):
+    [station, january] = parsed_month(2011, 1)
+    [station, february] = parsed_month(2011, 2, station)
+    writer = open_writer(dest, tmp_path)
+    try:
+        import_history.write_incremental(
+            incremental_args(dest, 2011, 1),
+            iter([[station, january[:360]]]), 2011, 1, None, writer)
+        METRICS.reset()
+        import_history.write_incremental(
+            incremental_args(dest, 2011, 2),
+            iter([[station, january], [station, february]]), 2011, 1, None,
+            writer)
+        [stored] = writer.cnx.execute(
+            'SELECT COUNT(*) FROM envcan_observation').fetchone()
+    finally:
+        writer.close()
+    report = METRICS.report()
+    assert report['stages']['write']['count'] == 2
+    assert report['counters']['rows'] == len(january) - 360 + len(february)
+    assert stored == len(january) + len(february)
+
+@pytest.mark.parametrize('parse_workers', [1, 2])
+def test_batch_failures_do_not_stop_other_stations(tmp_path, parse_workers):
+    corpus_dir = str(tmp_path / 'corpus')
+    synthetic.write_corpus(corpus_dir, 4, 1, formats=('xml',))
+    # Station 2 has a corrupt month and station 3 a missing one (404)
+    with open(synthetic.corpus_path(corpus_dir, 'xml', 2, 2000, 3),
+              'wb') as month_file:
+        month_file.write(b'<stationdata')
+    os.remove(synthetic.corpus_path(corpus_dir, 'xml', 3, 2000, 5))
+
+    corpus_server = synthetic.BulkdataServer(corpus_dir=corpus_dir).start()
+    writer = storage.SQLiteWriter(str(tmp_path / 'envcan.sqlite'))
+    try:
+        importer = BatchImporter(
+            load_manifest(os.path.join(corpus_dir, 'manifest.csv')),
+            dest='sqlite', workers=2, base_url=corpus_server.url,
+            writer=writer, parse_workers=parse_workers)
+        failures = importer.run()
+        stored = dict(writer.cnx.execute(
+            'SELECT stationID, COUNT(*) FROM envcan_observation '
+            'GROUP BY stationID').fetchall())
+    finally:
+        writer.close()
+        corpus_server.stop()
+    assert sorted(failures) == [2, 3]
+    assert isinstance(failures[3], error.HTTPError)
+    assert stored[1] == stored[4] == 366 * 24
+
+def stored_observations(writer):
+    return writer.cnx.execute(
+        'SELECT ' + ', '.join(storage.OBSERVATION_COLUMNS) +
+        ' FROM envcan_observation ORDER BY stationID, obs_datetime_std'
+        ).fetchall()
+
+@pytest.mark.parametrize('dest', ['sqlite', 'duckdb'])
+def test_reimport_is_a_no_op(server, tmp_path, dest):
+    writer = open_writer(dest, tmp_path)
+    try:
+        def import_range(month_start, month_end):
+            import_history.write_months(
+                import_history.iter_hourly(
+                    STATION_ID, 2011, 2011, month_start, month_end, 1,
+                    TZ_NAME, base_url=server.url, columnar=True),
+                STATION_ID, dest, writer=writer)
+            import_history.write_summaries(
+                import_history.iter_summaries(
+                    STATION_ID, 2, 2011, 2011, month_start, month_end, 1,
+                    TZ_NAME, base_url=server.url),
+                STATION_ID, 2, dest, writer=writer)
+
+        import_range(1, 3)
+        stored = stored_observations(writer)
+        [daily] = writer.cnx.execute(
+            'SELECT COUNT(*) FROM envcan_daily').fetchone()
+        assert len(stored) == (31 + 28 + 31) * 24
+        assert daily == 31 + 28 + 31
+
+        # The same range again, then one overlapping it
+        import_range(1, 3)
+        assert stored_observations(writer) == stored
+        import_range(2, 4)
+        restored = stored_observations(writer)
+        [daily] = writer.cnx.execute(
+            'SELECT COUNT(*) FROM envcan_daily').fetchone()
+    finally:
+        writer.close()
+    assert restored[:len(stored)] == stored
+    assert len(restored) == (31 + 28 + 31 + 30) * 24
+    assert daily == 31 + 28 + 31 + 30
+
+def test_incremental_csv_keeps_filling_the_current_month(tmp_path,
+                                                         monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    [station, january] = parsed_month(2011, 1)
+    [station, february] = parsed_month(2011, 2, station)
+    obs_filename = str(STATION_ID) + 'observations.csv'
+
+    # A nightly run on January 16th stores the first half of the month...
+    args = incremental_args('csv', 2011, 1)
+    [year_start, month_start] = import_history.resume_month(args,
+                                                            obs_filename)
+    import_history.write_incremental(args, iter([[station, january[:360]]]),
+                                     year_start, month_start, obs_filename)
+
+    # ...and the next one has to start from January again
+    args = incremental_args('csv', 2011, 2)
+    [year_start, month_start] = import_history.resume_month(args,
+                                                            obs_filename)
+    assert [year_start, month_start] == [2011, 1]
+    import_history.write_incremental(
+        args, iter([[station, january], [station, february]]), year_start,
+        month_start, obs_filename)
+
+    with open(obs_filename, 'r', newline='') as obs_file:
+        rows = list(csv.DictReader(obs_file))
+    stamps = [row['obs_datetime_std'] for row in rows]
+    assert len(stamps) == len(january) + len(february)
+    assert len(set(stamps)) == len(stamps)
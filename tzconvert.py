@@ -0,0 +1,77 @@
+import functools
+from bisect import bisect_right
+
+import pytz
+
+class TransitionTable():
+    """
+    Precomputed UTC transition table for a pytz timezone, used to convert a
+    whole month of standard-time datetimes to local time in one pass.
+
+    The table is pytz's own (_utc_transition_times, _transition_info and
+    _tzinfos), and the conversion repeats pytz's fromutc arithmetic, so the
+    results are identical to datetime.astimezone(tz), including the tzinfo
+    object attached to each datetime. The speedup comes from locating the
+    first transition with one bisect and then walking forward, instead of a
+    bisect plus several utcoffset() calls per row.
+    """
+    def __init__(self, tz):
+        self.tz = tz
+        self.transitions = getattr(tz, '_utc_transition_times', None)
+        self.infos = getattr(tz, '_transition_info', None)
+        self.tzinfos = getattr(tz, '_tzinfos', None)
+
+    def localize(self, std_datetimes):
+        """
+        Convert aware datetimes to the table's timezone.
+
+        Keyword arguments:
+        std_datetimes -- List of aware datetimes (eg. obs_datetime_std).
+                         Ascending order is fastest but not required. None
+                         entries are passed through.
+
+        Return:
+        A list of aware datetimes in local time, one per input.
+        """
+        if self.transitions is None:
+            # StaticTzInfo/UTC have no transitions; astimezone is cheap
+            return [None if dt is None else dt.astimezone(self.tz)
+                    for dt in std_datetimes]
+
+        local_datetimes = list()
+        transitions = self.transitions
+        last_idx = len(transitions) - 1
+        idx = None
+        std_tz = None
+        for dt in std_datetimes:
+            if dt is None:
+                local_datetimes.append(None)
+                continue
+            if std_tz is not dt.tzinfo:
+                # Standard offsets are fixed per station; look up once
+                std_tz = dt.tzinfo
+                delta = dt.utcoffset()
+            utc = dt.replace(tzinfo=None) - delta
+            if idx is None or utc < transitions[idx]:
+                idx = max(0, bisect_right(transitions, utc) - 1)
+            while idx < last_idx and transitions[idx + 1] <= utc:
+                idx += 1
+            inf = self.infos[idx]
+            local_datetimes.append((utc + inf[0]).replace(
+                tzinfo=self.tzinfos[inf]))
+        return local_datetimes
+
+@functools.lru_cache(maxsize=None)
+def transition_table(tz_name):
+    """Return the shared TransitionTable for an IANA timezone name."""
+    return TransitionTable(pytz.timezone(tz_name))
+
+def localize_observations(observations, tz_name):
+    """
+    Fill obs_datetime_dst for a month of models.Observation objects from
+    their obs_datetime_std, in one pass over the transition table.
+    """
+    local_datetimes = transition_table(tz_name).localize(
+        [obs.obs_datetime_std for obs in observations])
+    for (obs, local_dt) in zip(observations, local_datetimes):
+        obs.obs_datetime_dst = local_dt